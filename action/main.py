@@ -1,15 +1,122 @@
 # standard imports
 import argparse
+import codecs
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
+import fcntl
+import fnmatch
+import functools
+import glob
+import hashlib
+import inspect
+import json
 import os
-
-import select
+import platform
+import re
+import selectors
 import shutil
+import stat
 import subprocess
 import sys
-from typing import Optional, Mapping
+import tarfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Callable, Optional, Mapping
+
+# a `KEY=value` assignment, the value may be single quoted, double quoted (and span lines), or bare
+_DOTENV_ENTRY = re.compile(r"""
+    ^[ \t]*(?:export[ \t]+)?(?P<key>[A-Za-z_][A-Za-z0-9_.]*)[ \t]*=[ \t]*
+    (?:
+        '(?P<single>(?:\\.|[^'\\])*)'[ \t]*(?:\#[^\r\n]*)?$
+        | "(?P<double>(?:\\.|[^"\\])*)"[ \t]*(?:\#[^\r\n]*)?$
+        | (?P<bare>(?!['"])[^\r\n]*)$
+    )
+""", re.MULTILINE | re.VERBOSE)
+_DOTENV_ESCAPES = {
+    '\\': '\\', "'": "'", '"': '"',
+    'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v',
+}
+_DOTENV_VARIABLE = re.compile(r'\$\{(?P<name>[^}:]*)(?::-(?P<default>[^}]*))?}')
+
+
+def parse_dotenv(text: str) -> dict:
+    """
+    Parse the contents of an environment file, with the same semantics as ``python-dotenv``.
+
+    Lines may start with ``export``. Quoted values may span lines. Double quoted values may contain the escape
+    sequences ``\\\\ \\' \\" \\a \\b \\f \\n \\r \\t \\v``, other backslashes are kept literally. Single quoted
+    values are taken literally, except for ``\\'`` and ``\\\\``. Bare values end at a `` #`` comment. Entries with an
+    unterminated quote are skipped. ``${VAR}`` and ``${VAR:-default}`` are expanded from the environment, then from
+    the values defined earlier in the file.
+
+    Parameters
+    ----------
+    text : str
+        The contents of the environment file.
+
+    Returns
+    -------
+    dict
+        The variables defined in the file.
+    """
+    values = {}
+
+    def expand(value: str) -> str:
+        return _DOTENV_VARIABLE.sub(
+            lambda m: os.environ.get(m.group('name'), values.get(m.group('name'))) or m.group('default') or '',
+            value,
+        )
+
+    for match in _DOTENV_ENTRY.finditer(text):
+        if match.group('single') is not None:
+            value = expand(re.sub(r"\\([\\'])", r'\1', match.group('single')))
+        elif match.group('double') is not None:
+            value = expand(re.sub(
+                r'\\([\\\'"abfnrtv])',
+                lambda m: _DOTENV_ESCAPES[m.group(1)],
+                match.group('double'),
+            ))
+        else:
+            value = expand(re.sub(r'(?:^|[ \t]+)#.*$', '', match.group('bare')).strip())
+        values[match.group('key')] = value
+
+    return values
+
+
+def load_dotenv(dotenv_path: Optional[str] = None) -> bool:
+    """
+    Load the variables of an environment file into the environment, without overriding variables that are already set.
+
+    Parameters
+    ----------
+    dotenv_path : Optional[str]
+        The environment file. If None, the first ``.env`` file found in the directory of this file or its parents.
+
+    Returns
+    -------
+    bool
+        Whether any variables were defined in the file.
+    """
+    if dotenv_path is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        while not os.path.isfile(os.path.join(directory, '.env')) and os.path.dirname(directory) != directory:
+            directory = os.path.dirname(directory)
+        dotenv_path = os.path.join(directory, '.env')
+
+    if not os.path.isfile(dotenv_path):
+        return False
+
+    with open(dotenv_path, 'r', encoding='utf-8') as f:
+        values = parse_dotenv(f.read())
+
+    for key, value in values.items():
+        os.environ.setdefault(key, value)
+
+    return bool(values)
 
-# lib imports
-from dotenv import load_dotenv
 
 # Load the environment variables from the Environment File
 load_dotenv()
@@ -22,11 +129,99 @@ ERROR = False
 FAILURES = []
 TEMP_DIRECTORIES = []
 HOMEBREW_BUILDPATH = ""
+BUILDPATHS = {}  # formula -> buildpath
+TESTPATHS = {}  # formula -> testpath
+FORMULA_RESULTS = {}  # formula -> list of failed phases, used in batch mode
+CACHED_FORMULAE = set()  # formulae whose successful result was replayed from the result cache
+FORMULA_FILES = {}  # formula -> input formula file, used to annotate problems in the formula
+CHECKPOINT = None  # the `Checkpoint` of the formula being validated, if checkpoints are enabled
+BREW_DIAGNOSTICS = None  # the `BrewDiagnostics` running in the background, if diagnostics are deferred
+FORMULA_DURATIONS = {}  # formula -> {phase: seconds} of the phases that ran and passed, saved to the timing database
 
 temp_repo = os.path.join('homebrew-release-action', 'homebrew-test')
 
 og_dir = os.getcwd()
 
+# subprocess output streaming
+OUTPUT_CHUNK_SIZE = 64 * 1024  # bytes read from a pipe per `os.read` call
+OUTPUT_MAX_LINE_LENGTH = 64 * 1024  # partial lines longer than this are emitted without waiting for a newline
+OUTPUT_FLUSH_INTERVAL = 0.1  # seconds, maximum time output is held in a buffer before it is written
+OUTPUT_FLUSH_SIZE = 64 * 1024  # characters, buffered console output is written once it reaches this size
+
+# collapsed logging
+LOG_TAIL_LINES = 20  # lines of output printed when a process succeeds
+# lines that are always printed to the console in collapsed logging mode
+LOG_NOTABLE_LINE = re.compile(r'\b(?:warning|error|fatal|failed|failure)\b|^::', re.IGNORECASE)
+
+# problem matching, each pattern is matched against one line of output, the first group that matches wins
+PROBLEM_MATCHER_MAX_ANNOTATIONS = 10  # per level and process, GitHub only shows a few annotations per step anyway
+_BUILD_PROBLEMS = re.compile(
+    # gcc and clang diagnostics: file:line[:column]: error: message
+    r'^(?P<cc_file>[^\s:][^:]*):(?P<cc_line>\d+):(?:\d+:)?\s+'
+    r'(?P<cc_level>fatal error|error|warning):\s+(?P<cc_message>.+)$'
+    # linker errors, prefixed by the linker or compiler driver
+    r'|^(?:\S*(?:ld|collect2|clang|clang\+\+|gcc|g\+\+|cc|c\+\+)(?:\.\w+)?:\s+)?(?:[^\s:]+:\S*:\s+)?(?:error:\s+)?'
+    r'(?P<ld_message>undefined reference to .+|undefined symbol: .+|cannot find -l\S+|library not found for .+'
+    r'|Undefined symbols for architecture .+|ld returned \d+ exit status|linker command failed.+)$'
+    # failed assertions and exceptions raised in a formula test or install block
+    r'|^\s*(?P<test_message>(?:Minitest::Assertion|Test::Unit::AssertionFailedError|BuildError|RuntimeError'
+    r'|Errno::\w+|ErrorDuringExecution): .+)$'
+    # backtrace location of the failure in a formula
+    r'|^\s*(?P<rb_file>\S+\.rb):(?P<rb_line>\d+):in '
+    # brew errors and warnings
+    r'|^(?P<brew_level>Error|Warning): (?P<brew_message>.+)$'
+)
+_AUDIT_PROBLEMS = re.compile(
+    # the full name of the formula, followed by its problems
+    r'^(?:[\w-]+/[\w-]+/)?(?P<audit_formula>[\w@+.-]+)$'
+    r'|^\s+\*\s+(?:line (?P<audit_line>\d+), col \d+: )?(?P<audit_message>.+)$'
+    r'|^(?P<brew_level>Error|Warning): (?P<brew_message>.+)$'
+)
+
+# resource accounting
+RESOURCE_SAMPLE_INTERVAL = 0.5  # seconds between samples of the process tree in `/proc`
+
+# source prefetching
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes read and hashed at a time, so memory use does not depend on the file size
+DOWNLOAD_TIMEOUT = 60  # seconds
+
+# per thread output state, e.g. the prefix used for subprocess output of concurrently validated formulae
+_OUTPUT_CONTEXT = threading.local()
+_STDOUT_LOCK = threading.Lock()  # serializes the writes of concurrent steps, so their lines don't interleave
+_TEMP_DIRECTORIES_LOCK = threading.Lock()
+_TEMP_MANIFEST_LOCK = threading.Lock()
+
+# timing trace, spans are recorded in the chrome trace event format
+TRACE_EVENTS = []
+_TRACE_EPOCH = time.perf_counter()
+_TRACE_LOCK = threading.Lock()
+
+# resource usage of subprocesses, accumulated per phase
+RESOURCE_USAGE = {}  # phase -> usage
+_RESOURCE_USAGE_LOCK = threading.Lock()
+
+# memoized result of `get_brew_environment`
+_BREW_ENVIRONMENT = None
+_BREW_ENVIRONMENT_LOCK = threading.RLock()
+
+# collects the Homebrew environment with a single shell, the brew commands used are handled by brew.sh without
+# starting Ruby, and developer mode is read from the repository config where `brew developer` stores it
+_BREW_PROBE_SCRIPT = '''
+repository="$(brew --repository 2>/dev/null)"
+printf 'version=%s\\n' "$(brew --version 2>/dev/null | head -n 1)"
+printf 'repository=%s\\n' "${repository}"
+printf 'prefix=%s\\n' "$(brew --prefix 2>/dev/null)"
+printf 'cache=%s\\n' "$(brew --cache 2>/dev/null)"
+printf 'devcmdrun=%s\\n' "$(git -C "${repository:-.}" config --get homebrew.devcmdrun 2>/dev/null)"
+'''
+
+
+def _parse_shard(value: str) -> tuple:
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f'invalid shard {value!r}, expected i/n with 1 <= i <= n')
+    return int(match.group(1)), int(match.group(2))
+
 
 def _parse_args(args_list: list) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Homebrew formula audit, install, and test')
@@ -36,55 +231,834 @@ def _parse_args(args_list: list) -> argparse.Namespace:
         help='Homebrew formula file to audit, install, and test',
         type=str,
     )
+    parser.add_argument(
+        '--formulae',
+        default=[f.strip() for f in os.getenv('INPUT_FORMULAE', '').splitlines() if f.strip()],
+        help='Homebrew formula files, directories, or glob patterns to validate together in batch mode',
+        nargs='*',
+        type=str,
+    )
+    parser.add_argument(
+        '--shard',
+        default=os.getenv('INPUT_SHARD') or None,
+        help='Validate only shard i of n of the formulae in batch mode, e.g. 1/4, balanced by recorded durations',
+        type=_parse_shard,
+    )
+    parser.add_argument(
+        '--max_workers',
+        default=int(os.getenv('INPUT_MAX_WORKERS') or 2),
+        help='Maximum number of formulae to validate concurrently in batch mode',
+        type=int,
+    )
     return parser.parse_args(args_list)
 
 
+@contextlib.contextmanager
+def _output_prefix(prefix: str):
+    """
+    Prefix subprocess output of the current thread, e.g. with the formula being validated.
+
+    Prefixes are nested, so a prefix added inside another prefix is appended to it.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix to add to each line of subprocess output.
+    """
+    og_prefix = getattr(_OUTPUT_CONTEXT, 'prefix', '')
+    _OUTPUT_CONTEXT.prefix = f'{og_prefix}{prefix}'
+    try:
+        yield
+    finally:
+        _OUTPUT_CONTEXT.prefix = og_prefix
+
+
+def _with_output_prefix(prefix: str, func: Callable) -> Callable:
+    """
+    Wrap a function to run with an output prefix in another thread, nested in the prefix of the calling thread.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix to add to each line of subprocess output.
+    func : Callable
+        The function to wrap.
+
+    Returns
+    -------
+    Callable
+        The wrapped function.
+    """
+    parent_prefix = getattr(_OUTPUT_CONTEXT, 'prefix', '')
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _output_prefix(f'{parent_prefix}{prefix}'):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _print_status(message: str) -> None:
+    """
+    Print a status message of the current thread as a single line, prefixed like its subprocess output.
+
+    ``print`` writes the message and the newline separately, so the messages of concurrent steps could end up on one
+    line. The line is written with a single locked write instead. Workflow commands, e.g. ``::error::``, are not
+    prefixed, as they are only recognized at the start of a line.
+
+    Parameters
+    ----------
+    message : str
+        The message to print.
+    """
+    prefix = '' if message.startswith('::') else getattr(_OUTPUT_CONTEXT, 'prefix', '')
+    with _STDOUT_LOCK:
+        sys.stdout.write(f'{prefix}{message}\n')
+        sys.stdout.flush()
+
+
+class Step:
+    """
+    A step of a ``run_steps`` schedule.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the step.
+    func : Callable
+        Called without arguments to run the step. Its return value is the result of the step.
+    requires : tuple
+        Names of the steps that must finish before this step starts.
+    """
+    def __init__(self, name: str, func: Callable, requires: tuple = ()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+
+def get_max_concurrency() -> int:
+    return max(1, int(os.getenv('INPUT_MAX_CONCURRENCY') or 2))
+
+
+def run_steps(steps: list, max_concurrency: int) -> dict:
+    """
+    Run steps as soon as the steps they require have finished, with at most ``max_concurrency`` running at once.
+
+    Ready steps start in the order they are declared, so with ``max_concurrency=1`` the steps run sequentially in
+    declaration order (for a declaration order that respects the requirements). The output of a step that starts while
+    another step is running, or together with another step, is prefixed with its name. The output of a step that
+    starts alone is left as is, so workflow commands printed by its subprocesses still work.
+
+    If a step raises an exception (including ``SystemExit``), no further steps are started, the running steps are
+    awaited, and the exception is re-raised.
+
+    Parameters
+    ----------
+    steps : list
+        The ``Step`` objects to run.
+    max_concurrency : int
+        Maximum number of steps to run at once.
+
+    Returns
+    -------
+    dict
+        Mapping of step name to the result of the step.
+    """
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Duplicate step names: {names}')
+    for step in steps:
+        for requirement in step.requires:
+            if requirement not in names:
+                raise ValueError(f'Step {step.name} requires unknown step {requirement}')
+
+    results = {}
+    pending = list(steps)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        while pending or running:
+            if error is None:
+                ready = [step for step in pending if all(r in results for r in step.requires)]
+                ready = ready[:max_concurrency - len(running)]
+                overlapping = len(running) + len(ready) > 1
+                for step in ready:
+                    pending.remove(step)
+                    func = _with_output_prefix(f'[{step.name}] ', step.func) if overlapping else step.func
+                    running[pool.submit(func)] = step
+
+            if not running:
+                if error is None:
+                    raise ValueError(f'Steps have circular requirements: {[step.name for step in pending]}')
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    results[step.name] = future.result()
+                except BaseException as e:
+                    error = error or e
+
+    if error is not None:
+        raise error
+
+    return results
+
+
+class _LineAssembler:
+    """
+    Reassemble lines from arbitrarily sized chunks of process output.
+
+    Complete lines are returned as soon as their newline arrives. Partial lines are held until they are completed, or
+    grow beyond ``max_line_length``. A partial line that has been pending for longer than ``OUTPUT_FLUSH_INTERVAL``
+    (e.g. a progress bar) can be shown with ``flush_stale`` while it stays pending, and ``shown`` then tells how much
+    of the first line returned by the next ``feed`` or ``flush`` was already shown.
+
+    Parameters
+    ----------
+    max_line_length : int
+        Maximum number of characters held for a single partial line.
+    """
+    def __init__(self, max_line_length: int = OUTPUT_MAX_LINE_LENGTH):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._max_line_length = max_line_length
+        self._pending = ''
+        self._pending_since = 0.0
+        self._pending_shown = 0
+        self.shown = 0  # characters of the first line returned by the last feed or flush shown by flush_stale
+
+    def feed(self, chunk: bytes) -> list:
+        text = self._pending + self._decoder.decode(chunk)
+
+        end = text.rfind('\n') + 1
+        lines = [f'{line}\n' for line in text[:end - 1].split('\n')] if end else []
+
+        if not self._pending or end:
+            self._pending_since = time.monotonic()
+        self._pending = text[end:]
+
+        if len(self._pending) >= self._max_line_length:
+            lines.append(self._pending)
+            self._pending = ''
+
+        if lines:
+            self.shown, self._pending_shown = self._pending_shown, 0
+        return lines
+
+    def flush_stale(self) -> str:
+        if len(self._pending) > self._pending_shown and \
+                time.monotonic() - self._pending_since >= OUTPUT_FLUSH_INTERVAL:
+            fragment = self._pending[self._pending_shown:]
+            self._pending_shown = len(self._pending)
+            return fragment
+        return ''
+
+    def flush(self) -> list:
+        text = self._pending + self._decoder.decode(b'', final=True)
+        self._pending = ''
+        self.shown, self._pending_shown = self._pending_shown, 0
+        return [text] if text else []
+
+
+class _BufferedWriter:
+    """
+    Buffer text and write it to stdout in batches.
+
+    The buffer is written once it holds ``OUTPUT_FLUSH_SIZE`` characters, or once ``OUTPUT_FLUSH_INTERVAL`` seconds
+    have passed since the last write, so verbose processes don't cost one write call per line.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix of every line, added to text that is written at the start of a line.
+    """
+    def __init__(self, prefix: str = ''):
+        self._buffer = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self._prefix = prefix
+        self._line_start = True
+
+    def write(self, text: str):
+        if self._prefix and self._line_start:
+            text = f'{self._prefix}{text}'
+        self._line_start = text.endswith('\n')
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= OUTPUT_FLUSH_SIZE:
+            self.flush()
+        else:
+            self.flush_stale()
+
+    def flush_stale(self):
+        if self._buffer and time.monotonic() - self._last_flush >= OUTPUT_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            with _STDOUT_LOCK:
+                sys.stdout.write(''.join(self._buffer))
+                sys.stdout.flush()
+            self._buffer.clear()
+            self._size = 0
+        self._last_flush = time.monotonic()
+
+
+def _pump_output(
+        process: subprocess.Popen,
+        on_line: Callable[[str], None],
+        on_wake: Optional[Callable[[], None]] = None,
+        on_output: Optional[Callable[[str], None]] = None,
+) -> None:
+    """
+    Stream the stdout and stderr of a process, line by line, until both pipes are closed.
+
+    Pipes are read in non-blocking chunks, and each pipe is unregistered as soon as it reaches EOF, so a closed pipe is
+    never polled again. If the process has exited but a pipe is still held open (e.g. by a daemonized grandchild), the
+    pump stops once the pipe has been idle for ``OUTPUT_FLUSH_INTERVAL`` seconds.
+
+    Parameters
+    ----------
+    process : subprocess.Popen
+        The process to read from. Both stdout and stderr must be pipes.
+    on_line : Callable[[str], None]
+        Called with each line, including its trailing newline if it has one.
+    on_wake : Optional[Callable[[], None]]
+        Called every time the pump wakes up, at least every ``OUTPUT_FLUSH_INTERVAL`` seconds even if the process is
+        quiet, e.g. to flush buffered output.
+    on_output : Optional[Callable[[str], None]]
+        Called with the output to display, before ``on_line`` is called with the same lines. Partial lines that have
+        been pending for ``OUTPUT_FLUSH_INTERVAL`` seconds are passed as they are, and only the rest of the line is
+        passed once it is completed, so each character is passed once.
+    """
+    def emit(assembler: _LineAssembler, lines: list):
+        for index, line in enumerate(lines):
+            if on_output:
+                on_output(line[assembler.shown:] if index == 0 else line)
+            on_line(line)
+
+    assemblers = {}
+    with selectors.DefaultSelector() as selector:
+        for pipe in (process.stdout, process.stderr):
+            os.set_blocking(pipe.fileno(), False)
+            selector.register(pipe.fileno(), selectors.EVENT_READ)
+            assemblers[pipe.fileno()] = _LineAssembler()
+
+        while selector.get_map():
+            events = selector.select(timeout=OUTPUT_FLUSH_INTERVAL)
+            if not events and _process_exited(process):
+                break
+
+            for key, _ in events:
+                try:
+                    chunk = os.read(key.fd, OUTPUT_CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+
+                if chunk:
+                    assembler = assemblers[key.fd]
+                    emit(assembler, assembler.feed(chunk))
+                else:  # EOF
+                    selector.unregister(key.fd)
+                    assembler = assemblers.pop(key.fd)
+                    emit(assembler, assembler.flush())
+
+            if on_output:
+                for assembler in assemblers.values():
+                    fragment = assembler.flush_stale()
+                    if fragment:
+                        on_output(fragment)
+
+            if on_wake:
+                on_wake()
+
+    for assembler in assemblers.values():
+        emit(assembler, assembler.flush())
+
+
+@contextlib.contextmanager
+def trace_span(name: str, category: str = 'phase', **kwargs):
+    """
+    Record the wall-clock duration of a block as a span in the timing trace.
+
+    Parameters
+    ----------
+    name : str
+        Name of the span.
+    category : str
+        Category of the span, e.g. ``phase`` or ``subprocess``.
+    **kwargs
+        Additional arguments to record with the span.
+
+    Yields
+    ------
+    dict
+        The span arguments, which may be updated while the block runs.
+    """
+    span_args = dict(kwargs)
+    start = time.perf_counter()
+    try:
+        yield span_args
+    finally:
+        end = time.perf_counter()
+        thread = threading.current_thread()
+        with _TRACE_LOCK:
+            TRACE_EVENTS.append(dict(
+                name=name,
+                cat=category,
+                ph='X',
+                ts=round((start - _TRACE_EPOCH) * 1e6),
+                dur=round((end - start) * 1e6),
+                pid=os.getpid(),
+                tid=thread.ident,
+                args=dict(span_args, thread=thread.name),
+            ))
+
+
+def _traced(func: Callable) -> Callable:
+    """
+    Decorate a phase function so each call is recorded as a span in the timing trace.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        name = f"{func.__name__} ({arguments['formula']})" if 'formula' in arguments else func.__name__
+        parent_phase = getattr(_OUTPUT_CONTEXT, 'phase', None)
+        _OUTPUT_CONTEXT.phase = name
+        try:
+            with trace_span(name=name, **{k: str(v) for k, v in arguments.items()}):
+                return func(*args, **kwargs)
+        finally:
+            _OUTPUT_CONTEXT.phase = parent_phase
+
+    return wrapper
+
+
+def _process_exited(process: subprocess.Popen) -> bool:
+    """
+    Check if a process has exited without reaping it, so its resource usage can still be collected by ``os.wait4``.
+    """
+    if process.returncode is not None:
+        return True
+    try:
+        return os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+    except (AttributeError, ChildProcessError, OSError):
+        return process.poll() is not None
+
+
+def _wait_process(process: subprocess.Popen) -> tuple:
+    """
+    Wait for a process to exit, and collect the resource usage of the process and its reaped descendants.
+
+    Parameters
+    ----------
+    process : subprocess.Popen
+        The process to wait for.
+
+    Returns
+    -------
+    tuple
+        The exit code, and a dict with ``cpu_user_seconds``, ``cpu_system_seconds``, ``peak_rss_bytes``,
+        ``read_bytes``, and ``write_bytes``, or None if the usage is not available on this platform. On macOS, the
+        block I/O is reported as the number of operations in ``read_blocks`` and ``write_blocks`` instead, as its size
+        is not known.
+    """
+    if process.returncode is not None or not hasattr(os, 'wait4'):
+        return process.wait(), None
+
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:  # reaped elsewhere
+        return process.wait(), None
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    usage = dict(
+        cpu_user_seconds=rusage.ru_utime,
+        cpu_system_seconds=rusage.ru_stime,
+        # kilobytes on Linux, bytes on macOS
+        peak_rss_bytes=rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+    )
+    # only I/O that reached the block device is counted, in units of 512 bytes on Linux, in operations on macOS
+    if sys.platform == 'darwin':
+        usage.update(read_blocks=rusage.ru_inblock, write_blocks=rusage.ru_oublock)
+    else:
+        usage.update(read_bytes=rusage.ru_inblock * 512, write_bytes=rusage.ru_oublock * 512)
+    return process.returncode, usage
+
+
+class _ProcessTreeSampler:
+    """
+    Sample the resident memory and I/O of a process and its descendants from ``/proc`` in a background thread.
+
+    ``os.wait4`` only reports the largest single process, and misses descendants that were not waited for, so the
+    sampler sums the memory of the whole tree, and the I/O of every process it has seen, including page cache I/O.
+
+    Parameters
+    ----------
+    pid : int
+        The root process.
+    """
+    def __init__(self, pid: int):
+        self._pid = pid
+        self._stop = threading.Event()
+        self._io = {}  # pid -> (read_bytes, write_bytes)
+        self.peak_rss_bytes = 0
+        self._thread = threading.Thread(target=self._run, name=f'sampler-{pid}', daemon=True)
+
+    @staticmethod
+    def available() -> bool:
+        return os.path.isfile('/proc/self/statm')
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.sample()
+            if self._stop.wait(RESOURCE_SAMPLE_INTERVAL):
+                break
+
+    def _descendants(self) -> list:
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat', 'r') as f:
+                    proc_stat = f.read()
+            except OSError:
+                continue
+            # the command name may contain spaces, the fields after it are space separated
+            ppid = int(proc_stat.rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+
+        pids = [self._pid]
+        for pid in pids:
+            pids.extend(children.get(pid, []))
+        return pids
+
+    def sample(self):
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        rss = 0
+        for pid in self._descendants():
+            try:
+                with open(f'/proc/{pid}/statm', 'r') as f:
+                    rss += int(f.read().split()[1]) * page_size
+                with open(f'/proc/{pid}/io', 'r') as f:
+                    io = dict(line.split(': ') for line in f.read().splitlines())
+                self._io[pid] = (int(io['rchar']), int(io['wchar']))
+            except (OSError, KeyError, ValueError, IndexError):
+                continue
+        self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+
+    @property
+    def read_bytes(self) -> int:
+        return sum(read for read, _ in self._io.values())
+
+    @property
+    def write_bytes(self) -> int:
+        return sum(write for _, write in self._io.values())
+
+
+def record_resource_usage(phase: str, usage: dict) -> None:
+    """
+    Add the resource usage of a subprocess to the totals of a phase.
+
+    CPU time and I/O are summed, peak memory is the largest peak of any subprocess in the phase.
+    """
+    with _RESOURCE_USAGE_LOCK:
+        totals = RESOURCE_USAGE.setdefault(phase, dict(processes=0))
+        totals['processes'] += 1
+        for key, value in usage.items():
+            if 'peak_' in key:
+                totals[key] = max(totals.get(key, 0), value)
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+
+def get_log_mode() -> str:
+    """
+    Get the logging mode, ``full`` to print all subprocess output, or ``collapsed`` to write it to per phase log files.
+    """
+    log_mode = os.getenv('INPUT_LOG_MODE', '') or 'full'
+    if log_mode not in ('full', 'collapsed'):
+        raise ValueError(f'::error:: Invalid log mode {log_mode}, expected full or collapsed')
+    return log_mode
+
+
+def get_log_dir() -> str:
+    return os.getenv('INPUT_LOG_DIR') or os.path.join(os.environ['GITHUB_WORKSPACE'], 'homebrew-release-action', 'logs')
+
+
+class _PhaseLog:
+    """
+    Write the full output of a subprocess to the log file of its phase, and only a summary to the console.
+
+    Lines matching ``LOG_NOTABLE_LINE`` are printed as they arrive, the last ``LOG_TAIL_LINES`` lines are printed when
+    the process exits, and the full output of the process is printed if it failed. The console output is wrapped in a
+    group, unless it is prefixed, since groups are only recognized at the start of a line.
+
+    Parameters
+    ----------
+    phase : str
+        Name of the phase, which is also the name of the log file.
+    command : str
+        The command being run.
+    console : Callable[[str], None]
+        Writes to the console.
+    group : bool
+        Whether to wrap the console output in a group.
+    """
+    def __init__(self, phase: str, command: str, console: Callable[[str], None], group: bool = True):
+        os.makedirs(get_log_dir(), exist_ok=True)
+        self.path = os.path.join(get_log_dir(), f"{re.sub(r'[^A-Za-z0-9_.@+-]+', '-', phase).strip('-')}.log")
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(f'$ {command}\n')
+        self._start = self._file.tell()
+        self._console = console
+        self._group = group
+        self._tail = collections.deque(maxlen=LOG_TAIL_LINES)
+        self._lines = 0
+
+        if self._group:
+            self._console(f'::group::{phase}: {command}\n')
+
+    def write(self, line: str):
+        self._file.write(line)
+        self._lines += 1
+        if LOG_NOTABLE_LINE.search(line):
+            self._console(line if line.endswith('\n') else f'{line}\n')
+            self._tail.clear()  # the lines before it are not repeated in the tail
+        else:
+            self._tail.append(line)
+
+    def close(self, failed: bool):
+        self._file.close()
+
+        if self._tail and not failed:
+            self._console(f'... last {len(self._tail)} of {self._lines} lines:\n')
+            for line in self._tail:
+                self._console(line if line.endswith('\n') else f'{line}\n')
+        if self._group:
+            self._console('::endgroup::\n')
+        self._console(f'Wrote {self._lines} lines to {self.path}\n')
+
+        if failed:
+            if self._group:
+                self._console(f'::group::Full log of {os.path.basename(self.path)}\n')
+            with open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+                f.seek(self._start)
+                for line in f:
+                    self._console(line)
+            if self._group:
+                self._console('::endgroup::\n')
+
+
+def _annotation_path(path: str) -> str:
+    workspace = os.getenv('GITHUB_WORKSPACE', '')
+    path = os.path.abspath(path)
+    if workspace and path.startswith(os.path.join(os.path.abspath(workspace), '')):
+        return os.path.relpath(path, workspace)
+    return path
+
+
+class _ProblemMatcher:
+    """
+    Find the causes of failures in the output of a process, to report them as GitHub annotations.
+
+    Each line is matched once against a single combined regular expression, so the cost is linear in the size of the
+    output. ``brew audit`` problems are attributed to the formula file of the formula header they follow. Compiler
+    diagnostics keep their file and line, and failures in formula code get the location from the backtrace line that
+    follows them, if it is in a formula file. Problems are deduplicated, and emitted when the process exits. Generic
+    brew ``Error:`` and ``Warning:`` lines are only emitted if the process failed, as brew prints routine warnings.
+
+    Parameters
+    ----------
+    args_list : list
+        The command, used to select the audit or build patterns.
+    """
+    def __init__(self, args_list: list):
+        self._audit = [str(arg) for arg in args_list[:2]] == ['brew', 'audit']
+        self._pattern = _AUDIT_PROBLEMS if self._audit else _BUILD_PROBLEMS
+        self._formula_files = {f'{formula}.rb': formula_file for formula, formula_file in FORMULA_FILES.items()}
+        self._audit_file = None
+        self._unlocated = None  # the last problem, if it has no location that a backtrace line could provide
+        self.problems = {}  # (level, file, line, message) -> None, an ordered set
+        self._brew_problems = set()  # generic brew errors and warnings, only relevant if the process failed
+
+    def _add(self, level: str, message: str, file: Optional[str] = None, line: Optional[str] = None):
+        key = (level, file, line, message.strip())
+        self.problems.setdefault(key, None)
+        self._unlocated = key if file is None else None
+
+    def feed(self, line: str):
+        match = self._pattern.match(line.rstrip('\n'))
+        if not match:
+            return
+        groups = match.groupdict()
+
+        if groups.get('cc_message'):
+            level = 'warning' if groups['cc_level'] == 'warning' else 'error'
+            self._add(level, groups['cc_message'], file=groups['cc_file'], line=groups['cc_line'])
+        elif groups.get('ld_message'):
+            self._add('error', groups['ld_message'])
+        elif groups.get('test_message'):
+            self._add('error', groups['test_message'])
+        elif groups.get('rb_file'):
+            formula_file = self._formula_files.get(os.path.basename(groups['rb_file']))
+            if formula_file and self._unlocated:
+                unlocated = self._unlocated
+                level, _, _, message = unlocated
+                self.problems.pop(unlocated)
+                self._add(level, message, file=_annotation_path(formula_file), line=groups['rb_line'])
+                if unlocated in self._brew_problems:
+                    self._brew_problems.add((level, _annotation_path(formula_file), groups['rb_line'], message))
+        elif groups.get('audit_formula'):
+            formula_file = FORMULA_FILES.get(groups['audit_formula'])
+            self._audit_file = _annotation_path(formula_file) if formula_file else None
+        elif groups.get('audit_message'):
+            self._add('error', groups['audit_message'], file=self._audit_file, line=groups['audit_line'] or '1')
+        elif groups.get('brew_message'):
+            self._add(groups['brew_level'].lower(), groups['brew_message'])
+            self._brew_problems.add(self._unlocated)
+
+    def emit(self, failed: bool = True) -> None:
+        """
+        Print the problems as annotations, at most ``PROBLEM_MATCHER_MAX_ANNOTATIONS`` per level.
+
+        Parameters
+        ----------
+        failed : bool
+            Whether the process failed. If not, generic brew errors and warnings are not emitted.
+        """
+        emitted = collections.Counter()
+        for problem in self.problems:
+            if not failed and problem in self._brew_problems:
+                continue
+            level, file, line, message = problem
+            emitted[level] += 1
+            if emitted[level] > PROBLEM_MATCHER_MAX_ANNOTATIONS:
+                continue
+            location = ','.join(f'{key}={value}' for key, value in (('file', file), ('line', line)) if value)
+            print(f'::{level}{" " + location if location else ""}::{message}')
+
+        for level, count in emitted.items():
+            if count > PROBLEM_MATCHER_MAX_ANNOTATIONS:
+                print(f'{count - PROBLEM_MATCHER_MAX_ANNOTATIONS} more {level}s were not annotated')
+
+
 def _run_subprocess(
         args_list: list,
         cwd: Optional[str] = None,
         env: Optional[Mapping] = None,
         ignore_error: bool = False,
+        line_callback: Optional[Callable[[str], None]] = None,
+        set_error: bool = True,
 ) -> bool:
+    # a failure sets ERROR unless it is ignored, or the caller handles it with `set_error=False`, e.g. by retrying
     global ERROR
-    if cwd:
-        os.chdir(cwd)  # hack for unit testing on windows
-    process = subprocess.Popen(
-        args=args_list,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        cwd=cwd,
-        env=env,
-    )
-
-    if cwd:
-        os.chdir(og_dir)
-
-    # Print stdout and stderr in real-time
-    while True:
-        reads = [process.stdout.fileno(), process.stderr.fileno()]
-        ret = select.select(reads, [], [])
-
-        for fd in ret[0]:
-            if fd == process.stdout.fileno():
-                read = process.stdout.readline()
-                print(read.decode('utf-8'), end='')
-            if fd == process.stderr.fileno():
-                read = process.stderr.readline()
-                print(read.decode('utf-8'), end='')
-
-        if process.poll() is not None:
-            break
-
-    # close the file descriptors
-    process.stdout.close()
-    process.stderr.close()
+    span_name = ' '.join(str(arg) for arg in args_list[:2])
+    with trace_span(
+            name=span_name,
+            category='subprocess',
+            command=' '.join(str(arg) for arg in args_list),
+    ) as span:
+        # hack for unit testing on windows, only in the main thread as it changes the cwd of every thread
+        chdir = cwd and threading.current_thread() is threading.main_thread()
+        if chdir:
+            os.chdir(cwd)
+        process = subprocess.Popen(
+            args=args_list,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=env,
+        )
 
-    exit_code = process.wait()
+        if chdir:
+            os.chdir(og_dir)
+
+        sampler = None
+        if os.getenv('INPUT_RESOURCE_SAMPLING', 'false').lower() == 'true' and _ProcessTreeSampler.available():
+            sampler = _ProcessTreeSampler(pid=process.pid)
+
+        # Print stdout and stderr in real-time
+        writer = _BufferedWriter(prefix=getattr(_OUTPUT_CONTEXT, 'prefix', ''))
+
+        callbacks = [line_callback] if line_callback else []
+        matcher = None
+        # failures of processes with ignore_error, e.g. `brew doctor`, are not problems
+        if not ignore_error and os.getenv('INPUT_PROBLEM_MATCHER', 'true').lower() == 'true':
+            matcher = _ProblemMatcher(args_list=args_list)
+            callbacks.append(matcher.feed)
+
+        phase_log = None
+        if get_log_mode() == 'collapsed':
+            phase_log = _PhaseLog(
+                phase=getattr(_OUTPUT_CONTEXT, 'phase', None) or span_name,
+                command=span['command'],
+                console=writer.write,
+                group=not getattr(_OUTPUT_CONTEXT, 'prefix', ''),
+            )
+            callbacks.append(phase_log.write)
+
+        def on_line(line: str):
+            for callback in callbacks:
+                callback(line)
+
+        try:
+            with sampler or contextlib.nullcontext():
+                _pump_output(
+                    process=process,
+                    on_line=on_line,
+                    on_wake=writer.flush_stale,
+                    on_output=None if phase_log else writer.write,
+                )
+        finally:
+            writer.flush()
+
+            # close the file descriptors
+            process.stdout.close()
+            process.stderr.close()
+
+        exit_code, usage = _wait_process(process)
+        span['exit_code'] = exit_code
+
+        if phase_log:
+            phase_log.close(failed=exit_code != 0)
+            writer.flush()
+
+        if matcher:
+            matcher.emit(failed=exit_code != 0)
+
+        if sampler:
+            usage = dict(
+                usage or {},
+                tree_peak_rss_bytes=sampler.peak_rss_bytes,
+                tree_read_bytes=sampler.read_bytes,
+                tree_write_bytes=sampler.write_bytes,
+            )
+        if usage:
+            span.update(usage)
+            record_resource_usage(phase=getattr(_OUTPUT_CONTEXT, 'phase', None) or span_name, usage=usage)
 
     if exit_code == 0:
         return True
 
-    print(f'::error:: Process [{args_list}] failed with exit code', exit_code)
+    if not (ignore_error or set_error):
+        _print_status(f'::warning:: Process [{args_list}] failed with exit code {exit_code}')
+        return False
+
+    _print_status(f'::error:: Process [{args_list}] failed with exit code {exit_code}')
     if not ignore_error:
         ERROR = True
         return False
@@ -92,6 +1066,39 @@ def _run_subprocess(
     return True
 
 
+def _capture_subprocess(args_list: list) -> Optional[str]:
+    """
+    Run a process and capture its stdout, for commands whose output is parsed instead of displayed.
+
+    Parameters
+    ----------
+    args_list : list
+        The command to run.
+
+    Returns
+    -------
+    Optional[str]
+        The stdout of the process, or None if the process failed.
+    """
+    with trace_span(
+            name=' '.join(str(arg) for arg in args_list[:2]),
+            category='subprocess',
+            command=' '.join(str(arg) for arg in args_list),
+    ) as span:
+        proc = subprocess.run(
+            args=args_list,
+            capture_output=True,
+        )
+        span['exit_code'] = proc.returncode
+
+    if proc.returncode != 0:
+        print(f'::warning:: Process [{args_list}] failed with exit code', proc.returncode)
+        print(proc.stderr.decode('utf-8', errors='replace'), end='')
+        return None
+
+    return proc.stdout.decode('utf-8', errors='replace')
+
+
 def set_github_action_output(output_name: str, output_value: str):
     """
     Set the output value by writing to the outputs in the Environment File, mimicking the behavior defined <here
@@ -110,162 +1117,905 @@ def set_github_action_output(output_name: str, output_value: str):
         f.write('\nEOF\n')
 
 
-def get_brew_repository() -> str:
-    proc = subprocess.run(
-        args=['brew', '--repository'],
-        capture_output=True,
-    )
-    return proc.stdout.decode('utf-8').strip()
+def set_github_step_summary(markdown: str):
+    """
+    Append markdown to the job summary, mimicking the behavior defined <here
+    https://docs.github.com/en/actions/using-workflows/workflow-commands-for-github-actions#adding-a-job-summary>__.
 
+    Parameters
+    ----------
+    markdown : str
+        Markdown to append.
+    """
+    with open(os.path.abspath(os.environ["GITHUB_STEP_SUMMARY"]), "a") as f:
+        f.write(markdown)
 
-def prepare_homebrew_core_fork(
-        branch_suffix: str,
-        path: str,
-) -> None:
-    global ERROR
 
-    og_error = ERROR
+def export_trace() -> str:
+    """
+    Write the timing trace as a chrome trace event file, and add a table of the spans to the job summary.
 
-    print('Preparing Homebrew/homebrew-core fork')
+    The trace can be opened in ``chrome://tracing`` or https://ui.perfetto.dev.
 
-    # checkout a new branch
-    branch_name = f'homebrew-release-action/{branch_suffix}'
+    Returns
+    -------
+    str
+        The path to the trace file.
+    """
+    trace_file = os.getenv('INPUT_TRACE_FILE') or os.path.join(
+        os.environ['GITHUB_WORKSPACE'], 'homebrew-release-action', 'trace.json')
 
-    print(f'Attempt to create new branch {branch_name}')
-    result = _run_subprocess(
-        args_list=['git', 'checkout', '-b', branch_name],
-        cwd=path,
-    )
-    if not result:  # checkout the existing branch
-        print(f'Attempting to checkout existing branch {branch_name}')
-        result = _run_subprocess(
-            args_list=['git', 'checkout', branch_name],
-            cwd=path,
-        )
+    with _TRACE_LOCK:
+        events = sorted(TRACE_EVENTS, key=lambda e: e['ts'])
 
-    if result:
-        ERROR = og_error
-    else:
-        raise SystemExit(1, f'::error:: Failed to create or checkout branch {branch_name}')
+    # name the threads, so concurrent phases are labelled in the trace viewer
+    threads = {e['tid']: e['args']['thread'] for e in events}
+    metadata = [
+        dict(name='thread_name', ph='M', pid=os.getpid(), tid=tid, args=dict(name=name))
+        for tid, name in threads.items()
+    ]
 
-    og_error = ERROR
+    os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+    with open(trace_file, 'w') as f:
+        json.dump(dict(traceEvents=metadata + events, displayTimeUnit='ms'), f)
 
-    # add the upstream remote
-    print('Adding upstream remote')
-    _run_subprocess(
-        args_list=[
-            'git',
-            'remote',
-            'add',
-            'upstream',
-            f'https://github.com/{os.environ["INPUT_UPSTREAM_HOMEBREW_CORE_REPO"]}'
-        ],
-        cwd=path,
+    set_github_action_output(
+        output_name='trace_file',
+        output_value=trace_file,
     )
 
-    # fetch the upstream remote
-    print('Fetching upstream remote')
-    _run_subprocess(
-        args_list=['git', 'fetch', 'upstream', '--depth=1'],
-        cwd=path,
+    rows = [
+        f"| {e['name']} | {e['cat']} | {e['ts'] / 1e6:.2f} | {e['dur'] / 1e6:.2f} |"
+        for e in events
+    ]
+    set_github_step_summary(
+        '## Homebrew Release Timing\n\n'
+        '| Span | Category | Start (s) | Duration (s) |\n'
+        '|------|----------|-----------|--------------|\n'
+        + '\n'.join(rows) + '\n\n'
     )
 
-    # hard reset
-    print('Hard resetting to upstream/master')
-    _run_subprocess(
-        args_list=['git', 'reset', '--hard', 'upstream/master'],
-        cwd=path,
-    )
+    return trace_file
+
+
+def export_resource_usage() -> dict:
+    """
+    Set the ``resource_usage`` output to the resource usage of each phase, and add it to the job summary.
+
+    Returns
+    -------
+    dict
+        The resource usage of each phase.
+    """
+    with _RESOURCE_USAGE_LOCK:
+        usage = {phase: dict(totals) for phase, totals in RESOURCE_USAGE.items()}
+
+    for totals in usage.values():
+        totals['cpu_seconds'] = round(totals.get('cpu_user_seconds', 0) + totals.get('cpu_system_seconds', 0), 3)
 
     set_github_action_output(
-        output_name='homebrew_core_branch',
-        output_value=branch_name
+        output_name='resource_usage',
+        output_value=json.dumps(usage),
     )
 
+    if not usage:
+        return usage
 
-def process_input_formula(formula_file: str) -> str:
-    # check if the formula file exists
-    if not os.path.exists(formula_file):
-        raise FileNotFoundError(f'::error:: Formula file {formula_file} does not exist')
-
-    # check if the formula file is a file
-    if not os.path.isfile(formula_file):
-        raise FileNotFoundError(f'::error:: Formula file {formula_file} is not a file')
+    def mib(value: Optional[int]) -> str:
+        return f'{value / 2 ** 20:.1f}' if value is not None else ''
 
-    # check if the formula file is a .rb file
-    if not formula_file.endswith('.rb'):
-        raise ValueError(f'::error:: Formula file {formula_file} is not a .rb file')
+    rows = [
+        f"| {phase} | {totals['processes']} | {totals['cpu_seconds']:.2f} | "
+        f"{mib(totals.get('tree_peak_rss_bytes', totals.get('peak_rss_bytes')))} | "
+        f"{mib(totals.get('tree_read_bytes', totals.get('read_bytes')))} | "
+        f"{mib(totals.get('tree_write_bytes', totals.get('write_bytes')))} |"
+        for phase, totals in usage.items()
+    ]
+    set_github_step_summary(
+        '## Homebrew Release Resource Usage\n\n'
+        '| Phase | Processes | CPU (s) | Peak Memory (MiB) | Read (MiB) | Written (MiB) |\n'
+        '|-------|-----------|---------|-------------------|------------|---------------|\n'
+        + '\n'.join(rows) + '\n\n'
+    )
 
-    # get filename
-    formula_filename = os.path.basename(formula_file)
-    print(f'formula_filename: {formula_filename}')
+    return usage
 
-    formula = formula_filename.split('.')[0]
 
-    # get the first letter of formula name
-    first_letter = formula_filename[0].lower()
-    print(f'first_letter: {first_letter}')
+def _probe_brew_environment() -> dict:
+    with trace_span(name='brew environment', category='subprocess'):
+        proc = subprocess.run(
+            args=['/bin/sh', '-c', _BREW_PROBE_SCRIPT],
+            capture_output=True,
+        )
 
-    # enable developer mode
-    print('Enabling brew developer mode')
-    _run_subprocess(
-        args_list=[
-            'brew',
-            'developer',
-            'on'
-        ],
+    values = dict(line.split('=', 1) for line in proc.stdout.decode('utf-8').splitlines() if '=' in line)
+    try:
+        temp = get_root_tmp_dir()
+    except FileNotFoundError:
+        temp = ''
+
+    return dict(
+        version=values.get('version', '').strip(),
+        repository=values.get('repository', '').strip(),
+        prefix=values.get('prefix', '').strip(),
+        cache=values.get('cache', '').strip(),
+        temp=temp,
+        developer=(
+            values.get('devcmdrun', '').strip() == 'true' or
+            os.getenv('HOMEBREW_DEVELOPER', '') not in ('', '0', 'false')
+        ),
     )
 
-    # run brew tap
-    print(f'Running `brew tap-new {temp_repo} --no-git`')
-    _run_subprocess(
-        args_list=[
-            'brew',
-            'tap-new',
-            temp_repo,
-            '--no-git'
-        ],
+
+def _brew_environment_cache_file() -> Optional[str]:
+    if os.getenv('INPUT_BREW_ENVIRONMENT_CACHE', 'false').lower() != 'true':
+        return None
+    return os.path.join(get_cache_dir(), 'brew-environment.json')
+
+
+def _brew_environment_session() -> str:
+    # the workflow run and attempt identify the runner session, the brew executable identifies the installation
+    return ':'.join([
+        shutil.which('brew') or '',
+        os.getenv('GITHUB_RUN_ID', ''),
+        os.getenv('GITHUB_RUN_ATTEMPT', ''),
+    ])
+
+
+def get_brew_environment(refresh: bool = False) -> dict:
+    """
+    Get the Homebrew version, repository, prefix, cache, temp directory, and developer mode state.
+
+    The values are collected by a single shell invocation and memoized for the process. If
+    ``INPUT_BREW_ENVIRONMENT_CACHE`` is ``true``, they are also stored in the cache directory and reused by later
+    steps of the same workflow run on the runner.
+
+    Parameters
+    ----------
+    refresh : bool
+        Probe the environment again, ignoring the memoized values.
+
+    Returns
+    -------
+    dict
+        The Homebrew environment. ``version`` is empty if Homebrew is not installed.
+    """
+    global _BREW_ENVIRONMENT
+
+    with _BREW_ENVIRONMENT_LOCK:
+        if refresh:
+            invalidate_brew_environment()
+
+        cache_file = _brew_environment_cache_file()
+        if _BREW_ENVIRONMENT is None and cache_file:
+            try:
+                with open(cache_file, 'r') as f:
+                    cached = json.load(f)
+                if cached.get('session') == _brew_environment_session():
+                    _BREW_ENVIRONMENT = cached['environment']
+            except (OSError, ValueError, KeyError):
+                pass
+
+        if _BREW_ENVIRONMENT is None:
+            _BREW_ENVIRONMENT = _probe_brew_environment()
+            if cache_file and _BREW_ENVIRONMENT['version']:
+                with open(f'{cache_file}.tmp', 'w') as f:
+                    json.dump(dict(session=_brew_environment_session(), environment=_BREW_ENVIRONMENT), f)
+                os.replace(f'{cache_file}.tmp', cache_file)
+
+        return dict(_BREW_ENVIRONMENT)
+
+
+def invalidate_brew_environment() -> None:
+    """
+    Forget the memoized Homebrew environment, after running a command that changes it, e.g. ``brew update``.
+    """
+    global _BREW_ENVIRONMENT
+
+    with _BREW_ENVIRONMENT_LOCK:
+        _BREW_ENVIRONMENT = None
+        cache_file = _brew_environment_cache_file()
+        if cache_file and os.path.isfile(cache_file):
+            os.remove(cache_file)
+
+
+def get_brew_repository() -> str:
+    return get_brew_environment()['repository']
+
+
+def get_brew_repository_head() -> str:
+    proc = subprocess.run(
+        args=['git', '-C', get_brew_repository(), 'rev-parse', 'HEAD'],
+        capture_output=True,
+    )
+    return proc.stdout.decode('utf-8').strip() if proc.returncode == 0 else ''
+
+
+def get_brew_version() -> str:
+    return get_brew_environment()['version']
+
+
+def get_cache_dir() -> str:
+    """
+    Get the runner local directory used to persist state between runs, e.g. on self-hosted runners.
+
+    Returns
+    -------
+    str
+        The ``INPUT_CACHE_DIR`` environment variable if set, otherwise ``homebrew-release-action`` in the user cache
+        directory.
+    """
+    cache_dir = os.getenv('INPUT_CACHE_DIR') or os.path.join(
+        os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+        'homebrew-release-action',
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _brew_update_stamp_file() -> str:
+    return os.path.join(get_cache_dir(), 'brew-update.json')
+
+
+def is_brew_update_fresh(max_age: float) -> bool:
+    """
+    Check if ``brew update`` was run recently enough to be skipped.
+
+    The stamp file written by ``write_brew_update_stamp`` is fresh if it was written less than ``max_age`` seconds ago,
+    and the Homebrew repository HEAD has not changed since.
+
+    Parameters
+    ----------
+    max_age : float
+        Maximum age of the stamp file in seconds.
+
+    Returns
+    -------
+    bool
+        True if the stamp is fresh, otherwise False.
+    """
+    try:
+        with open(_brew_update_stamp_file(), 'r') as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    head = get_brew_repository_head()
+    return bool(head) and stamp.get('head') == head and 0 <= time.time() - stamp.get('timestamp', 0) <= max_age
+
+
+def write_brew_update_stamp() -> None:
+    stamp_file = _brew_update_stamp_file()
+    with open(f'{stamp_file}.tmp', 'w') as f:
+        json.dump(dict(head=get_brew_repository_head(), timestamp=time.time()), f)
+    os.replace(f'{stamp_file}.tmp', stamp_file)
+
+
+def get_upstream_homebrew_core_url() -> str:
+    """
+    Get the URL of the upstream homebrew-core repository.
+
+    Returns
+    -------
+    str
+        ``INPUT_UPSTREAM_HOMEBREW_CORE_REPO`` as a GitHub URL, unless it is already a URL or a local directory, e.g. a
+        bare repository standing in for the upstream repository.
+    """
+    upstream = os.environ["INPUT_UPSTREAM_HOMEBREW_CORE_REPO"]
+    if '://' in upstream:
+        return upstream
+    if os.path.isdir(upstream):
+        return f'file://{os.path.abspath(upstream)}'
+    return f'https://github.com/{upstream}'
+
+
+@contextlib.contextmanager
+def _file_lock(lock_file: str):
+    """
+    Hold an exclusive ``flock`` on a lock file, to serialize access to state shared by runs on the same runner.
+    """
+    with open(lock_file, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _git_rev_parse(path: str, ref: str) -> Optional[str]:
+    proc = subprocess.run(
+        args=['git', 'rev-parse', '--verify', '--quiet', ref],
+        cwd=path,
+        capture_output=True,
+    )
+    return proc.stdout.decode('utf-8').strip() if proc.returncode == 0 else None
+
+
+def get_homebrew_core_mirror() -> Optional[str]:
+    """
+    Get the path of the runner local mirror of upstream homebrew-core.
+
+    Returns
+    -------
+    Optional[str]
+        The ``INPUT_HOMEBREW_CORE_MIRROR`` environment variable as an absolute path, or None if the mirror is disabled.
+    """
+    mirror = os.getenv('INPUT_HOMEBREW_CORE_MIRROR')
+    return os.path.abspath(os.path.expanduser(mirror)) if mirror else None
+
+
+def update_homebrew_core_mirror(mirror: str, url: str) -> Optional[str]:
+    """
+    Create or incrementally update a bare mirror of the master branch of upstream homebrew-core.
+
+    The mirror is kept across runs, so only the commits pushed upstream since the last run are downloaded, and the
+    fetch is skipped entirely when ``git ls-remote`` shows the mirror is already current. Updates are serialized with
+    ``flock`` against other runs on the same runner.
+
+    Parameters
+    ----------
+    mirror : str
+        Path to the bare mirror repository.
+    url : str
+        URL of the upstream homebrew-core repository.
+
+    Returns
+    -------
+    Optional[str]
+        The commit of master in the mirror, or None if the mirror could not be updated.
+    """
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    with _file_lock(f'{mirror}.lock'):
+        if not os.path.isdir(mirror):
+            print(f'Creating homebrew-core mirror in {mirror}')
+            if not _run_subprocess(args_list=['git', 'init', '--bare', '--quiet', mirror], set_error=False):
+                return None
+
+        remote = _capture_subprocess(args_list=['git', 'ls-remote', url, 'refs/heads/master'])
+        head = _git_rev_parse(path=mirror, ref='refs/heads/master')
+        if remote and remote.split()[0] == head:
+            print(f'homebrew-core mirror is already current at {head}')
+            return head
+
+        print(f'Updating homebrew-core mirror in {mirror}')
+        if not _run_subprocess(
+                args_list=['git', 'fetch', '--no-tags', url, '+refs/heads/master:refs/heads/master'],
+                cwd=mirror,
+                set_error=False,
+        ):
+            return None
+
+        return _git_rev_parse(path=mirror, ref='refs/heads/master')
+
+
+def _borrow_homebrew_core_mirror(path: str) -> bool:
+    """
+    Point upstream/master of the fork at the mirror, borrowing the objects of the mirror with git alternates.
+
+    Returns
+    -------
+    bool
+        True if upstream/master now matches the mirror, otherwise False and upstream should be fetched instead.
+    """
+    mirror = get_homebrew_core_mirror()
+    head = update_homebrew_core_mirror(mirror=mirror, url=get_upstream_homebrew_core_url())
+    if not head:
+        print('::warning:: Failed to update the homebrew-core mirror, fetching upstream instead')
+        return False
+
+    alternates = _capture_subprocess(
+        args_list=['git', '-C', path, 'rev-parse', '--git-path', 'objects/info/alternates'],
+    )
+    if alternates is None:
+        print('::warning:: Failed to find the object store of the homebrew-core fork, fetching upstream instead')
+        return False
+    alternates = os.path.join(path, alternates.strip())
+    mirror_objects = os.path.join(mirror, 'objects')
+    try:
+        with open(alternates, 'r') as f:
+            borrowed = f.read().splitlines()
+    except FileNotFoundError:
+        borrowed = []
+    if mirror_objects not in borrowed:
+        print(f'Borrowing objects from the homebrew-core mirror in {mirror}')
+        with open(alternates, 'a') as f:
+            f.write(f'{mirror_objects}\n')
+
+    if _git_rev_parse(path=path, ref='refs/remotes/upstream/master') == head:
+        print('upstream/master is already current, skipping fetch')
+        return True
+
+    # every object is already available from the mirror, so only the ref needs to be set
+    if not _run_subprocess(
+            args_list=['git', 'update-ref', 'refs/remotes/upstream/master', head],
+            cwd=path,
+            set_error=False,
+    ):
+        print('::warning:: Failed to point upstream/master at the homebrew-core mirror, fetching upstream instead')
+        return False
+
+    return True
+
+
+@_traced
+def prepare_homebrew_core_fork(
+        branch_suffix: str,
+        path: str,
+        sparse_paths: Optional[list] = None,
+) -> None:
+    """
+    Create or checkout the branch for the formula in the homebrew-core fork, and hard reset it to upstream/master.
+
+    Parameters
+    ----------
+    branch_suffix : str
+        Suffix of the branch name, usually the formula name.
+    path : str
+        Path to the homebrew-core fork.
+    sparse_paths : Optional[list]
+        If provided, the working tree is limited to these paths with a sparse checkout, and upstream is fetched without
+        blobs (``--filter=blob:none``). Only the blobs of the sparse paths are then downloaded by the reset, instead of
+        the thousands of formula files in homebrew-core.
+
+    Notes
+    -----
+    If ``INPUT_HOMEBREW_CORE_MIRROR`` is set, upstream is read from a mirror kept on the runner instead. The fork
+    borrows the objects of the mirror with git alternates, so neither the upstream remote nor a fetch is needed.
+    """
+    print('Preparing Homebrew/homebrew-core fork')
+
+    if sparse_paths:
+        print(f'Limiting the working tree to {sparse_paths}')
+        _run_subprocess(
+            args_list=['git', 'sparse-checkout', 'set', '--no-cone'] + [f'/{p}' for p in sparse_paths],
+            cwd=path,
+        )
+
+    # checkout a new branch
+    branch_name = f'homebrew-release-action/{branch_suffix}'
+
+    print(f'Attempt to create new branch {branch_name}')
+    result = _run_subprocess(
+        args_list=['git', 'checkout', '-b', branch_name],
+        cwd=path,
+        set_error=False,
+    )
+    if not result:  # checkout the existing branch
+        print(f'Attempting to checkout existing branch {branch_name}')
+        result = _run_subprocess(
+            args_list=['git', 'checkout', branch_name],
+            cwd=path,
+            set_error=False,
+        )
+
+    if not result:
+        raise SystemExit(1, f'::error:: Failed to create or checkout branch {branch_name}')
+
+    if not (get_homebrew_core_mirror() and _borrow_homebrew_core_mirror(path=path)):
+        # add the upstream remote
+        print('Adding upstream remote')
+        _run_subprocess(
+            args_list=[
+                'git',
+                'remote',
+                'add',
+                'upstream',
+                get_upstream_homebrew_core_url(),
+            ],
+            cwd=path,
+        )
+
+        # fetch the upstream remote
+        print('Fetching upstream remote')
+        _run_subprocess(
+            args_list=['git', 'fetch', 'upstream', '--depth=1'] + (['--filter=blob:none'] if sparse_paths else []),
+            cwd=path,
+        )
+
+    # hard reset
+    print('Hard resetting to upstream/master')
+    _run_subprocess(
+        args_list=['git', 'reset', '--hard', 'upstream/master'],
+        cwd=path,
+    )
+
+    set_github_action_output(
+        output_name='homebrew_core_branch',
+        output_value=branch_name
     )
 
+
+def get_formula_class_name(formula: str) -> str:
+    """
+    Get the class name Homebrew expects for a formula name, e.g. ``HelloWorld`` for ``hello_world``.
+
+    This mirrors ``Formulary.class_s`` in Homebrew.
+    """
+    class_name = formula.capitalize()
+    class_name = re.sub(r'[-_.\s]([a-zA-Z0-9])', lambda m: m.group(1).upper(), class_name)
+    class_name = class_name.replace('+', 'x')
+    return re.sub(r'(.)@(\d)', r'\1AT\2', class_name, count=1)
+
+
+# statements that open a block closed by `end`, when they start a line or end it with `do`
+_RUBY_BLOCK_START = re.compile(
+    r'^(?:if|unless|case|while|until|begin|def|class|module)\b'  # e.g. `if OS.mac?`
+    r'|=\s*(?:if|unless|case|while|until|begin)\b'  # e.g. `args = if OS.mac?` or `args ||= begin`
+    r'|\bdo\s*(?:\|[^|]*\|)?$'  # e.g. `test do` or `each do |f|`
+)
+_RUBY_HEREDOC = re.compile(r'<<[~-]?([\'"]?)([A-Z_]+)\1')
+_RUBY_STRING_CALL = re.compile(r'^(?P<method>[a-z_0-9]+)[ (]\s*"(?P<value>[^"]*)"(?P<rest>.*)$')
+
+
+def _strip_ruby_comment(line: str) -> str:
+    quote = None
+    escaped = False
+    for index, char in enumerate(line):
+        if escaped:
+            escaped = False
+        elif char == '\\' and quote:
+            escaped = True
+        elif quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '#':
+            return line[:index].rstrip()
+    return line
+
+
+def parse_formula(text: str) -> dict:
+    """
+    Extract the parts of a Ruby formula that can be checked without Homebrew.
+
+    The formula is scanned line by line, tracking ``do``/``end`` blocks, so e.g. the ``url`` of a ``resource`` is not
+    mistaken for the ``url`` of the formula. Lines ending with ``,`` are joined with the next line, so the options of a
+    multi-line ``url`` are kept. The first ``url`` and ``sha256`` in ``stable`` and ``on_*`` blocks (e.g. ``on_macos``)
+    count as those of the formula, and a ``url`` in a ``head`` block as its ``head``. Heredocs and comments are
+    skipped.
+
+    Parameters
+    ----------
+    text : str
+        The contents of the formula file.
+
+    Returns
+    -------
+    dict
+        ``class_name`` and ``class_line``, the ``url``, ``sha256``, ``version``, and ``head`` of the formula as
+        ``(value, line)`` tuples, ``url_options`` with the rest of the ``url`` line, ``url_conditional`` if the
+        ``url`` is declared in an ``on_*`` block and may not apply to this platform, ``depends_on`` as a list of
+        ``(name, line)``, ``resources`` as a list of dicts with ``name``, ``line``, ``url``, ``url_options``, and
+        ``sha256``, ``test`` with the ``line`` and number of ``statements`` of the test block, or None, and
+        ``unbalanced`` with the line where the ``do``/``end`` blocks stopped matching up, or None.
+    """
+    formula = dict(class_name=None, class_line=None, depends_on=[], resources=[], test=None, unbalanced=None)
+    stack = []  # (kind, dict of the block)
+    heredoc = None
+    continued = None  # (line number, text) of a statement continued on the next line
+
+    for number, line in enumerate(text.splitlines(), start=1):
+        stripped = line.strip()
+        if heredoc:
+            if stripped == heredoc:
+                heredoc = None
+            continue
+        if stripped == '__END__':  # the rest is data, e.g. a patch
+            break
+        stripped = _strip_ruby_comment(stripped)
+        if not stripped:
+            continue
+
+        if continued:
+            number, stripped = continued[0], f'{continued[1]} {stripped}'
+            continued = None
+        if stripped.endswith(','):
+            continued = (number, stripped)
+            continue
+
+        match = _RUBY_HEREDOC.search(stripped)
+        if match:
+            heredoc = match.group(2)
+
+        kind = stack[-1][0] if stack else None
+        call = _RUBY_STRING_CALL.match(stripped)
+        if kind in ('formula', 'stable', 'on') and call:
+            method = call.group('method')
+            if method in ('url', 'sha256', 'version', 'head') and method not in formula:
+                formula[method] = (call.group('value'), number)
+                if method == 'url':
+                    formula['url_options'] = call.group('rest')
+                    formula['url_conditional'] = kind == 'on'
+            elif method == 'depends_on':
+                formula['depends_on'].append((call.group('value'), number))
+        elif kind == 'head' and call and call.group('method') == 'url':
+            formula.setdefault('head', (call.group('value'), number))
+        elif kind == 'resource' and call and call.group('method') in ('url', 'sha256'):
+            stack[-1][1].setdefault(call.group('method'), call.group('value'))
+            if call.group('method') == 'url':
+                stack[-1][1]['url_options'] = call.group('rest')
+
+        if stripped == 'end' or stripped.startswith('end ') or stripped.startswith('end.'):
+            if stack:
+                stack.pop()
+            elif formula['unbalanced'] is None:
+                formula['unbalanced'] = number
+            continue
+
+        if not stack and formula['class_name'] and formula['unbalanced'] is None:
+            # the formula class was closed by an `end` of a block that was not recognized
+            formula['unbalanced'] = number
+
+        for _, block in stack:
+            if block is not None and 'statements' in block:
+                block['statements'] += 1
+
+        if not _RUBY_BLOCK_START.search(stripped):
+            continue
+
+        class_match = re.match(r'^class\s+(\w+)\s*<\s*Formula\b', stripped)
+        if class_match and not stack:
+            formula['class_name'] = class_match.group(1)
+            formula['class_line'] = number
+            stack.append(('formula', None))
+        elif kind == 'formula' and call and call.group('method') == 'resource':
+            resource = dict(name=call.group('value'), line=number)
+            formula['resources'].append(resource)
+            stack.append(('resource', resource))
+        elif kind == 'formula' and re.match(r'^test\s+do$', stripped):
+            formula['test'] = dict(line=number, statements=0)
+            stack.append(('test', formula['test']))
+        elif kind == 'formula' and re.match(r'^stable\s+do$', stripped):
+            stack.append(('stable', None))
+        elif kind == 'formula' and re.match(r'^head\s+do$', stripped):
+            stack.append(('head', None))
+        elif kind in ('formula', 'on') and re.match(r'^on_\w+\b.*\bdo$', stripped):
+            stack.append(('on', None))
+        else:
+            stack.append(('block', None))
+
+    if stack and formula['unbalanced'] is None:
+        formula['unbalanced'] = number
+
+    return formula
+
+
+def _is_git_url(url: str, url_options: str) -> bool:
+    return url.endswith('.git') or url.startswith('git://') or ':git' in url_options or 'revision:' in url_options
+
+
+def check_formula(formula_file: str) -> list:
+    """
+    Check a formula file for problems that would make the brew pipeline fail, without running brew.
+
+    Parameters
+    ----------
+    formula_file : str
+        The formula file.
+
+    Returns
+    -------
+    list
+        ``(level, line, message)`` tuples, where level is ``error`` or ``warning``.
+    """
+    with open(formula_file, 'r', encoding='utf-8') as f:
+        formula = parse_formula(f.read())
+
+    problems = []
+    if not formula['class_name']:
+        return [('error', 1, 'No `class ... < Formula` definition found')]
+
+    expected_class_name = get_formula_class_name(os.path.basename(formula_file).rsplit('.', 1)[0])
+    if formula['class_name'] != expected_class_name:
+        problems.append((
+            'error',
+            formula['class_line'],
+            f'Class name {formula["class_name"]} does not match the file name, expected {expected_class_name}',
+        ))
+    class_problems = len(problems)
+
+    if 'url' not in formula and 'head' not in formula:
+        problems.append(('error', formula['class_line'], 'Formula has no `url` or `head`'))
+    elif 'url' in formula:
+        url, line = formula['url']
+        if 'sha256' in formula:
+            sha256, line = formula['sha256']
+            if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+                problems.append(('error', line, f'sha256 {sha256} is not 64 lowercase hexadecimal characters'))
+        elif not _is_git_url(url, formula['url_options']):
+            problems.append(('error', line, f'Formula url {url} has no `sha256`'))
+
+    for resource in formula['resources']:
+        if 'url' not in resource:
+            problems.append(('error', resource['line'], f'Resource {resource["name"]} has no `url`'))
+        elif 'sha256' not in resource and not _is_git_url(resource['url'], resource['url_options']):
+            problems.append(('error', resource['line'], f'Resource {resource["name"]} has no `sha256`'))
+
+    seen = set()
+    for name, line in formula['depends_on']:
+        if name in seen:
+            problems.append(('warning', line, f'Dependency {name} is declared more than once'))
+        seen.add(name)
+
+    if formula['test'] is None:
+        problems.append(('error', formula['class_line'], 'Formula has no `test do` block'))
+    elif formula['test']['statements'] == 0:
+        problems.append(('error', formula['test']['line'], 'Formula has an empty `test do` block'))
+
+    if formula['unbalanced'] is not None:
+        # the blocks could not be followed, so the problems may be caused by the parser, and are left to brew
+        problems = problems[:class_problems] + [
+            ('warning', line, message) for _, line, message in problems[class_problems:]
+        ]
+        problems.append((
+            'warning',
+            formula['unbalanced'],
+            'Could not match the `do`/`end` blocks of the formula, the static checks may be incomplete',
+        ))
+
+    return problems
+
+
+def static_check_formula(formula_file: str) -> bool:
+    """
+    Run ``check_formula`` and print each problem as a GitHub annotation.
+
+    Parameters
+    ----------
+    formula_file : str
+        The formula file.
+
+    Returns
+    -------
+    bool
+        Whether the formula has no errors.
+    """
+    problems = check_formula(formula_file)
+    for level, line, message in problems:
+        print(f'::{level} file={formula_file},line={line}::{message}')
+
+    return not any(level == 'error' for level, _, _ in problems)
+
+
+@_traced
+def process_input_formula(formula_file: str, contribute: Optional[bool] = None) -> str:
+    # check if the formula file exists
+    if not os.path.exists(formula_file):
+        raise FileNotFoundError(f'::error:: Formula file {formula_file} does not exist')
+
+    # check if the formula file is a file
+    if not os.path.isfile(formula_file):
+        raise FileNotFoundError(f'::error:: Formula file {formula_file} is not a file')
+
+    # check if the formula file is a .rb file
+    if not formula_file.endswith('.rb'):
+        raise ValueError(f'::error:: Formula file {formula_file} is not a .rb file')
+
+    # check for obvious problems before running brew
+    if os.getenv('INPUT_STATIC_CHECK', 'true').lower() == 'true' and not static_check_formula(formula_file):
+        raise ValueError(f'::error:: Formula file {formula_file} failed static checks')
+
+    # get filename
+    formula_filename = os.path.basename(formula_file)
+    print(f'formula_filename: {formula_filename}')
+
+    formula = formula_filename.split('.')[0]
+    FORMULA_FILES[formula] = formula_file
+
+    # get the first letter of formula name
+    first_letter = formula_filename[0].lower()
+    print(f'first_letter: {first_letter}')
+
+    # enable developer mode
+    if get_brew_environment()['developer']:
+        print('Brew developer mode is already enabled')
+    else:
+        print('Enabling brew developer mode')
+        _run_subprocess(
+            args_list=[
+                'brew',
+                'developer',
+                'on'
+            ],
+        )
+        invalidate_brew_environment()
+
+    # run brew tap, the tap already exists if more than one formula is processed
+    if os.path.isdir(os.path.join(get_brew_repository(), 'Library', 'Taps', temp_repo)):
+        print(f'Tap {temp_repo} already exists')
+    else:
+        print(f'Running `brew tap-new {temp_repo} --no-git`')
+        _run_subprocess(
+            args_list=[
+                'brew',
+                'tap-new',
+                temp_repo,
+                '--no-git'
+            ],
+        )
+
     org_homebrew_repo = os.path.join(
         os.environ['GITHUB_WORKSPACE'], 'homebrew-release-action', 'org_homebrew_repo')
-    homebrew_core_fork_repo = os.path.join(
-        os.environ['GITHUB_WORKSPACE'], 'homebrew-release-action', 'homebrew_core_fork_repo')
+    homebrew_core_fork_repo = get_homebrew_core_fork_repo()
     print(f'org_homebrew_repo: {org_homebrew_repo}')
     print(f'homebrew_core_fork_repo: {homebrew_core_fork_repo}')
 
-    if os.getenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE').lower() == 'true':
-        prepare_homebrew_core_fork(branch_suffix=formula, path=homebrew_core_fork_repo)
+    # with contribute=False, the fork is prepared and the formula copied into it later by `contribute_formula`
+    copy_to_fork = contribute is not False
+    if contribute is None:
+        contribute = os.getenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE').lower() == 'true'
+    if contribute:
+        _prepare_homebrew_core_fork_for_formula(formula_file=formula_file)
 
     # copy the formula file to the two directories
     tap_dirs = [
         os.path.join(org_homebrew_repo, 'Formula', first_letter),  # we will commit back to this
-        os.path.join(homebrew_core_fork_repo, 'Formula', first_letter),  # we will commit back to this
     ]
+    if copy_to_fork:
+        tap_dirs.append(os.path.join(homebrew_core_fork_repo, 'Formula', first_letter))  # we will commit back to this
     if is_brew_installed():
         tap_dirs.append(os.path.join(get_brew_repository(), 'Library', 'Taps', temp_repo, 'Formula', first_letter))
     for d in tap_dirs:
-        print(f'Copying {formula_filename} to {d}')
-        os.makedirs(d, exist_ok=True)
-        shutil.copy2(formula_file, d)
-
-        if not os.path.exists(os.path.join(d, formula_filename)):
-            raise FileNotFoundError(f'::error:: Formula file {formula_filename} was not copied to {d}')
-        print(f'Copied {formula_filename} to {d}')
+        _copy_formula_file(formula_file=formula_file, directory=d)
 
     return formula
 
 
+def get_homebrew_core_fork_repo() -> str:
+    return os.path.join(os.environ['GITHUB_WORKSPACE'], 'homebrew-release-action', 'homebrew_core_fork_repo')
+
+
+def _copy_formula_file(formula_file: str, directory: str) -> None:
+    formula_filename = os.path.basename(formula_file)
+    print(f'Copying {formula_filename} to {directory}')
+    os.makedirs(directory, exist_ok=True)
+    shutil.copy2(formula_file, directory)
+
+    if not os.path.exists(os.path.join(directory, formula_filename)):
+        raise FileNotFoundError(f'::error:: Formula file {formula_filename} was not copied to {directory}')
+    print(f'Copied {formula_filename} to {directory}')
+
+
+def _prepare_homebrew_core_fork_for_formula(formula_file: str) -> None:
+    formula_filename = os.path.basename(formula_file)
+    first_letter = formula_filename[0].lower()
+    sparse = os.getenv('INPUT_HOMEBREW_CORE_SPARSE', 'false').lower() == 'true'
+    prepare_homebrew_core_fork(
+        branch_suffix=formula_filename.split('.')[0],
+        path=get_homebrew_core_fork_repo(),
+        sparse_paths=[f'Formula/{first_letter}/{formula_filename}'] if sparse else None,
+    )
+
+
+def contribute_formula(formula_file: str) -> None:
+    """
+    Prepare the homebrew-core fork for the formula, and copy the formula file into it.
+
+    This is the homebrew-core part of ``process_input_formula``, so it can run separately from the rest of it.
+
+    Parameters
+    ----------
+    formula_file : str
+        The formula file.
+    """
+    _prepare_homebrew_core_fork_for_formula(formula_file=formula_file)
+    _copy_formula_file(
+        formula_file=formula_file,
+        directory=os.path.join(get_homebrew_core_fork_repo(), 'Formula', os.path.basename(formula_file)[0].lower()),
+    )
+
+
+@_traced
 def is_brew_installed() -> bool:
     print('Checking if Homebrew is installed')
-    return _run_subprocess(
-        args_list=[
-            'brew',
-            '--version'
-        ]
-    )
+    version = get_brew_version()
+    if not version:
+        print('::error:: Homebrew is not installed')
+        return False
+
+    print(version)
+    return True
 
 
+@_traced
 def audit_formula(formula: str) -> bool:
     print(f'Auditing formula {formula}')
     return _run_subprocess(
@@ -281,39 +2031,269 @@ def audit_formula(formula: str) -> bool:
     )
 
 
-def brew_upgrade() -> bool:
-    print('Updating Homebrew')
+def parse_audit_output(output: list, formulae: list) -> dict:
+    """
+    Attribute the problems reported by a ``brew audit`` of many formulae to each formula.
+
+    ``brew audit`` prints the full name of each formula with problems, followed by one indented ``*`` line per problem.
+
+    Parameters
+    ----------
+    output : list
+        The lines printed by ``brew audit``.
+    formulae : list
+        Names of the audited formulae in the temporary tap.
+
+    Returns
+    -------
+    dict
+        The problems of each formula, formulae without problems have an empty list.
+    """
+    names = {}
+    for formula in formulae:
+        names[formula] = formula
+        names[f'{temp_repo}/{formula}'.replace(os.sep, '/')] = formula
+
+    problems = {formula: [] for formula in formulae}
+    current = None
+    for line in output:
+        stripped = line.strip()
+        if stripped in names:
+            current = names[stripped]
+        elif current and stripped.startswith('* '):
+            problems[current].append(stripped[2:])
+        elif not line.startswith(' '):
+            current = None
+
+    return problems
+
+
+@_traced
+def audit_formulae(formulae: list) -> dict:
+    """
+    Audit many formulae with a single ``brew audit`` invocation.
+
+    If the audit fails, but the failure cannot be attributed to any formula from the output, each formula is audited
+    on its own instead.
+
+    Parameters
+    ----------
+    formulae : list
+        Names of the formulae in the temporary tap.
+
+    Returns
+    -------
+    dict
+        Whether each formula passed the audit.
+    """
+    global ERROR
+
+    print(f'Auditing formulae {", ".join(formulae)}')
+    output = []
     result = _run_subprocess(
         args_list=[
             'brew',
-            'update'
-        ]
+            'audit',
+            '--os=all',
+            '--arch=all',
+            '--strict',
+            '--online',
+        ] + [os.path.join(temp_repo, formula) for formula in formulae],
+        line_callback=output.append,
+        set_error=False,
     )
-    if not result:
-        return False
+    if result:
+        return {formula: True for formula in formulae}
+
+    problems = parse_audit_output(output=output, formulae=formulae)
+    if not any(problems.values()):
+        print('::warning:: Could not attribute the audit failure to a formula, auditing each formula')
+        return {formula: audit_formula(formula) for formula in formulae}
+
+    for formula, formula_problems in problems.items():
+        for problem in formula_problems:
+            print(f'{formula}: {problem}')  # annotated by the problem matcher
+
+    ERROR = True
+    return {formula: not formula_problems for formula, formula_problems in problems.items()}
+
+
+@_traced
+def fetch_formulae(formulae: list) -> dict:
+    """
+    Download the sources and dependencies of many formulae with a single ``brew fetch`` invocation.
+
+    If the fetch fails, each formula is fetched on its own to find the formulae that failed.
+
+    Parameters
+    ----------
+    formulae : list
+        Names of the formulae in the temporary tap.
+
+    Returns
+    -------
+    dict
+        Whether each formula was fetched.
+    """
+    print(f'Fetching formulae {", ".join(formulae)}')
+
+    def fetch(names: list, set_error: bool = True) -> bool:
+        return _run_subprocess(
+            args_list=[
+                'brew',
+                'fetch',
+                '--deps',
+                '--formula',
+            ] + [os.path.join(temp_repo, formula) for formula in names],
+            set_error=set_error,
+        )
+
+    # a failed fetch of many formulae is retried for each formula
+    if fetch(formulae, set_error=len(formulae) == 1):
+        return {formula: True for formula in formulae}
+    if len(formulae) == 1:
+        return {formulae[0]: False}
+
+    print('::warning:: Fetching formulae failed, fetching each formula')
+    return {formula: fetch([formula]) for formula in formulae}
+
+
+def get_formula_dependencies(formulae: list) -> Optional[list]:
+    """
+    Get the recursive build, runtime, and test dependencies of formulae in the temporary tap.
+
+    Parameters
+    ----------
+    formulae : list
+        Names of the formulae in the temporary tap.
+
+    Returns
+    -------
+    Optional[list]
+        The full names of the dependencies, or None if they could not be resolved.
+    """
+    output = _capture_subprocess(
+        args_list=[
+            'brew',
+            'deps',
+            '--formula',
+            '--include-build',
+            '--include-test',
+            '--full-name',
+            '--union',
+        ] + [os.path.join(temp_repo, formula) for formula in formulae],
+    )
+    if output is None:
+        return None
+    return output.split()
+
+
+def get_outdated_formulae() -> Optional[list]:
+    output = _capture_subprocess(
+        args_list=[
+            'brew',
+            'outdated',
+            '--formula',
+            '--quiet',
+        ],
+    )
+    if output is None:
+        return None
+    return output.split()
+
+
+@_traced
+def brew_upgrade(formulae: Optional[list] = None) -> bool:
+    """
+    Update Homebrew, and upgrade installed formulae.
 
-    print('Upgrading Homebrew')
+    With the default ``scoped`` upgrade mode, only the outdated formulae in the dependency closure of ``formulae`` are
+    upgraded. Set ``INPUT_UPGRADE_MODE`` to ``full`` to upgrade every installed formula.
+
+    Parameters
+    ----------
+    formulae : Optional[list]
+        Names of the formulae being validated.
+
+    Returns
+    -------
+    bool
+        True if the update and upgrade succeeded, otherwise False.
+    """
+    max_age = float(os.getenv('INPUT_BREW_UPDATE_MAX_AGE') or 0)
+    if max_age > 0 and is_brew_update_fresh(max_age=max_age):
+        print(f'Skipping `brew update`, Homebrew was updated less than {max_age:g} seconds ago')
+        update_status = 'cached'
+    else:
+        print('Updating Homebrew')
+        result = _run_subprocess(
+            args_list=[
+                'brew',
+                'update'
+            ]
+        )
+        if not result:
+            return False
+
+        invalidate_brew_environment()
+        if max_age > 0:
+            write_brew_update_stamp()
+        update_status = 'updated'
+
+    set_github_action_output(
+        output_name='brew_update',
+        output_value=update_status,
+    )
+
+    upgrade_mode = (os.getenv('INPUT_UPGRADE_MODE') or 'scoped').lower()
+    if upgrade_mode == 'full':
+        print('Upgrading Homebrew')
+        return _run_subprocess(
+            args_list=[
+                'brew',
+                'upgrade'
+            ]
+        )
+    elif upgrade_mode != 'scoped':
+        raise ValueError(f'::error:: Unknown upgrade mode {upgrade_mode}, expected `scoped` or `full`')
+
+    print(f'Resolving dependencies of {formulae}')
+    dependencies = get_formula_dependencies(formulae=formulae) if formulae else []
+    outdated = get_outdated_formulae() if dependencies else []
+    if dependencies is None or outdated is None:
+        print('::warning:: Could not resolve outdated dependencies, skipping upgrade')
+        return True
+
+    # compare both full and short names, `brew outdated` does not always print the full name of tap formulae
+    dependency_names = set(dependencies) | {d.rsplit('/', 1)[-1] for d in dependencies}
+    to_upgrade = [f for f in outdated if f in dependency_names]
+    if not to_upgrade:
+        print('No outdated dependencies to upgrade')
+        return True
+
+    print(f'Upgrading outdated dependencies: {", ".join(to_upgrade)}')
     return _run_subprocess(
         args_list=[
             'brew',
-            'upgrade'
-        ]
+            'upgrade',
+            '--formula',
+        ] + to_upgrade
     )
 
 
-def brew_debug() -> bool:
-    # run brew config
-    print('Running `brew config`')
-    result = _run_subprocess(
+def brew_config() -> bool:
+    _print_status('Running `brew config`')
+    return _run_subprocess(
         args_list=[
             'brew',
             'config',
         ],
     )
 
-    # run brew doctor
-    print('Running `brew doctor`')
-    _run_subprocess(
+
+def brew_doctor() -> bool:
+    _print_status('Running `brew doctor`')
+    return _run_subprocess(
         args_list=[
             'brew',
             'doctor',
@@ -321,42 +2301,327 @@ def brew_debug() -> bool:
         ignore_error=True,
     )
 
-    return result
+
+class BrewDiagnostics:
+    """
+    Run ``brew config`` and ``brew doctor`` in the background, buffering their output.
+
+    The output is only useful to debug a failure, so it is printed by `report` if the run failed, instead of holding up
+    the audit, install, and test while ``brew doctor`` runs.
+    """
+    COMMANDS = (['brew', 'config'], ['brew', 'doctor'])
+
+    def __init__(self):
+        self.results = {}  # command -> (exit code, output)
+        self._threads = [
+            threading.Thread(target=self._run, args=(args_list,), name=' '.join(args_list), daemon=True)
+            for args_list in self.COMMANDS
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self, args_list: list) -> None:
+        command = ' '.join(args_list)
+        with trace_span(name=command, category='subprocess', command=command) as span:
+            try:
+                process = subprocess.Popen(args=args_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError as e:
+                span['exit_code'] = None
+                self.results[command] = (None, f'{e}\n')
+                return
+            output = process.stdout.read().decode('utf-8', errors='replace')
+            process.stdout.close()
+            exit_code, usage = _wait_process(process)
+            span['exit_code'] = exit_code
+
+        if usage:
+            record_resource_usage(phase='brew_debug', usage=usage)
+        self.results[command] = (exit_code, output)
+
+    def wait(self) -> dict:
+        """
+        Wait for the diagnostics to finish.
+
+        Returns
+        -------
+        dict
+            The exit code and output of each command.
+        """
+        for thread in self._threads:
+            thread.join()
+        return self.results
+
+    def report(self, failed: bool) -> None:
+        """
+        Wait for the diagnostics to finish, and print their output if the run failed.
+
+        A failing ``brew config`` is always printed, as it means Homebrew itself is broken.
+
+        Parameters
+        ----------
+        failed : bool
+            Whether the run failed.
+        """
+        results = self.wait()
+        for command in (' '.join(args_list) for args_list in self.COMMANDS):
+            exit_code, output = results[command]
+            if command == 'brew config' and exit_code != 0:
+                print(f'::warning:: `{command}` failed with exit code {exit_code}')
+            elif not failed:
+                continue
+            print(f'::group::{command}')
+            print(output, end='')
+            print('::endgroup::')
+
+
+def report_brew_diagnostics(failed: bool) -> None:
+    """
+    Wait for the deferred ``brew config`` and ``brew doctor``, and print their output if the run failed.
+    """
+    global BREW_DIAGNOSTICS
+    if BREW_DIAGNOSTICS:
+        BREW_DIAGNOSTICS.report(failed=failed)
+        BREW_DIAGNOSTICS = None
+
+
+@_traced
+def brew_debug() -> bool:
+    global BREW_DIAGNOSTICS
+    if os.getenv('INPUT_DEFER_DIAGNOSTICS', 'false').lower() == 'true':
+        if not BREW_DIAGNOSTICS:
+            print('Running `brew config` and `brew doctor` in the background')
+            BREW_DIAGNOSTICS = BrewDiagnostics()
+        return True
+
+    # run brew config and brew doctor, they don't depend on each other
+    results = run_steps(
+        steps=[
+            Step(name='brew config', func=brew_config),
+            Step(name='brew doctor', func=brew_doctor),
+        ],
+        max_concurrency=get_max_concurrency(),
+    )
+
+    return results['brew config']
+
+
+def get_root_tmp_dir() -> str:
+    root_tmp_dirs = [
+        os.getenv('HOMEBREW_TEMP', ""),  # if manually set
+        '/private/tmp',  # macOS default
+        '/var/tmp',  # Linux default
+    ]
+
+    # first tmp dir that exists
+    root_tmp_dir = next((d for d in root_tmp_dirs if os.path.isdir(d)), None)
+
+    if not root_tmp_dir:
+        raise FileNotFoundError('::error:: Could not find root temp directory')
+
+    return root_tmp_dir
+
+
+def _scan_tmp_dir(root_tmp_dir: str, formula: str):
+    """
+    Yield the directory entries in the root temp directory that may be temp directories of the formula.
+
+    Homebrew names its temp directories ``<formula>-<date>-<pid>-<random>``, and test directories
+    ``<formula>-test-<date>-<pid>-<random>``. Resource directories (``<formula>--<resource>-...``) and directories of
+    other formulae sharing the prefix (e.g. ``<formula>-extra-...``) are skipped. Only the names are compared, so
+    entries of other formulae are never stat'ed.
+    """
+    pattern = re.compile(rf'{re.escape(formula)}-(?:test-)?\d')
+    with os.scandir(root_tmp_dir) as entries:
+        for entry in entries:
+            if pattern.match(entry.name) and entry.is_dir(follow_symlinks=False):
+                yield entry
+
+
+def snapshot_tmp_dir(formula: str) -> dict:
+    """
+    Snapshot the existing temp directories of a formula, before running a Homebrew command that creates a new one.
+
+    Parameters
+    ----------
+    formula : str
+        Name of the formula.
+
+    Returns
+    -------
+    dict
+        Mapping of directory name to ``(inode, mtime)``, to be passed to ``find_tmp_dir``.
+    """
+    snapshot = {}
+    try:
+        root_tmp_dir = get_root_tmp_dir()
+    except FileNotFoundError:
+        return snapshot
+
+    for entry in _scan_tmp_dir(root_tmp_dir=root_tmp_dir, formula=formula):
+        snapshot[entry.name] = (entry.inode(), entry.stat(follow_symlinks=False).st_mtime_ns)
+    return snapshot
+
+
+def find_tmp_dir(formula: str, snapshot: Optional[dict] = None) -> str:
+    """
+    Find the temp directory created by the last Homebrew command run for a formula.
+
+    The root temp directory is compared against a snapshot taken with ``snapshot_tmp_dir`` before the command ran.
+    Directories that are in the snapshot with the same inode, or that were already found, are skipped. If more than
+    one new directory exists, the oldest is used.
+
+    Parameters
+    ----------
+    formula : str
+        Name of the formula.
+    snapshot : Optional[dict]
+        Snapshot from ``snapshot_tmp_dir``. If not provided, every temp directory of the formula is considered new.
+
+    Returns
+    -------
+    str
+        The path to the temp directory.
+    """
+    print('Trying to find temp directory')
+    root_tmp_dir = get_root_tmp_dir()
+    print(f'Using temp directory {root_tmp_dir}')
+
+    snapshot = snapshot or {}
+    with _TEMP_DIRECTORIES_LOCK:
+        new_dirs = []
+        for entry in _scan_tmp_dir(root_tmp_dir=root_tmp_dir, formula=formula):
+            previous = snapshot.get(entry.name)
+            if (previous and previous[0] == entry.inode()) or entry.path in TEMP_DIRECTORIES:
+                continue
+            new_dirs.append((entry.stat(follow_symlinks=False).st_mtime_ns, entry.name, entry.path))
+
+        tmp_dir = min(new_dirs)[2] if new_dirs else ""
+        if tmp_dir:
+            print(f'Found temp directory {tmp_dir}')
+            TEMP_DIRECTORIES.append(tmp_dir)
+
+    if not tmp_dir:
+        raise FileNotFoundError(f'::error:: Could not find temp directory for {formula} in {root_tmp_dir}')
+
+    track_temp_directory(tmp_dir)
+    return tmp_dir
+
+
+def get_temp_gc_limits() -> tuple:
+    """
+    Get the maximum age in seconds, and the size budget in bytes, of the temp directories kept by this action.
+
+    The limits are read from ``INPUT_TEMP_GC_MAX_AGE`` and ``INPUT_TEMP_GC_MAX_SIZE`` (in MiB). A limit of ``0`` is
+    disabled, and temp directories are only tracked if a limit is set.
+    """
+    return (
+        float(os.getenv('INPUT_TEMP_GC_MAX_AGE') or 0),
+        float(os.getenv('INPUT_TEMP_GC_MAX_SIZE') or 0) * 2 ** 20,
+    )
+
+
+@contextlib.contextmanager
+def _temp_manifest():
+    """
+    Load the manifest of temp directories created by this action, and save it when the block exits.
+
+    The manifest is locked against other threads, and with ``flock`` against other runs on the same runner.
+    """
+    manifest_file = os.path.join(get_cache_dir(), 'temp-directories.json')
+    with _TEMP_MANIFEST_LOCK, _file_lock(f'{manifest_file}.lock'):
+        try:
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+        yield manifest
+
+        with open(f'{manifest_file}.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f'{manifest_file}.tmp', manifest_file)
 
 
-def find_tmp_dir(formula: str) -> str:
-    print('Trying to find temp directory')
-    root_tmp_dirs = [
-        os.getenv('HOMEBREW_TEMP', ""),  # if manually set
-        '/private/tmp',  # macOS default
-        '/var/tmp',  # Linux default
-    ]
+def track_temp_directory(path: str) -> None:
+    """
+    Record a temp directory created by this action in the manifest, so a later run can garbage collect it.
 
-    # first tmp dir that exists
-    root_tmp_dir = next((d for d in root_tmp_dirs if os.path.isdir(d)), None)
+    Recording a directory again marks it as recently used. Nothing is recorded if garbage collection is disabled.
+    """
+    if not any(get_temp_gc_limits()):
+        return
 
-    if not root_tmp_dir:
-        raise FileNotFoundError('::error:: Could not find root temp directory')
+    st = os.lstat(path)
+    with _temp_manifest() as manifest:
+        manifest[path] = dict(inode=st.st_ino, device=st.st_dev, last_used=time.time())
 
-    print(f'Using temp directory {root_tmp_dir}')
 
-    # find formula temp directories not already in the list
-    for d in os.listdir(root_tmp_dir):
-        print(f'Checking temp directory {d}')
-        tmp_dir = os.path.join(root_tmp_dir, d)
-        if d.startswith(f'{formula}-') and tmp_dir not in TEMP_DIRECTORIES:
-            print(f'Found temp directory {tmp_dir}')
-            TEMP_DIRECTORIES.append(tmp_dir)
-            break
-    else:
-        tmp_dir = ""
+def _directory_size(path: str) -> int:
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return size
 
-    if not tmp_dir:
-        raise FileNotFoundError(f'::error:: Could not find temp directory {tmp_dir}')
 
-    return tmp_dir
+@_traced
+def collect_temp_directories() -> list:
+    """
+    Remove temp directories left by previous runs of this action with ``--keep-tmp``.
 
+    Only directories in the manifest are considered, and only if they still have the inode they had when they were
+    recorded, so directories this action did not create are never removed. Directories not used for longer than the
+    maximum age are removed, then the least recently used directories are removed until the total size of the tracked
+    directories fits the size budget. Directories of the current run are kept.
 
+    Returns
+    -------
+    list
+        The removed directories.
+    """
+    max_age, max_size = get_temp_gc_limits()
+    if not max_age and not max_size:
+        return []
+
+    now = time.time()
+    victims = []
+    with _temp_manifest() as manifest:
+        entries = []
+        sizes = {}
+        for path, record in list(manifest.items()):
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                del manifest[path]
+                continue
+            if not stat.S_ISDIR(st.st_mode) or (st.st_ino, st.st_dev) != (record['inode'], record['device']):
+                # replaced by something this action did not create
+                del manifest[path]
+                continue
+
+            sizes[path] = _directory_size(path)
+            if path not in TEMP_DIRECTORIES:
+                entries.append((record['last_used'], path))
+
+        total = sum(sizes.values())
+        for last_used, path in sorted(entries):
+            if (max_age and now - last_used > max_age) or (max_size and total > max_size):
+                victims.append(path)
+                total -= sizes[path]
+                del manifest[path]
+
+    for path in victims:
+        print(f'Removing temp directory {path}')
+        shutil.rmtree(path, ignore_errors=True)
+
+    print(f'Removed {len(victims)} temp directories, {len(sizes) - len(victims)} tracked directories remain')
+    return victims
+
+
+@_traced
 def install_formula(formula: str) -> bool:
     print(f'Installing formula {formula}')
     env = dict(
@@ -366,6 +2631,7 @@ def install_formula(formula: str) -> bool:
     # combine with os environment
     env.update(os.environ)
 
+    snapshot = snapshot_tmp_dir(formula)
     result = _run_subprocess(
         args_list=[
             'brew',
@@ -379,7 +2645,8 @@ def install_formula(formula: str) -> bool:
     )
 
     global HOMEBREW_BUILDPATH
-    HOMEBREW_BUILDPATH = find_tmp_dir(formula)
+    HOMEBREW_BUILDPATH = find_tmp_dir(formula, snapshot=snapshot)
+    BUILDPATHS[formula] = HOMEBREW_BUILDPATH
 
     set_github_action_output(
         output_name='buildpath',
@@ -389,15 +2656,17 @@ def install_formula(formula: str) -> bool:
     return result
 
 
+@_traced
 def test_formula(formula: str) -> bool:
     print(f'Testing formula {formula}')
     env = dict(
-        HOMEBREW_BUILDPATH=HOMEBREW_BUILDPATH,
+        HOMEBREW_BUILDPATH=BUILDPATHS.get(formula, HOMEBREW_BUILDPATH),
     )
 
     # combine with os environment
     env.update(os.environ)
 
+    snapshot = snapshot_tmp_dir(formula)
     result = _run_subprocess(
         args_list=[
             'brew',
@@ -409,26 +2678,814 @@ def test_formula(formula: str) -> bool:
         env=env,
     )
 
+    TESTPATHS[formula] = find_tmp_dir(formula, snapshot=snapshot)
+
     set_github_action_output(
         output_name='testpath',
-        output_value=find_tmp_dir(formula)
+        output_value=TESTPATHS[formula]
     )
 
     return result
 
 
-def main():
-    if not is_brew_installed():
-        raise SystemExit(1, 'Homebrew is not installed')
+def _matches_any(path: str, patterns: list) -> bool:
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern)
+               for pattern in patterns)
+
+
+def create_archive(archive_file: str, directories: dict, include: list = (), exclude: list = ()) -> int:
+    """
+    Stream directories into a gzip compressed tarball.
+
+    Files are read and compressed in small blocks as they are added, so memory use does not depend on the size of the
+    directories, and nothing is copied to an intermediate location.
+
+    Parameters
+    ----------
+    archive_file : str
+        The tarball to create.
+    directories : dict
+        The name of each directory in the archive, mapped to its path.
+    include : list
+        Glob patterns, matched against the path relative to the directory and the file name. If not empty, only
+        matching files are archived.
+    exclude : list
+        Glob patterns of files to leave out, matched like ``include``.
+
+    Returns
+    -------
+    int
+        The number of files archived.
+    """
+    count = 0
+    os.makedirs(os.path.dirname(os.path.abspath(archive_file)), exist_ok=True)
+    with tarfile.open(archive_file, 'w:gz', compresslevel=6) as tar:
+        for name, directory in directories.items():
+            for root, dirs, files in os.walk(directory):
+                dirs.sort()
+                for file in sorted(files):
+                    path = os.path.join(root, file)
+                    relative_path = os.path.relpath(path, directory).replace(os.sep, '/')
+                    if include and not _matches_any(relative_path, include):
+                        continue
+                    if _matches_any(relative_path, exclude):
+                        continue
+                    tar.add(path, arcname=f'{name}/{relative_path}', recursive=False)
+                    count += 1
+
+    return count
+
+
+@_traced
+def archive_temp_directories(formulae: list) -> Optional[str]:
+    """
+    Archive the buildpath and testpath of formulae to ``INPUT_ARCHIVE_FILE``, and set the ``archive`` output.
+
+    Files are filtered by the glob patterns in ``INPUT_ARCHIVE_INCLUDE`` and ``INPUT_ARCHIVE_EXCLUDE``, one per line.
+
+    Parameters
+    ----------
+    formulae : list
+        Names of the formulae. If there is more than one, the directories are archived under the formula name.
+
+    Returns
+    -------
+    Optional[str]
+        The archive, or None if archiving is disabled.
+    """
+    archive_file = os.getenv('INPUT_ARCHIVE_FILE', '')
+    if not archive_file:
+        return None
+
+    directories = {}
+    for formula in formulae:
+        prefix = f'{formula}/' if len(formulae) > 1 else ''
+        for name, paths in (('buildpath', BUILDPATHS), ('testpath', TESTPATHS)):
+            if paths.get(formula) and os.path.isdir(paths[formula]):
+                directories[f'{prefix}{name}'] = paths[formula]
+
+    count = create_archive(
+        archive_file=archive_file,
+        directories=directories,
+        include=[line.strip() for line in os.getenv('INPUT_ARCHIVE_INCLUDE', '').splitlines() if line.strip()],
+        exclude=[line.strip() for line in os.getenv('INPUT_ARCHIVE_EXCLUDE', '').splitlines() if line.strip()],
+    )
+    print(f'Archived {count} files from {len(directories)} directories to {archive_file}')
+
+    set_github_action_output(
+        output_name='archive',
+        output_value=archive_file,
+    )
+
+    return archive_file
+
+
+def get_formula_downloads(formula_file: str) -> list:
+    """
+    Get the source and resources of a formula that can be downloaded and verified ahead of ``brew install``.
+
+    Git urls, urls without a ``sha256``, and urls declared for some platforms only (``on_*`` blocks) are left to brew.
+
+    Parameters
+    ----------
+    formula_file : str
+        The formula file.
+
+    Returns
+    -------
+    list
+        Dicts with the ``name``, ``url``, and ``sha256`` of each download.
+    """
+    with open(formula_file, 'r', encoding='utf-8') as f:
+        formula = parse_formula(f.read())
+
+    downloads = []
+    if 'url' in formula and 'sha256' in formula and not formula['url_conditional'] \
+            and not _is_git_url(formula['url'][0], formula['url_options']):
+        downloads.append(dict(name='source', url=formula['url'][0], sha256=formula['sha256'][0]))
+
+    for resource in formula['resources']:
+        if 'url' in resource and 'sha256' in resource and not _is_git_url(resource['url'], resource['url_options']):
+            downloads.append(dict(name=resource['name'], url=resource['url'], sha256=resource['sha256']))
+
+    return downloads
+
+
+def get_download_cache_path(cache_dir: str, url: str) -> str:
+    """
+    Get the path brew uses for a cached download, ``<HOMEBREW_CACHE>/downloads/<sha256 of url>--<basename>``.
+    """
+    basename = urllib.parse.unquote(os.path.basename(urllib.parse.urlparse(url).path))
+    return os.path.join(cache_dir, 'downloads', f'{hashlib.sha256(url.encode()).hexdigest()}--{basename}')
+
+
+def _file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def download_file(url: str, sha256: str, path: str, abort: Optional[threading.Event] = None) -> bool:
+    """
+    Download a file, hashing it while it is streamed to disk, and move it into place only if the hash matches.
+
+    The file is written to ``<path>.incomplete`` first, like brew does, so an interrupted download is never used.
+
+    Parameters
+    ----------
+    url : str
+        The url to download.
+    sha256 : str
+        The expected SHA-256 of the file.
+    path : str
+        Where to store the file.
+    abort : Optional[threading.Event]
+        Stop the download early when set, e.g. because another download failed.
+
+    Returns
+    -------
+    bool
+        True if the file was downloaded, False if a file with the expected hash already existed.
+
+    Raises
+    ------
+    ValueError
+        If the hash of the downloaded file does not match.
+    InterruptedError
+        If the download was aborted.
+    """
+    if os.path.isfile(path) and _file_sha256(path) == sha256:
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    incomplete = f'{path}.incomplete'
+    digest = hashlib.sha256()
+    try:
+        request = urllib.request.Request(url, headers={'User-Agent': 'homebrew-release-action'})
+        with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response, open(incomplete, 'wb') as f:
+            for chunk in iter(functools.partial(response.read, DOWNLOAD_CHUNK_SIZE), b''):
+                if abort is not None and abort.is_set():
+                    raise InterruptedError(f'Download of {url} was aborted')
+                digest.update(chunk)
+                f.write(chunk)
+
+        if digest.hexdigest() != sha256:
+            raise ValueError(f'SHA-256 mismatch for {url}, expected {sha256}, got {digest.hexdigest()}')
+
+        os.replace(incomplete, path)
+    finally:
+        if os.path.isfile(incomplete):
+            os.remove(incomplete)
+
+    return True
+
+
+@_traced
+def prefetch_formula(formula_file: str, cache_dir: Optional[str] = None, max_workers: int = 4) -> bool:
+    """
+    Download the source and resources of a formula concurrently into the Homebrew cache, so ``brew install`` does not
+    download them on the critical path.
+
+    A checksum mismatch aborts the remaining downloads and fails the prefetch. Other download errors, e.g. a server
+    that rejects the request, are only reported as warnings and the download is left to brew.
+
+    Parameters
+    ----------
+    formula_file : str
+        The formula file.
+    cache_dir : Optional[str]
+        The Homebrew cache. Defaults to ``brew --cache``.
+    max_workers : int
+        Maximum number of concurrent downloads.
+
+    Returns
+    -------
+    bool
+        False if a download did not match its checksum.
+    """
+    downloads = get_formula_downloads(formula_file)
+    if not downloads:
+        print('Nothing to prefetch')
+        return True
+
+    cache_dir = cache_dir or get_brew_environment()['cache']
+    abort = threading.Event()
+
+    def prefetch(download: dict) -> bool:
+        path = get_download_cache_path(cache_dir=cache_dir, url=download['url'])
+        try:
+            with trace_span(name=f'download ({download["name"]})', category='subprocess', url=download['url']):
+                downloaded = download_file(url=download['url'], sha256=download['sha256'], path=path, abort=abort)
+        except ValueError as e:
+            abort.set()
+            print(f'::error:: Prefetch of {download["name"]} failed: {e}')
+            return False
+        except InterruptedError:
+            return True
+        except OSError as e:
+            print(f'::warning:: Prefetch of {download["name"]} failed, leaving it to brew: {e}')
+            return True
+
+        print(f'{"Prefetched" if downloaded else "Already cached"} {download["name"]}: {path}')
+        return True
+
+    print(f'Prefetching {len(downloads)} downloads')
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(downloads)))) as pool:
+        return all(list(pool.map(_with_output_prefix('', prefetch), downloads)))
+
+
+def expand_formula_files(patterns: list) -> list:
+    """
+    Expand formula files, directories, and glob patterns into a list of formula files.
+
+    Directories are searched recursively for ``.rb`` files. Duplicates are removed, keeping the first occurrence.
+
+    Parameters
+    ----------
+    patterns : list
+        Formula files, directories, or glob patterns.
+
+    Returns
+    -------
+    list
+        The formula files.
+    """
+    formula_files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '**', '*.rb'), recursive=True))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+        else:
+            matches = [pattern]
+
+        if not matches:
+            raise FileNotFoundError(f'::error:: No formula files found for {pattern}')
+
+        for match in matches:
+            if match not in formula_files:
+                formula_files.append(match)
+
+    return formula_files
+
+
+def get_timing_db() -> str:
+    """
+    Get the path of the timing database, which records the install and test durations of formulae in previous runs.
+
+    Returns
+    -------
+    str
+        The ``INPUT_TIMING_DB`` environment variable if set, otherwise ``timings.json`` in the cache directory.
+    """
+    return os.getenv('INPUT_TIMING_DB') or os.path.join(get_cache_dir(), 'timings.json')
+
+
+def load_formula_timings() -> dict:
+    """
+    Load the timing database.
+
+    Returns
+    -------
+    dict
+        The recorded durations in seconds of each phase of each formula, e.g. ``{'foo': {'install': 60, 'test': 5}}``.
+        Empty if the database does not exist or is invalid.
+    """
+    try:
+        with open(get_timing_db(), 'r') as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return timings if isinstance(timings, dict) else {}
+
+
+def save_formula_timings() -> None:
+    """
+    Merge the durations of the phases that ran in this run into the timing database.
+
+    The database is locked with ``flock``, so parallel runs on the same runner don't lose each other's timings.
+    """
+    if not FORMULA_DURATIONS:
+        return
+
+    timing_db = get_timing_db()
+    os.makedirs(os.path.dirname(os.path.abspath(timing_db)), exist_ok=True)
+    with _file_lock(f'{timing_db}.lock'):
+        timings = load_formula_timings()
+        for formula, durations in FORMULA_DURATIONS.items():
+            timings.setdefault(formula, {}).update({phase: round(d, 3) for phase, d in durations.items()})
+
+        with open(f'{timing_db}.tmp', 'w') as f:
+            json.dump(timings, f, indent=2, sort_keys=True)
+        os.replace(f'{timing_db}.tmp', timing_db)
+
+
+def hash_formula_timings(timings: dict) -> str:
+    """
+    Hash the timing database, so jobs that computed different shard assignments can be told apart.
+
+    Parameters
+    ----------
+    timings : dict
+        The timing database, from ``load_formula_timings``.
+
+    Returns
+    -------
+    str
+        The first 12 hex digits of the sha256 of the canonical JSON of the database.
+    """
+    return hashlib.sha256(json.dumps(timings, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def shard_formula_files(formula_files: list, shard: int, shards: int, timings: dict) -> list:
+    """
+    Select the formula files of one shard, balancing the shards by the recorded durations of the formulae.
+
+    The formulae are assigned longest first to the shard with the least total duration so far (greedy LPT
+    bin-packing). Formulae without recorded durations are weighted with the median duration of the others, or equally
+    if nothing is recorded. Ties are broken by file name, so the assignment only depends on the formula files and the
+    timing database; every job of a matrix must be given the same database to compute the same assignment. The hash of
+    the database and the assignment of every shard are printed, so mismatching jobs can be detected.
+
+    Parameters
+    ----------
+    formula_files : list
+        Formula files to shard.
+    shard : int
+        The shard to select, from 1 to ``shards``.
+    shards : int
+        Number of shards.
+    timings : dict
+        The timing database, from ``load_formula_timings``.
+
+    Returns
+    -------
+    list
+        The formula files of the shard, in their original order.
+    """
+    def recorded(formula_file: str) -> Optional[float]:
+        durations = timings.get(os.path.splitext(os.path.basename(formula_file))[0])
+        if not isinstance(durations, dict) or not durations:
+            return None
+        return float(sum(durations.get(phase, 0) for phase in ('install', 'test')))
+
+    weights = {formula_file: recorded(formula_file) for formula_file in formula_files}
+    known = sorted(weight for weight in weights.values() if weight is not None)
+    fallback = (known[len(known) // 2] + known[(len(known) - 1) // 2]) / 2 if known else 1.0
+    weights = {formula_file: fallback if weight is None else weight for formula_file, weight in weights.items()}
+
+    loads = [0.0] * shards
+    assignment = {}
+    for formula_file in sorted(formula_files, key=lambda f: (-weights[f], f)):
+        index = min(range(shards), key=lambda i: (loads[i], i))
+        loads[index] += weights[formula_file]
+        assignment[formula_file] = index
+
+    print(f'Shard assignment of {len(formula_files)} formulae with timing database {hash_formula_timings(timings)}:')
+    for index in range(shards):
+        names = sorted(os.path.basename(f) for f in formula_files if assignment[f] == index)
+        print(f'  {index + 1}/{shards} ({loads[index]:.0f}s): {", ".join(names)}')
+
+    selected = [formula_file for formula_file in formula_files if assignment[formula_file] == shard - 1]
+    print(f'Shard {shard}/{shards}: {len(selected)} of {len(formula_files)} formulae, '
+          f'estimated {loads[shard - 1]:.0f}s of {sum(loads):.0f}s')
+    return selected
+
+
+def get_formula_dependency_levels(formula_files: Mapping) -> tuple:
+    """
+    Group formulae into levels by their dependencies on each other, so every formula comes after its dependencies.
+
+    Only dependencies on formulae in ``formula_files`` are considered. A dependency matches a formula by its bare name,
+    or its name in the temporary tap, e.g. ``foo`` or ``homebrew-release-action/homebrew-test/foo``. Brew resolves a
+    name in another tap, e.g. ``org/homebrew/foo``, to that tap, so it does not reuse the formula validated here.
+
+    Parameters
+    ----------
+    formula_files : Mapping
+        Formula name -> formula file, in the order to keep within a level.
+
+    Returns
+    -------
+    tuple
+        The levels, as lists of formula names, and a dict of formula name -> set of the formulae it depends on.
+
+    Raises
+    ------
+    ValueError
+        If the formulae depend on each other in a cycle.
+    """
+    dependencies = {}
+    for formula, formula_file in formula_files.items():
+        try:
+            with open(formula_file, 'r', encoding='utf-8') as f:
+                depends_on = parse_formula(f.read())['depends_on']
+        except OSError:
+            depends_on = []
+        tap_prefix = f"{temp_repo.replace(os.sep, '/')}/"
+        dependencies[formula] = {
+            name[len(tap_prefix):] if name.startswith(tap_prefix) else name for name, _ in depends_on
+        } & set(formula_files) - {formula}
+
+    levels = []
+    done = set()
+    while len(done) < len(formula_files):
+        level = [formula for formula in formula_files if formula not in done and dependencies[formula] <= done]
+        if not level:
+            cycle = sorted(set(formula_files) - done)
+            raise ValueError(f'::error:: Formulae {cycle} have a dependency cycle')
+        levels.append(level)
+        done.update(level)
+
+    return levels, dependencies
+
+
+def is_formula_installed(formula: str) -> bool:
+    proc = subprocess.run(
+        args=['brew', 'list', '--versions', os.path.join(temp_repo, formula)],
+        capture_output=True,
+    )
+    return proc.returncode == 0 and bool(proc.stdout.strip())
+
+
+class Checkpoint:
+    """
+    Record the phases of a formula validation that completed, so a re-run of a failed job can resume after them.
+
+    Each completed phase is written to the checkpoint file together with a key of the formula file and Homebrew
+    state (see ``get_result_cache_key``). When resuming, the phases recorded with the current key are skipped, up to
+    the first phase that did not complete. A completed install is only skipped if the formula is still installed and
+    its buildpath still exists, in which case the buildpath is restored.
+
+    Parameters
+    ----------
+    formula : str
+        Name of the formula in the temporary tap.
+    formula_file : str
+        The formula file.
+    path : str
+        The checkpoint file.
+    """
+    PHASES = ('upgrade', 'debug', 'audit', 'install', 'test')
+
+    def __init__(self, formula: str, formula_file: str, path: str):
+        self.formula = formula
+        self.formula_file = formula_file
+        self.path = path
+        self.completed = {}  # phase -> state of the phase
+        self._lock = threading.Lock()
+
+    def resume(self) -> list:
+        """
+        Load the phases completed by a previous run with the same key.
+
+        Returns
+        -------
+        list
+            The phases that will be skipped.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            print('No checkpoint to resume from')
+            return []
+
+        key = get_result_cache_key(self.formula_file)
+        if checkpoint.get('formula') != self.formula or checkpoint.get('key') != key:
+            print('The formula or Homebrew changed since the checkpoint was written, not resuming')
+            return []
+
+        for phase in self.PHASES:
+            state = checkpoint.get('phases', {}).get(phase)
+            if state is None:
+                break
+            if phase == 'install' and not (
+                    os.path.isdir(state.get('buildpath', '')) and is_formula_installed(self.formula)):
+                print(f'Formula {self.formula} is no longer installed, or its buildpath is gone')
+                break
+            self.completed[phase] = state
+
+        print(f'Resuming after phases: {", ".join(self.completed) or "none"}')
+        return list(self.completed)
+
+    def is_done(self, phase: str) -> bool:
+        with self._lock:
+            return phase in self.completed
+
+    def complete(self, phase: str, **state) -> None:
+        """
+        Record a completed phase, and write the checkpoint file.
+        """
+        with self._lock:
+            self.completed[phase] = state
+            checkpoint = dict(
+                formula=self.formula,
+                key=get_result_cache_key(self.formula_file),
+                phases=self.completed,
+            )
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(f'{self.path}.tmp', 'w') as f:
+                json.dump(checkpoint, f, indent=2)
+            os.replace(f'{self.path}.tmp', self.path)
+
+    def remove(self) -> None:
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def _run_checkpointed(phase: str, func: Callable, formula: str) -> bool:
+    """
+    Run a phase of a formula validation, unless the checkpoint shows it completed in a previous run.
+    """
+    if CHECKPOINT and CHECKPOINT.is_done(phase):
+        print(f'Skipping {phase} of {formula}, it completed in a previous run')
+        if phase == 'install':
+            global HOMEBREW_BUILDPATH
+            HOMEBREW_BUILDPATH = BUILDPATHS[formula] = CHECKPOINT.completed[phase]['buildpath']
+            set_github_action_output(output_name='buildpath', output_value=HOMEBREW_BUILDPATH)
+        return True
+
+    start = time.perf_counter()
+    result = func(formula)
+    if result and phase in ('install', 'test'):
+        FORMULA_DURATIONS.setdefault(formula, {})[phase] = time.perf_counter() - start
+    if result and CHECKPOINT:
+        CHECKPOINT.complete(phase, **(dict(buildpath=BUILDPATHS[formula]) if phase == 'install' else {}))
+    return result
+
+
+def validate_formula(formula: str, audit_result: Optional[bool] = None) -> list:
+    """
+    Audit, install, and test a formula.
+
+    If ``INPUT_CONCURRENT_AUDIT`` is ``true``, the audit runs in a background thread while the formula is installed and
+    tested, and the output of each phase is prefixed with the phase name. The failed phases are reported in the same
+    order either way.
+
+    Parameters
+    ----------
+    formula : str
+        Name of the formula in the temporary tap.
+    audit_result : Optional[bool]
+        The result of an audit that already ran, e.g. from ``audit_formulae``. If None, the formula is audited.
+
+    Returns
+    -------
+    list
+        The phases that failed.
+    """
+    failures = []
+
+    if audit_result is not None:
+        install_result = _run_checkpointed('install', install_formula, formula)
+        test_result = _run_checkpointed('test', test_formula, formula)
+    elif os.getenv('INPUT_CONCURRENT_AUDIT', 'false').lower() == 'true':
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            audit_future = pool.submit(
+                _with_output_prefix('[audit] ', functools.partial(_run_checkpointed, 'audit', audit_formula)), formula)
+            with _output_prefix('[install] '):
+                install_result = _run_checkpointed('install', install_formula, formula)
+            with _output_prefix('[test] '):
+                test_result = _run_checkpointed('test', test_formula, formula)
+            audit_result = audit_future.result()
+    else:
+        audit_result = _run_checkpointed('audit', audit_formula, formula)
+        install_result = _run_checkpointed('install', install_formula, formula)
+        test_result = _run_checkpointed('test', test_formula, formula)
+
+    if not audit_result:
+        print(f'::error:: Formula {formula} failed audit')
+        failures.append('audit')
+
+    if not install_result:
+        print(f'::error:: Formula {formula} failed install')
+        failures.append('install')
+
+    if not test_result:
+        print(f'::error:: Formula {formula} failed test')
+        failures.append('test')
+
+    return failures
+
+
+def get_result_cache_key(formula_file: str) -> str:
+    """
+    Get the result cache key of a formula file.
+
+    The key is a hash of the formula file contents, the Homebrew version, the HEAD of the Homebrew repository and
+    homebrew/core tap (if tapped), and the platform.
+
+    Parameters
+    ----------
+    formula_file : str
+        The formula file.
+
+    Returns
+    -------
+    str
+        The cache key.
+    """
+    key = hashlib.sha256()
+    with open(formula_file, 'rb') as f:
+        key.update(hashlib.sha256(f.read()).digest())
+
+    core_tap = os.path.join(get_brew_repository(), 'Library', 'Taps', 'homebrew', 'homebrew-core')
+    core_tap_head = subprocess.run(
+        args=['git', '-C', core_tap, 'rev-parse', 'HEAD'],
+        capture_output=True,
+    ).stdout.decode('utf-8').strip() if os.path.isdir(core_tap) else ''
+
+    for part in (get_brew_version(), get_brew_repository_head(), core_tap_head, platform.platform(terse=True)):
+        key.update(f'\0{part}'.encode('utf-8'))
+
+    return key.hexdigest()
+
+
+def _result_cache_file(formula_file: str) -> Optional[str]:
+    cache_dir = os.getenv('INPUT_RESULT_CACHE_DIR')
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, f'{get_result_cache_key(formula_file)}.json')
+
+
+def load_cached_result(formula_file: str) -> Optional[dict]:
+    """
+    Load the cached result of a previous successful validation of the formula file.
+
+    Parameters
+    ----------
+    formula_file : str
+        The formula file.
+
+    Returns
+    -------
+    Optional[dict]
+        The cached result, or None if the result cache is disabled, revalidation is forced, or there is no match.
+    """
+    if os.getenv('INPUT_FORCE_VALIDATE', 'false').lower() == 'true':
+        return None
+
+    cache_file = _result_cache_file(formula_file)
+    if not cache_file:
+        return None
+
+    try:
+        with open(cache_file, 'r') as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return result if result.get('verdict') == 'success' else None
+
+
+def save_cached_result(formula_file: str, formula: str) -> None:
+    cache_file = _result_cache_file(formula_file)
+    if not cache_file:
+        return
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(f'{cache_file}.tmp', 'w') as f:
+        json.dump(dict(
+            formula=formula,
+            verdict='success',
+            buildpath=BUILDPATHS.get(formula, ''),
+            testpath=TESTPATHS.get(formula, ''),
+            timestamp=time.time(),
+        ), f)
+    os.replace(f'{cache_file}.tmp', cache_file)
+
+
+def validate_formula_cached(formula: str, formula_file: str, audit_result: Optional[bool] = None) -> list:
+    """
+    Validate a formula, unless the result cache holds a successful result for the same formula file and Homebrew state.
+
+    A cached success is replayed by setting the ``buildpath`` and ``testpath`` outputs from the cached result.
+
+    Parameters
+    ----------
+    formula : str
+        Name of the formula in the temporary tap.
+    formula_file : str
+        The formula file.
+    audit_result : Optional[bool]
+        The result of an audit that already ran. If None, the formula is audited.
+
+    Returns
+    -------
+    list
+        The phases that failed.
+    """
+    cached = load_cached_result(formula_file)
+    if cached:
+        print(f'Formula {formula} was validated in a previous run, skipping audit, install, and test')
+        CACHED_FORMULAE.add(formula)
+        BUILDPATHS[formula] = cached.get('buildpath', '')
+        TESTPATHS[formula] = cached.get('testpath', '')
+        for output_name in ('buildpath', 'testpath'):
+            set_github_action_output(
+                output_name=output_name,
+                output_value=cached.get(output_name, ''),
+            )
+        return []
+
+    failures = validate_formula(formula, audit_result=audit_result)
+    if not failures:
+        save_cached_result(formula_file=formula_file, formula=formula)
+    return failures
+
+
+def _validate_formula_prefixed(formula: str, formula_file: str, audit_result: Optional[bool] = None) -> list:
+    with _output_prefix(f'[{formula}] '):
+        try:
+            return validate_formula_cached(formula, formula_file, audit_result=audit_result)
+        except Exception as e:
+            print(f'::error:: Formula {formula} failed validation: {e}')
+            return ['validate']
+
+
+def validate_batch(formula_files: list, max_workers: int) -> None:
+    """
+    Validate many formulae, sharing the Homebrew setup between them.
+
+    The formulae are processed one at a time, Homebrew is updated once, and then the formulae are audited, installed,
+    and tested across a pool of at most ``max_workers`` threads. Results are collected per formula.
+
+    If ``INPUT_BATCH_BREW_COMMANDS`` is ``true``, the formulae without a cached result are audited and fetched by one
+    ``brew audit`` and one ``brew fetch`` invocation before the pool starts, instead of paying the startup of brew for
+    every formula. Formulae that could not be fetched are not installed or tested.
+
+    If ``INPUT_DEPENDENCY_ORDER`` is ``true``, formulae that depend on other formulae in the batch are validated after
+    them, level by level, and are skipped if any of those dependencies failed.
+
+    Parameters
+    ----------
+    formula_files : list
+        Formula files to validate.
+    max_workers : int
+        Maximum number of formulae to validate concurrently.
+    """
+    global ERROR
+
+    if os.getenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', '').lower() == 'true':
+        raise SystemExit(1, '::error:: Contributing to homebrew-core is not supported in batch mode')
 
-    formula = process_input_formula(args.formula_file)
+    formulae = []
+    for formula_file in formula_files:
+        formula = process_input_formula(formula_file)
+        if formula in formulae:
+            raise ValueError(f'::error:: Formula {formula} was provided more than once')
+        formulae.append(formula)
 
     if os.environ['INPUT_VALIDATE'].lower() != 'true':
         print('Skipping audit, install, and test')
         return
 
-    upgrade_status = brew_upgrade()
-    if not upgrade_status:
+    collect_temp_directories()
+
+    if not brew_upgrade(formulae=formulae):
         print('::error:: Homebrew update or upgrade failed')
         raise SystemExit(1)
 
@@ -436,17 +3493,193 @@ def main():
         print('::error:: Homebrew debug failed')
         raise SystemExit(1)
 
-    if not audit_formula(formula):
-        print(f'::error:: Formula {formula} failed audit')
-        FAILURES.append('audit')
+    audits = {}
+    fetches = {}
+    pending = [
+        formula for formula, formula_file in zip(formulae, formula_files) if not load_cached_result(formula_file)
+    ]
+    if pending and os.getenv('INPUT_BATCH_BREW_COMMANDS', 'true').lower() == 'true':
+        with _output_prefix('[audit] '):
+            audits = audit_formulae(pending)
+        with _output_prefix('[fetch] '):
+            fetches = fetch_formulae(pending)
+
+    results = {}
+    for formula in formulae:
+        if fetches.get(formula) is False:
+            print(f'::error:: Formula {formula} failed fetch')
+            results[formula] = ([] if audits[formula] else ['audit']) + ['fetch']
+
+    files = dict(zip(formulae, formula_files))
+    if os.getenv('INPUT_DEPENDENCY_ORDER', 'true').lower() == 'true':
+        levels, dependencies = get_formula_dependency_levels(files)
+    else:
+        levels, dependencies = [formulae], {formula: set() for formula in formulae}
+
+    print(f'Validating {len(formulae) - len(results)} formulae in {len(levels)} levels '
+          f'with up to {max_workers} workers')
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        for level in levels:
+            batch = []
+            for formula in level:
+                if formula in results:
+                    continue
+                failed = sorted(dependency for dependency in dependencies[formula] if results[dependency])
+                if failed:
+                    # the dependencies are installed from the tap, so the formula would fail, or build them again
+                    print(f'::error:: Skipping formula {formula}, its dependencies {failed} failed')
+                    results[formula] = ['dependencies']
+                    continue
+                batch.append(formula)
+
+            # formulae in a level don't depend on each other, and reuse the dependencies installed by earlier levels
+            for formula, failures in zip(batch, pool.map(
+                    _validate_formula_prefixed,
+                    batch,
+                    [files[formula] for formula in batch],
+                    [audits.get(formula) for formula in batch],
+            )):
+                results[formula] = failures
+
+    for formula in formulae:
+        FORMULA_RESULTS[formula] = results[formula]
 
-    if not install_formula(formula):
-        print(f'::error:: Formula {formula} failed install')
-        FAILURES.append('install')
+    set_github_action_output(
+        output_name='results',
+        output_value=json.dumps({
+            formula: dict(
+                failures=failures,
+                cached=formula in CACHED_FORMULAE,
+                buildpath=BUILDPATHS.get(formula, ''),
+                testpath=TESTPATHS.get(formula, ''),
+            ) for formula, failures in FORMULA_RESULTS.items()
+        }),
+    )
 
-    if not test_formula(formula):
-        print(f'::error:: Formula {formula} failed test')
-        FAILURES.append('test')
+    archive_temp_directories(formulae=formulae)
+
+    failed = {formula: failures for formula, failures in FORMULA_RESULTS.items() if failures}
+    for formula in formulae:
+        print(f'{formula}: {f"failed {failed[formula]}" if formula in failed else "passed"}')
+
+    if failed:
+        ERROR = True
+        raise SystemExit(
+            1,
+            f'::error:: Formulae did not pass checks: {failed}. Please check the logs for more information.'
+        )
+
+    print(f'Formulae {", ".join(formulae)} audit, install, and test successful')
+
+
+def main():
+    if get_log_mode() == 'collapsed':
+        set_github_action_output(
+            output_name='log_dir',
+            output_value=get_log_dir(),
+        )
+
+    failed = True
+    try:
+        _main()
+        failed = ERROR
+    finally:
+        report_brew_diagnostics(failed=failed)
+        save_formula_timings()
+        export_trace()
+        export_resource_usage()
+
+
+def _main():
+    if not is_brew_installed():
+        raise SystemExit(1, 'Homebrew is not installed')
+
+    if args.formulae:
+        formula_files = expand_formula_files(args.formulae)
+        if args.shard:
+            timings = load_formula_timings()
+            set_github_action_output(output_name='timing_db_hash', output_value=hash_formula_timings(timings))
+            formula_files = shard_formula_files(formula_files, *args.shard, timings=timings)
+            if not formula_files:
+                print('No formulae in this shard')
+                return
+        validate_batch(formula_files=formula_files, max_workers=args.max_workers)
+        return
+
+    contribute = os.getenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE').lower() == 'true'
+    validate = os.environ['INPUT_VALIDATE'].lower() == 'true'
+    state = {}
+
+    def process_formula_step():
+        global CHECKPOINT
+        state['formula'] = process_input_formula(args.formula_file, contribute=False)
+
+        checkpoint_file = os.getenv('INPUT_CHECKPOINT_FILE', '')
+        if checkpoint_file and validate:
+            CHECKPOINT = Checkpoint(formula=state['formula'], formula_file=args.formula_file, path=checkpoint_file)
+            if os.getenv('INPUT_RESUME', 'false').lower() == 'true':
+                CHECKPOINT.resume()
+
+    def upgrade_step():
+        if not _run_checkpointed('upgrade', lambda formula: brew_upgrade(formulae=[formula]), state['formula']):
+            print('::error:: Homebrew update or upgrade failed')
+            raise SystemExit(1)
+
+    def debug_step():
+        if not _run_checkpointed('debug', lambda formula: brew_debug(), state['formula']):
+            print('::error:: Homebrew debug failed')
+            raise SystemExit(1)
+
+    def prefetch_step():
+        if not prefetch_formula(formula_file=args.formula_file):
+            print('::error:: Prefetching the formula sources failed')
+            raise SystemExit(1)
+
+    def validate_step():
+        try:
+            FAILURES.extend(validate_formula_cached(formula=state['formula'], formula_file=args.formula_file))
+        finally:
+            # the directories are most useful when the validation failed
+            archive_temp_directories(formulae=[state['formula']])
+
+    # the homebrew-core fork is fetched while Homebrew is updated
+    steps = [Step(name='formula', func=process_formula_step)]
+    if contribute:
+        steps.append(Step(
+            name='homebrew-core',
+            func=lambda: contribute_formula(formula_file=args.formula_file),
+            requires=('formula',),
+        ))
+    # the formula sources are downloaded while Homebrew is updated
+    prefetch = validate and os.getenv('INPUT_PREFETCH', 'false').lower() == 'true'
+    if validate:
+        steps.append(Step(name='upgrade', func=upgrade_step, requires=('formula',)))
+    if prefetch:
+        steps.append(Step(name='prefetch', func=prefetch_step, requires=('formula',)))
+    if validate and any(get_temp_gc_limits()):
+        # temp directories of previous runs are removed while this run is set up
+        steps.append(Step(name='gc', func=collect_temp_directories))
+    if validate:
+        steps += [
+            Step(name='debug', func=debug_step, requires=('upgrade',)),
+            Step(
+                name='validate',
+                func=validate_step,
+                requires=('debug',) + (('homebrew-core',) if contribute else ()) + (('prefetch',) if prefetch else ()),
+            ),
+        ]
+
+    run_steps(steps=steps, max_concurrency=get_max_concurrency())
+    formula = state['formula']
+
+    if not validate:
+        print('Skipping audit, install, and test')
+        return
+
+    set_github_action_output(
+        output_name='result_cache',
+        output_value='hit' if formula in CACHED_FORMULAE else 'miss',
+    )
 
     if ERROR:
         raise SystemExit(
@@ -454,6 +3687,9 @@ def main():
             f'::error:: Formula did not pass checks: {FAILURES}. Please check the logs for more information.'
         )
 
+    if CHECKPOINT:
+        CHECKPOINT.remove()
+
     print(f'Formula {formula} audit, install, and test successful')
 
 
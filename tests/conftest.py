@@ -1,8 +1,11 @@
 # standard imports
+import functools
+import http.server
 import os
 import shutil
 import subprocess
 import sys
+import threading
 
 # lib imports
 import pytest
@@ -32,6 +35,22 @@ def error_reset():
     main.ERROR = False
 
 
+@pytest.fixture(scope='function', autouse=True)
+def brew_environment_reset():
+    main._BREW_ENVIRONMENT = None
+
+
+@pytest.fixture(scope='function', autouse=True)
+def formula_durations_reset():
+    main.FORMULA_DURATIONS.clear()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def trace_reset():
+    main.TRACE_EVENTS.clear()
+    main.RESOURCE_USAGE.clear()
+
+
 @pytest.fixture(scope='function')
 def github_output_file():
     f = os.environ['GITHUB_OUTPUT']
@@ -48,6 +67,38 @@ def github_output_file():
         fi.write('')
 
 
+@pytest.fixture(scope='function')
+def main_output_files(tmp_path, monkeypatch):
+    """
+    Write the outputs, job summary, and trace of a `main` run to a temp directory instead of the build directory.
+    """
+    files = dict(
+        output=tmp_path / 'github_output.md',
+        step_summary=tmp_path / 'github_step_summary.md',
+        trace=tmp_path / 'trace.json',
+    )
+    monkeypatch.setenv('GITHUB_OUTPUT', str(files['output']))
+    monkeypatch.setenv('GITHUB_STEP_SUMMARY', str(files['step_summary']))
+    monkeypatch.setenv('INPUT_TRACE_FILE', str(files['trace']))
+    yield files
+
+
+@pytest.fixture(scope='function')
+def github_step_summary_file():
+    f = os.environ['GITHUB_STEP_SUMMARY']
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+
+    # touch the file
+    with open(f, 'w') as fi:
+        fi.write('')
+
+    yield f
+
+    # re-touch the file
+    with open(f, 'w') as fi:
+        fi.write('')
+
+
 @pytest.fixture(scope='session')
 def operating_system():
     if sys.platform == 'win32':
@@ -99,6 +150,72 @@ def homebrew_core_fork_repo():
     # shutil.rmtree(repo_directory)
 
 
+def _git(*args, cwd=None):
+    proc = subprocess.run(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+        cwd=cwd,
+        capture_output=True,
+    )
+    if proc.returncode != 0:
+        print(proc.stderr.decode('utf-8'))
+        raise Exception(f'Failed to run git {args}')
+    return proc.stdout.decode('utf-8').strip()
+
+
+@pytest.fixture(scope='function')
+def http_server(tmp_path):
+    """
+    Serve a temporary directory over HTTP on localhost, as a stand-in for formula source hosts.
+
+    Yields the directory and the base url.
+    """
+    directory = tmp_path / 'http'
+    directory.mkdir()
+
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield directory, f'http://127.0.0.1:{server.server_address[1]}'
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture(scope='function')
+def local_homebrew_core(tmp_path, monkeypatch):
+    """
+    Create a local bare repository standing in for upstream homebrew-core, and a clone of it standing in for the fork.
+    """
+    work = tmp_path / 'work'
+    for formula in ['Formula/a/aaa.rb', 'Formula/h/hello_world.rb', 'Formula/z/zzz.rb']:
+        (work / formula).parent.mkdir(parents=True, exist_ok=True)
+        (work / formula).write_text(f'# {formula}\n')
+    (work / 'README.md').write_text('# homebrew-core\n')
+    _git('init', '-b', 'master', str(work))
+    _git('add', '.', cwd=str(work))
+    _git('commit', '-m', 'init', cwd=str(work))
+
+    upstream = tmp_path / 'upstream.git'
+    _git('clone', '--bare', str(work), str(upstream))
+    _git('config', 'uploadpack.allowFilter', 'true', cwd=str(upstream))
+
+    fork = tmp_path / 'fork'
+    _git('clone', '--depth=1', f'file://{upstream}', str(fork))
+
+    # upstream moves on after the fork was checked out
+    for formula in ['Formula/a/aaa.rb', 'Formula/h/hello_world.rb', 'Formula/z/zzz.rb']:
+        (work / formula).write_text(f'# {formula} v2\n')
+    _git('commit', '-am', 'update', cwd=str(work))
+    _git('push', str(upstream), 'master', cwd=str(work))
+
+    monkeypatch.setenv('INPUT_UPSTREAM_HOMEBREW_CORE_REPO', str(upstream))
+
+    yield dict(upstream=str(upstream), fork=str(fork), work=str(work))
+
+
 @pytest.fixture(scope='function')
 def brew_untap():
     # uninstall hello_world formula
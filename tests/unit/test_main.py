@@ -1,7 +1,12 @@
 # standard imports
+import hashlib
+import json
 import os
 import subprocess
 import sys
+import tarfile
+import threading
+import time
 from typing import Optional
 from unittest.mock import patch
 
@@ -34,6 +39,56 @@ def get_current_branch(cwd: Optional[str] = None) -> str:
 def test_parse_args():
     args = main._parse_args(['--formula_file', 'foo'])
     assert args.formula_file == 'foo'
+    assert args.formulae == []
+
+
+DOTENV = """# comment
+export A=1
+B = 'single ${A} # x'  # comment
+C="double\\n${A} \\"q\\""
+D=bare value # comment
+E=a#b
+F="multi
+line"
+G=${MISSING:-fallback}/${A}
+H
+I="a\\db \\\\ \\'"
+J='it\\'s \\\\ \\d'
+R="unterminated
+"""
+
+
+def test_parse_dotenv():
+    assert main.parse_dotenv(DOTENV) == {
+        'A': '1',
+        'B': 'single 1 # x',
+        'C': 'double\n1 "q"',
+        'D': 'bare value',
+        'E': 'a#b',
+        'F': 'multi\nline',
+        'G': 'fallback/1',
+        'I': 'a\\db \\ \'',
+        'J': "it's \\ \\d",
+    }
+
+
+def test_load_dotenv(tmp_path, monkeypatch):
+    dotenv_path = tmp_path / '.env'
+    dotenv_path.write_text('DOTENV_TEST_NEW=new\nDOTENV_TEST_SET=new\n')
+    monkeypatch.delenv('DOTENV_TEST_NEW', raising=False)
+    monkeypatch.setenv('DOTENV_TEST_SET', 'set')
+
+    assert main.load_dotenv(dotenv_path=str(dotenv_path))
+    assert os.environ['DOTENV_TEST_NEW'] == 'new'
+    assert os.environ['DOTENV_TEST_SET'] == 'set'
+
+    assert not main.load_dotenv(dotenv_path=str(tmp_path / 'missing.env'))
+
+
+def test_parse_args_batch():
+    args = main._parse_args(['--formulae', 'Formula', 'other/*.rb', '--max_workers', '4'])
+    assert args.formulae == ['Formula', 'other/*.rb']
+    assert args.max_workers == 4
 
 
 def test_run_subprocess(capsys):
@@ -57,6 +112,140 @@ def test_run_subprocess_fail(capsys):
     assert main.ERROR
 
 
+def test_run_subprocess_partial_lines(capsys):
+    result = main._run_subprocess(
+        args_list=[
+            sys.executable,
+            '-c',
+            'import sys, time; sys.stdout.write("progress"); sys.stdout.flush(); time.sleep(0.3); '
+            'sys.stderr.write("err\\n"); print("done")',
+        ],
+    )
+
+    assert result, "Process returned non zero exit code"
+
+    captured = capsys.readouterr()
+    assert captured.out.startswith('progress')
+    assert 'err\n' in captured.out
+    assert 'done\n' in captured.out
+    assert captured.err == ''
+
+
+def test_run_subprocess_stale_partial_line(capsys):
+    lines = []
+    with main._output_prefix('[install] '):
+        result = main._run_subprocess(
+            args_list=[
+                sys.executable,
+                '-c',
+                'import sys, time; sys.stdout.write("progress 50%"); sys.stdout.flush(); time.sleep(0.3); '
+                'print(" done"); print("next")',
+            ],
+            line_callback=lines.append,
+        )
+
+    assert result, "Process returned non zero exit code"
+
+    # the stale fragment is shown early, but its line is prefixed and passed to the callback once
+    assert capsys.readouterr().out == '[install] progress 50% done\n[install] next\n'
+    assert lines == ['progress 50% done\n', 'next\n']
+
+
+def test_run_subprocess_large_output(capsys):
+    result = main._run_subprocess(
+        args_list=[sys.executable, '-c', 'for i in range(100000): print(i)'],
+    )
+
+    assert result, "Process returned non zero exit code"
+
+    captured = capsys.readouterr()
+    assert captured.out == ''.join(f'{i}\n' for i in range(100000))
+
+
+def test_run_subprocess_quiet_flush(capsys):
+    thread = threading.Thread(target=main._run_subprocess, kwargs=dict(
+        args_list=[
+            sys.executable,
+            '-c',
+            'import time; print("a", flush=True); time.sleep(0.02); print("b", flush=True); time.sleep(2)',
+        ],
+    ))
+    thread.start()
+    try:
+        # the buffered lines are written while the process is quiet, not when it exits
+        time.sleep(1)
+        assert capsys.readouterr().out == 'a\nb\n'
+    finally:
+        thread.join()
+
+
+def test_run_subprocess_closed_pipe_does_not_spin():
+    started = time.process_time()
+    result = main._run_subprocess(
+        args_list=[sys.executable, '-c', 'import os, time; os.close(1); time.sleep(1)'],
+    )
+    assert result, "Process returned non zero exit code"
+
+    # a busy loop on the closed stdout pipe would burn a full second of cpu time
+    assert time.process_time() - started < 0.5
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    ([b'foo\nbar\n'], ['foo\n', 'bar\n']),
+    ([b'fo', b'o\nba', b'r\n'], ['foo\n', 'bar\n']),
+    ([b'foo\n\nbar'], ['foo\n', '\n']),
+    ([b'\xc3', b'\xa9\n'], ['é\n']),
+])
+def test_line_assembler(chunks, expected):
+    assembler = main._LineAssembler()
+    lines = []
+    for chunk in chunks:
+        lines.extend(assembler.feed(chunk))
+    assert lines == expected
+
+
+def test_run_subprocess_output_prefix(capsys):
+    with main._output_prefix('[foo] '):
+        with main._output_prefix('[bar] '):
+            result = main._run_subprocess(
+                args_list=[sys.executable, '-c', 'print("line 1"); print("line 2")'],
+            )
+
+    assert result, "Process returned non zero exit code"
+
+    captured = capsys.readouterr()
+    assert captured.out == '[foo] [bar] line 1\n[foo] [bar] line 2\n'
+
+
+def test_line_assembler_bounded():
+    assembler = main._LineAssembler(max_line_length=4)
+    assert assembler.feed(b'abcdef') == ['abcdef']
+    assert assembler.feed(b'gh\n') == ['gh\n']
+    assert assembler.feed(b'ij') == []
+    assert assembler.flush() == ['ij']
+    assert assembler.flush() == []
+
+
+def test_line_assembler_stale(monkeypatch):
+    monkeypatch.setattr(main, 'OUTPUT_FLUSH_INTERVAL', 0)
+    assembler = main._LineAssembler(max_line_length=8)
+    assert assembler.feed(b'ab') == []
+    assert assembler.flush_stale() == 'ab'
+    assert assembler.flush_stale() == ''
+    assert assembler.feed(b'c') == []
+    assert assembler.flush_stale() == 'c'
+    assert assembler.feed(b'd\ne') == ['abcd\n']
+    assert assembler.shown == 3
+    assert assembler.flush() == ['e']
+    assert assembler.shown == 0
+
+    # a stale line that grows beyond the maximum length
+    assert assembler.feed(b'fghi') == []
+    assert assembler.flush_stale() == 'fghi'
+    assert assembler.feed(b'jklm') == ['fghijklm']
+    assert assembler.shown == 4
+
+
 @pytest.mark.parametrize('outputs', [
     ('test_1', 'foo'),
     ('test_2', 'bar'),
@@ -70,6 +259,160 @@ def test_set_github_action_output(github_output_file, outputs):
     assert output.endswith(f"{outputs[0]}<<EOF\n{outputs[1]}\nEOF\n")
 
 
+def test_set_github_step_summary(github_step_summary_file):
+    main.set_github_step_summary(markdown='## foo\n')
+    main.set_github_step_summary(markdown='bar\n')
+
+    with open(github_step_summary_file, 'r') as f:
+        assert f.read() == '## foo\nbar\n'
+
+
+@pytest.fixture(scope='function')
+def trace_events():
+    main.TRACE_EVENTS = []
+    yield main.TRACE_EVENTS
+    main.TRACE_EVENTS = []
+
+
+def test_trace_span(trace_events):
+    with main.trace_span(name='foo', category='phase', formula='bar') as span:
+        span['result'] = True
+
+    assert len(trace_events) == 1
+    event = trace_events[0]
+    assert event['name'] == 'foo'
+    assert event['cat'] == 'phase'
+    assert event['ph'] == 'X'
+    assert event['dur'] >= 0
+    assert event['args']['formula'] == 'bar'
+    assert event['args']['result']
+
+
+def test_traced(trace_events):
+    @main._traced
+    def phase(formula, flag=False):
+        return formula
+
+    assert phase('foo') == 'foo'
+    assert trace_events[0]['name'] == 'phase (foo)'
+    assert trace_events[0]['args']['formula'] == 'foo'
+
+
+def test_run_subprocess_trace(trace_events):
+    main._run_subprocess(args_list=[sys.executable, '-c', 'raise SystemExit(3)'], ignore_error=True)
+
+    assert trace_events[0]['cat'] == 'subprocess'
+    assert trace_events[0]['args']['exit_code'] == 3
+
+
+def test_export_trace(github_output_file, github_step_summary_file, trace_events, tmp_path, monkeypatch):
+    monkeypatch.setenv('INPUT_TRACE_FILE', str(tmp_path / 'trace.json'))
+
+    with main.trace_span(name='outer'):
+        with main.trace_span(name='inner', category='subprocess'):
+            pass
+
+    trace_file = main.export_trace()
+    assert trace_file == str(tmp_path / 'trace.json')
+
+    with open(trace_file, 'r') as f:
+        trace = json.load(f)
+    assert [e['name'] for e in trace['traceEvents'] if e['ph'] == 'X'] == ['outer', 'inner']
+    assert any(e['ph'] == 'M' and e['name'] == 'thread_name' for e in trace['traceEvents'])
+
+    with open(github_output_file, 'r') as f:
+        assert f'trace_file<<EOF\n{trace_file}\nEOF\n' in f.read()
+
+    with open(github_step_summary_file, 'r') as f:
+        summary = f.read()
+    assert '| outer | phase |' in summary
+    assert '| inner | subprocess |' in summary
+
+
+@pytest.fixture(scope='function')
+def resource_usage():
+    main.RESOURCE_USAGE = {}
+    yield main.RESOURCE_USAGE
+    main.RESOURCE_USAGE = {}
+
+
+ALLOCATE_AND_WRITE = (
+    'import sys, time; data = bytearray(32 * 2 ** 20); sys.stdout.buffer.write(data[:1024]); '
+    'open(sys.argv[1], "wb").write(data); time.sleep(0.3)'
+)
+
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason='os.wait4 is not available')
+def test_wait_process():
+    process = subprocess.Popen([sys.executable, '-c', 'x = bytearray(32 * 2 ** 20)'])
+    exit_code, usage = main._wait_process(process)
+    assert exit_code == 0
+    assert process.returncode == 0
+    assert usage['peak_rss_bytes'] >= 32 * 2 ** 20
+    assert usage['cpu_user_seconds'] + usage['cpu_system_seconds'] > 0
+    io_keys = {'read_blocks', 'write_blocks'} if sys.platform == 'darwin' else {'read_bytes', 'write_bytes'}
+    assert set(usage) >= io_keys
+
+    # block I/O is counted in operations on macOS, of unknown size
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    with patch.object(main.sys, 'platform', 'darwin'):
+        _, usage = main._wait_process(process)
+    assert 'read_blocks' in usage and 'read_bytes' not in usage
+
+    # the exit code is still reported if the process was already reaped
+    process = subprocess.Popen([sys.executable, '-c', 'raise SystemExit(3)'])
+    process.wait()
+    assert main._wait_process(process) == (3, None)
+
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason='os.wait4 is not available')
+@pytest.mark.parametrize('sampling', ['false', 'true'])
+def test_run_subprocess_resource_usage(resource_usage, trace_events, tmp_path, monkeypatch, sampling):
+    monkeypatch.setenv('INPUT_RESOURCE_SAMPLING', sampling)
+    monkeypatch.setattr(main, 'RESOURCE_SAMPLE_INTERVAL', 0.05)
+
+    @main._traced
+    def phase(formula):
+        for _ in range(2):
+            assert main._run_subprocess(args_list=[sys.executable, '-c', ALLOCATE_AND_WRITE, str(tmp_path / 'out')])
+
+    phase(formula='foo')
+
+    usage = resource_usage['phase (foo)']
+    assert usage['processes'] == 2
+    assert usage['peak_rss_bytes'] >= 32 * 2 ** 20
+    assert [e['args']['exit_code'] for e in trace_events if e['cat'] == 'subprocess'] == [0, 0]
+    assert all('peak_rss_bytes' in e['args'] for e in trace_events if e['cat'] == 'subprocess')
+
+    if sampling == 'true' and main._ProcessTreeSampler.available():
+        assert usage['tree_peak_rss_bytes'] >= 32 * 2 ** 20
+        assert usage['tree_write_bytes'] >= 2 * 32 * 2 ** 20
+
+
+def test_record_resource_usage(resource_usage):
+    main.record_resource_usage(phase='foo', usage=dict(cpu_user_seconds=1.0, peak_rss_bytes=10, tree_peak_rss_bytes=20))
+    main.record_resource_usage(phase='foo', usage=dict(cpu_user_seconds=2.0, peak_rss_bytes=5, tree_peak_rss_bytes=30))
+    assert resource_usage == {
+        'foo': dict(processes=2, cpu_user_seconds=3.0, peak_rss_bytes=10, tree_peak_rss_bytes=30),
+    }
+
+
+def test_export_resource_usage(github_output_file, github_step_summary_file, resource_usage):
+    main.record_resource_usage(
+        phase='install_formula (foo)',
+        usage=dict(cpu_user_seconds=1.5, cpu_system_seconds=0.5, peak_rss_bytes=2 ** 20, read_bytes=0, write_bytes=0),
+    )
+
+    usage = main.export_resource_usage()
+    assert usage['install_formula (foo)']['cpu_seconds'] == 2.0
+
+    with open(github_output_file, 'r') as f:
+        assert f'resource_usage<<EOF\n{json.dumps(usage)}\nEOF\n' in f.read()
+
+    with open(github_step_summary_file, 'r') as f:
+        assert '| install_formula (foo) | 1 | 2.00 | 1.0 | 0.0 | 0.0 |' in f.read()
+
+
 def test_get_brew_repository(operating_system):
     assert main.get_brew_repository()
 
@@ -107,6 +450,186 @@ def test_proces_input_formula():
         assert os.path.isfile(os.path.join(d, 'Formula', 'h', 'hello_world.rb'))
 
 
+@pytest.mark.parametrize('formula, expected', [
+    ('hello_world', 'HelloWorld'),
+    ('foo-bar', 'FooBar'),
+    ('python@3.11', 'PythonAT311'),
+    ('libxml++', 'Libxmlxx'),
+])
+def test_get_formula_class_name(formula, expected):
+    assert main.get_formula_class_name(formula) == expected
+
+
+def test_parse_formula():
+    with open(os.path.join(os.getcwd(), 'tests', 'Formula', 'hello_world.rb'), 'r') as f:
+        formula = main.parse_formula(f.read())
+
+    assert formula['class_name'] == 'HelloWorld'
+    assert formula['url'] == ('https://github.com/LizardByte/homebrew-release-action.git', 4)
+    assert formula['version'] == ('0.0.1', 5)
+    assert 'sha256' not in formula
+    assert formula['test']['line'] == 20
+    assert formula['test']['statements'] > 0
+
+
+@pytest.mark.parametrize('install_block', [
+    # a trailing comment after a block opener
+    '    Dir["*.txt"].each do |f| # docs\n      doc.install f\n    end\n',
+    # assignment conditionals
+    '    args = if OS.mac?\n      ["--mac"]\n    else\n      []\n    end\n'
+    '    args ||= begin\n      []\n    end\n    system "make", *args # "quoted # not a comment"\n',
+    # data after __END__ is not parsed
+    '    system "make"\n  end\nend\n__END__\nend\n  def install\n',
+])
+def test_parse_formula_blocks(install_block):
+    formula = main.parse_formula(
+        'class Foo < Formula\n'
+        '  url "https://example.com/foo.tar.gz" # the source\n'
+        '  def install\n'
+        f'{install_block}'
+        + ('' if '__END__' in install_block else '  end\n\n  test do\n    system "true"\n  end\nend\n')
+    )
+    assert formula['url'] == ('https://example.com/foo.tar.gz', 2)
+    assert formula['unbalanced'] is None
+    if '__END__' not in install_block:
+        assert formula['test']['statements'] == 1
+
+
+@pytest.mark.parametrize('text, line', [
+    (
+        'class Foo < Formula\n  url "https://example.com/foo.tar.gz"\n  end\n'
+        '  test do\n    system "true"\n  end\nend\n',
+        4,
+    ),
+    ('class Foo < Formula\n  url "https://example.com/foo.tar.gz"\n  foo = bar do\n', 3),
+])
+def test_check_formula_unbalanced(tmp_path, text, line):
+    formula_file = tmp_path / 'foo.rb'
+    formula_file.write_text(text)
+
+    # problems that may be caused by the parser are only warnings, and left to brew
+    problems = main.check_formula(str(formula_file))
+    assert all(level == 'warning' for level, _, _ in problems)
+    assert problems[-1][1] == line
+    assert 'Could not match the `do`/`end` blocks' in problems[-1][2]
+
+
+FORMULA_SHA256 = 'a' * 64
+
+
+@pytest.mark.parametrize('filename, body, expected', [
+    ('foo.rb', f'url "https://example.com/foo.tar.gz"\n  sha256 "{FORMULA_SHA256}"', []),
+    ('foo.rb', 'url "https://example.com/foo.tar.gz"', [('error', 2, 'has no `sha256`')]),
+    ('foo.rb', 'url "https://example.com/foo", using: :git, tag: "v1"', []),
+    ('foo.rb', 'url "https://git.sr.ht/~foo/foo",\n      tag:      "v1",\n      revision: "abc"', []),
+    ('foo.rb', 'head do\n    url "https://example.com/foo.git"\n  end', []),
+    (
+        'foo.rb',
+        f'on_macos do\n    on_arm do\n      url "https://example.com/foo-arm.tar.gz"\n      sha256 "{FORMULA_SHA256}"\n'
+        f'    end\n  end\n  on_linux do\n    url "https://example.com/foo-linux.tar.gz"\n'
+        f'    sha256 "{FORMULA_SHA256}"\n  end',
+        [],
+    ),
+    ('foo.rb', 'on_linux do\n    url "https://example.com/foo.tar.gz"\n  end', [('error', 3, 'has no `sha256`')]),
+    ('foo.rb', 'url "https://example.com/foo.tar.gz"\n  sha256 "abc"', [('error', 3, 'not 64 lowercase')]),
+    ('foo.rb', 'version "1.0"', [('error', 1, 'no `url` or `head`')]),
+    ('bar.rb', f'url "https://example.com/foo.tar.gz"\n  sha256 "{FORMULA_SHA256}"', [('error', 1, 'expected Bar')]),
+    (
+        'foo.rb',
+        f'url "https://example.com/foo.tar.gz"\n  sha256 "{FORMULA_SHA256}"\n'
+        '  resource "baz" do\n    url "https://example.com/baz.tar.gz"\n  end',
+        [('error', 4, 'Resource baz has no `sha256`')],
+    ),
+    (
+        'foo.rb',
+        f'url "https://example.com/foo.tar.gz"\n  sha256 "{FORMULA_SHA256}"\n'
+        '  depends_on "cmake" => :build\n  depends_on "cmake"',
+        [('warning', 5, 'cmake is declared more than once')],
+    ),
+])
+def test_check_formula(tmp_path, filename, body, expected):
+    formula_file = tmp_path / filename
+    formula_file.write_text(f'class Foo < Formula\n  {body}\n\n  test do\n    system "true"\n  end\nend\n')
+
+    problems = main.check_formula(str(formula_file))
+    assert len(problems) == len(expected)
+    for (level, line, message), (expected_level, expected_line, expected_message) in zip(problems, expected):
+        assert level == expected_level
+        assert line == expected_line
+        assert expected_message in message
+
+
+@pytest.mark.parametrize('test_block, expected', [
+    ('', 'has no `test do` block'),
+    ('  test do\n  end\n', 'has an empty `test do` block'),
+    ('  test do\n    # only a comment\n  end\n', 'has an empty `test do` block'),
+])
+def test_check_formula_test_block(tmp_path, test_block, expected):
+    formula_file = tmp_path / 'foo.rb'
+    formula_file.write_text(f'class Foo < Formula\n  url "https://example.com/foo.git"\n{test_block}end\n')
+
+    problems = main.check_formula(str(formula_file))
+    assert len(problems) == 1
+    assert expected in problems[0][2]
+
+
+def test_process_input_formula_static_check(tmp_path, capsys):
+    formula_file = tmp_path / 'foo.rb'
+    formula_file.write_text('class Bar < Formula\nend\n')
+
+    with patch.object(main, '_run_subprocess') as mock_run:
+        with pytest.raises(ValueError, match='failed static checks'):
+            main.process_input_formula(formula_file=str(formula_file))
+    mock_run.assert_not_called()
+
+    assert f'::error file={formula_file},line=1::' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('contribute, expected_dirs', [
+    (None, ['org_homebrew_repo', 'homebrew_core_fork_repo']),
+    (False, ['org_homebrew_repo']),
+])
+def test_process_input_formula_contribute(tmp_path, contribute, expected_dirs):
+    formula_file = os.path.join(os.getcwd(), 'tests', 'Formula', 'hello_world.rb')
+    with patch.multiple(
+            main,
+            get_brew_environment=lambda *args, **kwargs: dict(developer=True),
+            get_brew_repository=lambda: str(tmp_path),
+            is_brew_installed=lambda: False,
+            _run_subprocess=lambda *args, **kwargs: True,
+            _prepare_homebrew_core_fork_for_formula=lambda *args, **kwargs: None,
+    ), patch.object(main, '_copy_formula_file') as mock_copy:
+        assert main.process_input_formula(formula_file=formula_file, contribute=contribute) == 'hello_world'
+
+    # the fork is left alone until `contribute_formula` checks out the branch
+    assert [
+        os.path.basename(os.path.dirname(os.path.dirname(call.kwargs['directory'])))
+        for call in mock_copy.call_args_list
+    ] == expected_dirs
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1/4', (1, 4)),
+    (' 4 / 4 ', (4, 4)),
+    ('0/4', None),
+    ('5/4', None),
+    ('1', None),
+    ('a/b', None),
+])
+def test_parse_args_shard(value, expected):
+    if expected:
+        assert main._parse_args(args_list=['--shard', value]).shard == expected
+    else:
+        with pytest.raises(SystemExit):
+            main._parse_args(args_list=['--shard', value])
+
+
+def test_parse_args_shard_env(monkeypatch):
+    assert main._parse_args(args_list=[]).shard is None
+    monkeypatch.setenv('INPUT_SHARD', '2/3')
+    assert main._parse_args(args_list=[]).shard == (2, 3)
+
+
 def test_is_brew_installed(operating_system):
     assert main.is_brew_installed()
 
@@ -119,38 +642,122 @@ def test_brew_debug():
     assert main.brew_debug()
 
 
+@pytest.fixture(scope='function')
+def fake_brew(tmp_path, monkeypatch):
+    """
+    Put a fake ``brew`` on the PATH, whose ``brew config`` exits with ``FAKE_BREW_CONFIG_EXIT``.
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    brew = bin_dir / 'brew'
+    brew.write_text(
+        '#!/bin/sh\n'
+        'case "$1" in\n'
+        '  config) echo "HOMEBREW_VERSION: 4.0.0"; exit "${FAKE_BREW_CONFIG_EXIT:-0}" ;;\n'
+        '  doctor) echo "Warning: Some installed formulae are deprecated"; exit 1 ;;\n'
+        'esac\n'
+    )
+    brew.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setattr(main, 'BREW_DIAGNOSTICS', None)
+
+
+@pytest.mark.parametrize('failed, config_exit, expected', [
+    (False, '0', []),
+    (True, '0', ['HOMEBREW_VERSION: 4.0.0', 'Warning: Some installed formulae are deprecated']),
+    (False, '1', ['HOMEBREW_VERSION: 4.0.0']),
+])
+def test_brew_debug_deferred(capsys, fake_brew, monkeypatch, failed, config_exit, expected):
+    monkeypatch.setenv('INPUT_DEFER_DIAGNOSTICS', 'true')
+    monkeypatch.setenv('FAKE_BREW_CONFIG_EXIT', config_exit)
+
+    assert main.brew_debug()
+    assert main.BREW_DIAGNOSTICS
+
+    # the diagnostics are only started once
+    diagnostics = main.BREW_DIAGNOSTICS
+    assert main.brew_debug()
+    assert main.BREW_DIAGNOSTICS is diagnostics
+    capsys.readouterr()
+
+    main.report_brew_diagnostics(failed=failed)
+    assert main.BREW_DIAGNOSTICS is None
+    assert diagnostics.results == {
+        'brew config': (int(config_exit), 'HOMEBREW_VERSION: 4.0.0\n'),
+        'brew doctor': (1, 'Warning: Some installed formulae are deprecated\n'),
+    }
+
+    output = capsys.readouterr().out
+    assert [line for line in output.splitlines() if not line.startswith('::')] == expected
+    assert ('::warning::' in output) == (config_exit != '0')
+
+
+@pytest.mark.parametrize('error, exception, expected_failed', [
+    (False, None, False),
+    (True, None, True),
+    (False, SystemExit(1), True),
+])
+def test_main_reports_brew_diagnostics(main_output_files, monkeypatch, error, exception, expected_failed):
+    monkeypatch.setattr(main, 'ERROR', error)
+
+    def _main():
+        if exception:
+            raise exception
+
+    with patch('action.main._main', side_effect=_main), \
+            patch('action.main.report_brew_diagnostics') as mock_report, \
+            patch('action.main.export_trace'), \
+            patch('action.main.export_resource_usage'):
+        if exception:
+            with pytest.raises(SystemExit):
+                main.main()
+        else:
+            main.main()
+
+    mock_report.assert_called_once_with(failed=expected_failed)
+
+
 @pytest.mark.parametrize('setup_scenario', [
-    # Scenario 1: Formula temp dir exists in first location (HOMEBREW_TEMP)
-    {'env': {'HOMEBREW_TEMP': '/tmp/custom'}, 'dirs': ['/tmp/custom'], 'files': ['formula-123']},
-    # Scenario 2: Formula temp dir exists in macOS default location
-    {'env': {}, 'dirs': ['/private/tmp'], 'files': ['formula-456']},
-    # Scenario 3: Formula temp dir exists in Linux default location
-    {'env': {}, 'dirs': ['/var/tmp'], 'files': ['formula-789']},
+    # Scenario 1: HOMEBREW_TEMP is set
+    {'env': {'HOMEBREW_TEMP': '/tmp/custom'}, 'dirs': ['/tmp/custom'], 'expected': '/tmp/custom'},
+    # Scenario 2: macOS default location
+    {'env': {}, 'dirs': ['/private/tmp'], 'expected': '/private/tmp'},
+    # Scenario 3: Linux default location
+    {'env': {}, 'dirs': ['/var/tmp'], 'expected': '/var/tmp'},
 ])
 @patch('os.path.isdir')
-@patch('os.listdir')
 @patch('os.environ')
-def test_find_tmp_dir(mock_environ, mock_listdir, mock_isdir, setup_scenario):
+def test_get_root_tmp_dir(mock_environ, mock_isdir, setup_scenario):
     # Setup environment variables
     mock_environ.get.side_effect = lambda key, default: setup_scenario['env'].get(key, default)
 
     # Configure which directories exist
     mock_isdir.side_effect = lambda path: any(d in path for d in setup_scenario['dirs'])
 
-    # Configure directory listings
-    mock_listdir.return_value = setup_scenario['files']
+    assert main.get_root_tmp_dir() == setup_scenario['expected']
+
+
+@pytest.fixture(scope='function')
+def homebrew_temp(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOMEBREW_TEMP', str(tmp_path))
 
     # Reset global tracking of temp directories
     main.TEMP_DIRECTORIES = []
 
-    # Run the function and check results
-    result = main.find_tmp_dir('formula')
+    yield tmp_path
+
+    main.TEMP_DIRECTORIES = []
+
 
-    # Verify the result contains the formula temp directory path
-    assert any(f in result for f in setup_scenario['files'])
+def test_find_tmp_dir(homebrew_temp):
+    (homebrew_temp / 'formula-20240101-123-abc').mkdir()
+    (homebrew_temp / 'other-20240101-123-abc').mkdir()
+
+    result = main.find_tmp_dir('formula')
+    assert result == str(homebrew_temp / 'formula-20240101-123-abc')
 
     # Verify the temp directory was added to tracking
-    assert len(main.TEMP_DIRECTORIES) == 1
+    assert main.TEMP_DIRECTORIES == [result]
 
 
 @patch('os.path.isdir')
@@ -163,51 +770,60 @@ def test_find_tmp_dir_no_root_tmp(mock_isdir):
         main.find_tmp_dir('formula')
 
 
-@patch('os.path.isdir')
-@patch('os.listdir')
-def test_find_tmp_dir_no_formula_tmp(mock_listdir, mock_isdir):
-    # Make root temp directories exist
-    mock_isdir.side_effect = lambda path: any(tmp_dir in path for tmp_dir in ['/private/tmp', '/var/tmp'])
-
-    # But no formula temp directories
-    mock_listdir.return_value = ['other-dir', 'not-matching']
-
-    # Reset global tracking of temp directories
-    main.TEMP_DIRECTORIES = []
+def test_find_tmp_dir_no_formula_tmp(homebrew_temp):
+    # No formula temp directories, only similarly named ones
+    for d in ['other-dir', 'formula', 'formula--resource-20240101-123-abc', 'formula-extra-20240101-123-abc']:
+        (homebrew_temp / d).mkdir()
+    (homebrew_temp / 'formula-20240101-123-file').write_text('')
 
     # Run the function and expect error
     with pytest.raises(FileNotFoundError, match="Could not find temp directory"):
         main.find_tmp_dir('formula')
 
 
-@pytest.mark.parametrize('existing_dirs', [
-    ['formula-123'],
-    ['formula-123', 'formula-456'],
-    ['formula-123', 'formula-456', 'formula-789'],
-])
-@patch('os.path.isdir')
-@patch('os.listdir')
-def test_find_tmp_dir_tracking(mock_listdir, mock_isdir, existing_dirs):
-    # Configure mock_isdir to return True for root temp directories
-    # but also retain the ability to check other paths
-    def mock_isdir_side_effect(path):
-        # Return True for any of the root temp directories
-        if any(tmp_dir in path for tmp_dir in ['/private/tmp', '/var/tmp']):
-            return True
-        return False
+def test_find_tmp_dir_snapshot(homebrew_temp):
+    # Stale directories from previous runs
+    for d in ['formula-20240101-1-a', 'formula-test-20240101-1-b']:
+        (homebrew_temp / d).mkdir()
 
-    mock_isdir.side_effect = mock_isdir_side_effect
+    snapshot = main.snapshot_tmp_dir('formula')
+    assert set(snapshot) == {'formula-20240101-1-a', 'formula-test-20240101-1-b'}
 
-    # Set up multiple formula directories
-    mock_listdir.return_value = existing_dirs
+    (homebrew_temp / 'formula-20240102-2-c').mkdir()
+    assert main.find_tmp_dir('formula', snapshot=snapshot) == str(homebrew_temp / 'formula-20240102-2-c')
+
+    # A test directory created after a new snapshot
+    snapshot = main.snapshot_tmp_dir('formula')
+    (homebrew_temp / 'formula-test-20240102-2-d').mkdir()
+    assert main.find_tmp_dir('formula', snapshot=snapshot) == str(homebrew_temp / 'formula-test-20240102-2-d')
+
+    # Nothing new since the snapshot
+    snapshot = main.snapshot_tmp_dir('formula')
+    with pytest.raises(FileNotFoundError, match="Could not find temp directory"):
+        main.find_tmp_dir('formula', snapshot=snapshot)
+
+    # A stale directory that was deleted and recreated with the same name is new
+    os.rmdir(homebrew_temp / 'formula-20240101-1-a')
+    (homebrew_temp / 'formula-20240101-1-a').mkdir()
+    if main.snapshot_tmp_dir('formula')['formula-20240101-1-a'][0] != snapshot['formula-20240101-1-a'][0]:
+        assert main.find_tmp_dir('formula', snapshot=snapshot) == str(homebrew_temp / 'formula-20240101-1-a')
 
-    # Reset global tracking of temp directories
-    main.TEMP_DIRECTORIES = []
+
+@pytest.mark.parametrize('existing_dirs', [
+    ['formula-1'],
+    ['formula-1', 'formula-2'],
+    ['formula-1', 'formula-2', 'formula-3'],
+])
+def test_find_tmp_dir_tracking(homebrew_temp, existing_dirs):
+    # Set up multiple formula directories, oldest first
+    for i, d in enumerate(existing_dirs):
+        (homebrew_temp / d).mkdir()
+        os.utime(homebrew_temp / d, ns=(i * 10 ** 9, i * 10 ** 9))
 
     # Each call should find the next directory (not already in TEMP_DIRECTORIES)
     for i, expected_dir in enumerate(existing_dirs):
         result = main.find_tmp_dir('formula')
-        assert expected_dir in result
+        assert result == str(homebrew_temp / expected_dir)
         assert len(main.TEMP_DIRECTORIES) == i + 1
 
     # If called again with no new directories, it should raise an error
@@ -215,6 +831,74 @@ def test_find_tmp_dir_tracking(mock_listdir, mock_isdir, existing_dirs):
         main.find_tmp_dir('formula')
 
 
+def _read_temp_manifest(cache_dir):
+    with open(os.path.join(cache_dir, 'temp-directories.json'), 'r') as f:
+        return json.load(f)
+
+
+def _make_temp_directory(path, size=0, last_used=None):
+    path.mkdir()
+    (path / 'data').write_bytes(os.urandom(size))
+    main.track_temp_directory(str(path))
+    if last_used is not None:
+        with main._temp_manifest() as manifest:
+            manifest[str(path)]['last_used'] = last_used
+    return str(path)
+
+
+def test_track_temp_directory(homebrew_temp, cache_dir, monkeypatch):
+    (homebrew_temp / 'formula-20240101-123-abc').mkdir()
+
+    # nothing is tracked if garbage collection is disabled
+    main.find_tmp_dir('formula')
+    assert not os.path.isfile(os.path.join(cache_dir, 'temp-directories.json'))
+
+    monkeypatch.setenv('INPUT_TEMP_GC_MAX_AGE', '60')
+    (homebrew_temp / 'formula-20240102-123-abc').mkdir()
+    tmp_dir = main.find_tmp_dir('formula')
+    assert list(_read_temp_manifest(cache_dir)) == [tmp_dir]
+    assert _read_temp_manifest(cache_dir)[tmp_dir]['inode'] == os.lstat(tmp_dir).st_ino
+
+
+def test_collect_temp_directories_age(homebrew_temp, cache_dir, monkeypatch):
+    monkeypatch.setenv('INPUT_TEMP_GC_MAX_AGE', '60')
+    old = _make_temp_directory(homebrew_temp / 'old-1', last_used=time.time() - 120)
+    recent = _make_temp_directory(homebrew_temp / 'recent-1')
+    current = _make_temp_directory(homebrew_temp / 'current-1', last_used=time.time() - 120)
+    main.TEMP_DIRECTORIES.append(current)
+
+    # replaced by a directory this action did not create, which has another inode
+    replaced = _make_temp_directory(homebrew_temp / 'replaced-1', last_used=time.time() - 120)
+    with main._temp_manifest() as manifest:
+        manifest[replaced]['inode'] += 1
+
+    untracked = homebrew_temp / 'untracked-1'
+    untracked.mkdir()
+    os.utime(untracked, (0, 0))
+
+    assert main.collect_temp_directories() == [old]
+    assert not os.path.exists(old)
+    for path in (recent, current, replaced, str(untracked)):
+        assert os.path.isdir(path)
+    assert set(_read_temp_manifest(cache_dir)) == {recent, current}
+
+
+def test_collect_temp_directories_size(homebrew_temp, cache_dir, monkeypatch):
+    monkeypatch.setenv('INPUT_TEMP_GC_MAX_SIZE', '1')  # MiB
+    now = time.time()
+    oldest = _make_temp_directory(homebrew_temp / 'a-1', size=400 * 1024, last_used=now - 30)
+    older = _make_temp_directory(homebrew_temp / 'b-1', size=400 * 1024, last_used=now - 20)
+    newest = _make_temp_directory(homebrew_temp / 'c-1', size=400 * 1024, last_used=now - 10)
+
+    assert main.collect_temp_directories() == [oldest]
+    assert os.path.isdir(older)
+    assert os.path.isdir(newest)
+
+
+def test_collect_temp_directories_disabled(homebrew_temp, cache_dir):
+    assert main.collect_temp_directories() == []
+
+
 def test_audit_formula():
     assert main.audit_formula(formula='hello_world')
 
@@ -227,7 +911,7 @@ def test_test_formula():
     assert main.test_formula(formula='hello_world')
 
 
-def test_main(brew_untap, homebrew_core_fork_repo, input_validate):
+def test_main(brew_untap, homebrew_core_fork_repo, input_validate, main_output_files):
     main.args = main._parse_args(args_list=[])
     main.main()
     assert not main.ERROR
@@ -317,6 +1001,7 @@ def test_main(brew_untap, homebrew_core_fork_repo, input_validate):
     ),
 ])
 def test_main_error_cases(
+        main_output_files,
         monkeypatch,
         scenario,
         mocks,
@@ -325,6 +1010,9 @@ def test_main_error_cases(
     # Set up environment for validation
     monkeypatch.setenv('INPUT_VALIDATE', 'true')
 
+    # process_input_formula is mocked, so there is no homebrew-core fork to contribute to
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'false')
+
     # Reset global state
     main.ERROR = False
     main.FAILURES = []
@@ -350,9 +1038,10 @@ def test_main_error_cases(
         assert main.FAILURES == expected_failures
 
 
-def test_main_skip_validate(monkeypatch):
+def test_main_skip_validate(main_output_files, monkeypatch):
     # Set up environment to skip validation
     monkeypatch.setenv('INPUT_VALIDATE', 'false')
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'false')
 
     # Reset global state
     main.ERROR = False
@@ -394,7 +1083,9 @@ def test_prepare_homebrew_core_fork_failure(mock_run, homebrew_core_fork_repo):
 def test_process_input_formula_copy_failure(mock_exists, tmp_path):
     # Create a test formula file
     test_formula = tmp_path / "test_formula.rb"
-    test_formula.write_text("class TestFormula < Formula\nend")
+    test_formula.write_text(
+        'class TestFormula < Formula\n  url "https://example.com/test.git"\n  test do\n    true\n  end\nend'
+    )
 
     # Make the initial file check pass, but the copy verification fail
     # First call (checking if formula exists): True
@@ -430,3 +1121,1447 @@ def test_brew_upgrade_update_failure(mock_run):
     # Verify that brew upgrade was NOT called (execution should stop after update fails)
     upgrade_call_made = any('upgrade' in str(call) for call in mock_run.call_args_list)
     assert not upgrade_call_made
+
+
+def test_expand_formula_files(tmp_path):
+    for name in ['b.rb', 'a.rb', os.path.join('c', 'c.rb'), 'README.md']:
+        os.makedirs(os.path.dirname(tmp_path / name), exist_ok=True)
+        (tmp_path / name).write_text('')
+
+    files = main.expand_formula_files([str(tmp_path), str(tmp_path / '*.rb'), str(tmp_path / 'a.rb')])
+    assert files == [
+        str(tmp_path / 'a.rb'),
+        str(tmp_path / 'b.rb'),
+        str(tmp_path / 'c' / 'c.rb'),
+    ]
+
+    with pytest.raises(FileNotFoundError, match="No formula files found"):
+        main.expand_formula_files([str(tmp_path / '*.txt')])
+
+
+def test_shard_formula_files(capsys):
+    formula_files = [f'Formula/{name}.rb' for name in 'abcdefg']
+    timings = dict(
+        a=dict(install=100, test=20),
+        b=dict(install=60),
+        c=dict(install=50, test=10),
+        d=dict(install=30),
+        e=dict(install=10, test=10),
+        # f and g have no history, and are weighted with the median of 60
+    )
+
+    shards = [main.shard_formula_files(formula_files, i, 3, timings=timings) for i in (1, 2, 3)]
+    assert shards == [
+        ['Formula/a.rb', 'Formula/d.rb'],
+        ['Formula/b.rb', 'Formula/e.rb', 'Formula/f.rb'],
+        ['Formula/c.rb', 'Formula/g.rb'],
+    ]
+    output = capsys.readouterr().out
+    assert f'Shard assignment of 7 formulae with timing database {main.hash_formula_timings(timings)}:\n' in output
+    assert '  2/3 (140s): b.rb, e.rb, f.rb\n' in output
+    assert 'Shard 1/3: 2 of 7 formulae, estimated 150s of 410s' in output
+
+    # the hash identifies the database, not its serialization
+    assert main.hash_formula_timings(dict(reversed(timings.items()))) == main.hash_formula_timings(timings)
+    assert main.hash_formula_timings({**timings, 'f': dict(install=1)}) != main.hash_formula_timings(timings)
+
+    # the assignment does not depend on the input order
+    assert main.shard_formula_files(formula_files[::-1], 2, 3, timings=timings) == shards[1][::-1]
+
+
+def test_shard_formula_files_no_history():
+    formula_files = [f'Formula/{name}.rb' for name in 'abcde']
+    shards = [main.shard_formula_files(formula_files, i, 2, timings={}) for i in (1, 2)]
+    assert shards == [['Formula/a.rb', 'Formula/c.rb', 'Formula/e.rb'], ['Formula/b.rb', 'Formula/d.rb']]
+
+    # more shards than formulae
+    assert main.shard_formula_files(formula_files[:1], 2, 2, timings={}) == []
+
+
+def test_formula_timings(monkeypatch, tmp_path):
+    timing_db = tmp_path / 'cache' / 'timings.json'
+    monkeypatch.setenv('INPUT_TIMING_DB', str(timing_db))
+    assert main.load_formula_timings() == {}
+
+    timing_db.parent.mkdir()
+    timing_db.write_text(json.dumps(dict(foo=dict(install=10, test=1), bar=dict(install=20))))
+
+    main._run_checkpointed('install', lambda formula: True, 'foo')
+    main._run_checkpointed('test', lambda formula: False, 'foo')  # failed phases are not recorded
+    main._run_checkpointed('audit', lambda formula: True, 'foo')  # only install and test are recorded
+    main._run_checkpointed('test', lambda formula: True, 'baz')
+    assert set(main.FORMULA_DURATIONS) == {'foo', 'baz'}
+    assert list(main.FORMULA_DURATIONS['foo']) == ['install']
+
+    main.save_formula_timings()
+    timings = main.load_formula_timings()
+    assert set(timings) == {'foo', 'bar', 'baz'}
+    assert timings['foo']['install'] < 10
+    assert timings['foo']['test'] == 1
+    assert timings['bar'] == dict(install=20)
+    assert list(timings['baz']) == ['test']
+
+    timing_db.write_text('not json')
+    assert main.load_formula_timings() == {}
+
+
+def test_main_shard(main_output_files, monkeypatch, tmp_path):
+    for name in 'abc':
+        (tmp_path / f'{name}.rb').write_text('')
+    monkeypatch.setenv('INPUT_TIMING_DB', str(tmp_path / 'timings.json'))
+    timings = dict(a=dict(install=100), b=dict(install=10))
+    (tmp_path / 'timings.json').write_text(json.dumps(timings))
+
+    with patch('action.main.is_brew_installed', return_value=True), \
+            patch('action.main.validate_batch') as mock_validate:
+        main.args = main._parse_args(args_list=['--formulae', str(tmp_path), '--shard', '2/2'])
+        main._main()
+        mock_validate.assert_called_once_with(
+            formula_files=[str(tmp_path / 'b.rb'), str(tmp_path / 'c.rb')],
+            max_workers=main.args.max_workers,
+        )
+        with open(os.environ['GITHUB_OUTPUT']) as f:
+            assert f'timing_db_hash<<EOF\n{main.hash_formula_timings(timings)}\nEOF\n' in f.read()
+
+        # no formulae in the shard
+        mock_validate.reset_mock()
+        main.args = main._parse_args(args_list=['--formulae', str(tmp_path / 'a.rb'), '--shard', '2/2'])
+        main._main()
+        mock_validate.assert_not_called()
+
+
+@pytest.fixture(scope='function')
+def batch_results():
+    main.ERROR = False
+    main.FORMULA_RESULTS = {}
+    yield main.FORMULA_RESULTS
+    main.FORMULA_RESULTS = {}
+
+
+def test_validate_batch(github_output_file, batch_results, monkeypatch):
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'false')
+    monkeypatch.setenv('INPUT_VALIDATE', 'true')
+
+    def validate(formula, audit_result=None):
+        assert audit_result is (formula != 'baz')
+        return ([] if audit_result else ['audit']) + (['test'] if formula == 'bar' else [])
+
+    with patch.multiple(
+            main,
+            process_input_formula=lambda formula_file: os.path.basename(formula_file).split('.')[0],
+            brew_upgrade=lambda *args, **kwargs: True,
+            brew_debug=lambda *args, **kwargs: True,
+            audit_formulae=lambda formulae: {formula: formula != 'baz' for formula in formulae},
+            fetch_formulae=lambda formulae: {formula: formula != 'qux' for formula in formulae},
+            validate_formula=validate,
+    ):
+        with pytest.raises(SystemExit):
+            main.validate_batch(formula_files=['foo.rb', 'bar.rb', 'baz.rb', 'qux.rb'], max_workers=2)
+
+    assert batch_results == {'foo': [], 'bar': ['test'], 'baz': ['audit'], 'qux': ['fetch']}
+    assert list(batch_results) == ['foo', 'bar', 'baz', 'qux']
+    assert main.ERROR
+
+    with open(github_output_file, 'r') as f:
+        output = f.read()
+    assert '"bar": {"failures": ["test"]' in output
+
+
+def _write_dependent_formulae(directory, dependencies):
+    formula_files = []
+    for formula, depends_on in dependencies.items():
+        formula_file = directory / f'{formula}.rb'
+        formula_file.write_text(
+            f'class {main.get_formula_class_name(formula)} < Formula\n'
+            + ''.join(f'  depends_on "{name}"\n' for name in depends_on)
+            + '  depends_on "cmake" => :build\n'
+            + 'end\n'
+        )
+        formula_files.append(str(formula_file))
+    return formula_files
+
+
+def test_get_formula_dependency_levels(tmp_path):
+    formula_files = _write_dependent_formulae(tmp_path, dict(
+        tool=['homebrew-release-action/homebrew-test/app'],
+        app=['lib'],
+        lib=[],
+        other=['org/homebrew/lib'],  # brew installs this from the org tap, not the temp tap
+    ))
+    files = {os.path.basename(f).split('.')[0]: f for f in formula_files}
+
+    levels, dependencies = main.get_formula_dependency_levels(files)
+    assert levels == [['lib', 'other'], ['app'], ['tool']]
+    assert dependencies == dict(tool={'app'}, app={'lib'}, lib=set(), other=set())
+
+    _write_dependent_formulae(tmp_path, dict(lib=['tool']))
+    with pytest.raises(ValueError, match=r"\['app', 'lib', 'tool'\] have a dependency cycle"):
+        main.get_formula_dependency_levels(files)
+
+
+@pytest.mark.parametrize('dependency_order', [True, False])
+def test_validate_batch_dependency_order(github_output_file, batch_results, monkeypatch, tmp_path, dependency_order):
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'false')
+    monkeypatch.setenv('INPUT_VALIDATE', 'true')
+    monkeypatch.setenv('INPUT_BATCH_BREW_COMMANDS', 'false')
+    monkeypatch.setenv('INPUT_DEPENDENCY_ORDER', str(dependency_order).lower())
+
+    formula_files = _write_dependent_formulae(tmp_path, dict(
+        tool=['app'],
+        app=['lib'],
+        lib=[],
+        other=[],
+    ))
+
+    validated = []
+
+    def validate(formula, audit_result=None):
+        validated.append(formula)
+        return ['install'] if formula == 'lib' else []
+
+    with patch.multiple(
+            main,
+            process_input_formula=lambda formula_file: os.path.basename(formula_file).split('.')[0],
+            brew_upgrade=lambda *args, **kwargs: True,
+            brew_debug=lambda *args, **kwargs: True,
+            validate_formula=validate,
+    ):
+        with pytest.raises(SystemExit):
+            main.validate_batch(formula_files=formula_files, max_workers=1)
+
+    assert list(batch_results) == ['tool', 'app', 'lib', 'other']
+    if dependency_order:
+        # the dependents of the failed lib are skipped
+        assert validated == ['lib', 'other']
+        assert batch_results == dict(tool=['dependencies'], app=['dependencies'], lib=['install'], other=[])
+    else:
+        assert validated == ['tool', 'app', 'lib', 'other']
+        assert batch_results == dict(tool=[], app=[], lib=['install'], other=[])
+
+
+def test_validate_batch_exception(github_output_file, batch_results, monkeypatch):
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'false')
+    monkeypatch.setenv('INPUT_VALIDATE', 'true')
+
+    monkeypatch.setenv('INPUT_BATCH_BREW_COMMANDS', 'false')
+
+    def validate(formula, audit_result=None):
+        assert audit_result is None
+        raise FileNotFoundError('::error:: Could not find temp directory')
+
+    with patch.multiple(
+            main,
+            process_input_formula=lambda formula_file: formula_file,
+            brew_upgrade=lambda *args, **kwargs: True,
+            brew_debug=lambda *args, **kwargs: True,
+            validate_formula=validate,
+    ):
+        with pytest.raises(SystemExit):
+            main.validate_batch(formula_files=['foo'], max_workers=1)
+
+    assert batch_results == {'foo': ['validate']}
+
+
+AUDIT_OUTPUT = [
+    'homebrew-release-action/homebrew-test/foo\n',
+    '  * line 5, col 3: Description should not end with a full stop\n',
+    '  * Stable: version 1.0 is redundant with version scanned from URL\n',
+    'baz\n',
+    '  * line 2, col 1: Formula should have a homepage\n',
+    'Error: 3 problems in 2 formulae detected.\n',
+]
+
+
+def test_parse_audit_output():
+    problems = main.parse_audit_output(output=AUDIT_OUTPUT, formulae=['foo', 'bar', 'baz'])
+    assert problems == {
+        'foo': [
+            'line 5, col 3: Description should not end with a full stop',
+            'Stable: version 1.0 is redundant with version scanned from URL',
+        ],
+        'bar': [],
+        'baz': ['line 2, col 1: Formula should have a homepage'],
+    }
+
+
+@pytest.mark.parametrize('output, run_results, expected', [
+    ([], [True], {'foo': True, 'bar': True, 'baz': True}),
+    (AUDIT_OUTPUT, [False], {'foo': False, 'bar': True, 'baz': False}),
+    # the failure is not attributable, each formula is audited
+    (['Error: Invalid usage\n'], [False, True, False, True], {'foo': True, 'bar': False, 'baz': True}),
+    # the failed batch audit does not count once every formula passed on its own
+    (['Error: Invalid usage\n'], [False, True, True, True], {'foo': True, 'bar': True, 'baz': True}),
+])
+def test_audit_formulae(output, run_results, expected):
+    calls = []
+
+    def run(args_list, line_callback=None, set_error=True, **kwargs):
+        calls.append(args_list)
+        if line_callback:
+            for line in output:
+                line_callback(line)
+        if not run_results[len(calls) - 1] and set_error:
+            main.ERROR = True
+        return run_results[len(calls) - 1]
+
+    with patch.object(main, '_run_subprocess', side_effect=run):
+        assert main.audit_formulae(['foo', 'bar', 'baz']) == expected
+
+    assert main.ERROR is not all(expected.values())
+
+    assert len(calls) == len(run_results)
+    assert calls[0][-3:] == [os.path.join(main.temp_repo, formula) for formula in ('foo', 'bar', 'baz')]
+
+
+@pytest.mark.parametrize('run_results, expected', [
+    ([True], {'foo': True, 'bar': True}),
+    ([False, True, False], {'foo': True, 'bar': False}),
+    ([False, True, True], {'foo': True, 'bar': True}),
+])
+def test_fetch_formulae(run_results, expected):
+    results = iter(run_results)
+
+    def run(set_error=True, **kwargs):
+        result = next(results)
+        if not result and set_error:
+            main.ERROR = True
+        return result
+
+    with patch.object(main, '_run_subprocess', side_effect=run) as mock_run:
+        assert main.fetch_formulae(['foo', 'bar']) == expected
+
+    assert mock_run.call_count == len(run_results)
+    assert main.ERROR is not all(expected.values())
+    assert mock_run.call_args_list[0].kwargs['args_list'][:2] == ['brew', 'fetch']
+
+
+def test_run_subprocess_set_error(capsys):
+    args_list = [sys.executable, '-c', 'raise SystemExit(1)']
+    assert not main._run_subprocess(args_list=args_list, set_error=False)
+    assert not main.ERROR
+    assert '::warning:: Process' in capsys.readouterr().out
+
+    # a failure handled by one step does not clear the failure of another
+    main.ERROR = True
+    with patch.object(main, '_run_subprocess', side_effect=[False, True, True]):
+        assert main.fetch_formulae(['foo', 'bar']) == {'foo': True, 'bar': True}
+    assert main.ERROR
+
+
+def test_print_status(capsys):
+    with main._output_prefix('[foo] '):
+        main._print_status('Running `brew config`')
+        main._print_status('::error:: failed')
+
+    assert capsys.readouterr().out == '[foo] Running `brew config`\n::error:: failed\n'
+
+
+def test_run_subprocess_line_callback():
+    lines = []
+    assert main._run_subprocess(
+        args_list=[sys.executable, '-c', 'print("foo"); print("bar")'],
+        line_callback=lines.append,
+    )
+    assert lines == ['foo\n', 'bar\n']
+
+
+VERBOSE_OUTPUT = (
+    'import sys\n'
+    'for i in range(50):\n'
+    '    print(f"line {i}")\n'
+    '    if i == 10:\n'
+    '        print("Warning: something happened")\n'
+    'sys.exit(int(sys.argv[1]))\n'
+)
+
+
+@pytest.mark.parametrize('exit_code', [0, 1])
+def test_run_subprocess_collapsed(capsys, tmp_path, monkeypatch, exit_code):
+    monkeypatch.setenv('INPUT_LOG_MODE', 'collapsed')
+    monkeypatch.setenv('INPUT_LOG_DIR', str(tmp_path / 'logs'))
+
+    @main._traced
+    def phase(formula):
+        return main._run_subprocess(args_list=[sys.executable, '-c', VERBOSE_OUTPUT, str(exit_code)])
+
+    assert phase(formula='foo') is (exit_code == 0)
+
+    log_file = tmp_path / 'logs' / 'phase-foo.log'
+    log = log_file.read_text()
+    assert log.startswith(f'$ {sys.executable} -c')
+    assert 'line 0\nline 1\n' in log
+    assert 'line 49\n' in log
+
+    output = capsys.readouterr().out
+    assert '::group::phase (foo): ' in output
+    assert 'Warning: something happened\n' in output
+    assert f'Wrote 51 lines to {log_file}' in output
+    if exit_code == 0:
+        assert 'line 49\n' in output
+        assert 'line 29\n' not in output
+        assert 'line 0\n' not in output
+    else:
+        assert '::group::Full log of phase-foo.log\n' in output
+        assert 'line 0\n' in output
+
+
+def test_run_subprocess_collapsed_prefix(capsys, tmp_path, monkeypatch):
+    monkeypatch.setenv('INPUT_LOG_MODE', 'collapsed')
+    monkeypatch.setenv('INPUT_LOG_DIR', str(tmp_path / 'logs'))
+
+    with main._output_prefix('[foo] '):
+        assert main._run_subprocess(args_list=[sys.executable, '-c', VERBOSE_OUTPUT, '0'])
+
+    output = capsys.readouterr().out
+    assert '::group::' not in output
+    assert '[foo] Warning: something happened\n' in output
+    assert len(os.listdir(tmp_path / 'logs')) == 1
+
+
+def test_run_steps_collapsed(capsys, tmp_path, monkeypatch):
+    monkeypatch.setenv('INPUT_LOG_MODE', 'collapsed')
+    monkeypatch.setenv('INPUT_LOG_DIR', str(tmp_path / 'logs'))
+    monkeypatch.delenv('INPUT_MAX_CONCURRENCY', raising=False)
+
+    @main._traced
+    def validate(formula):
+        return main._run_subprocess(args_list=[sys.executable, '-c', VERBOSE_OUTPUT, '0'])
+
+    def echo(text):
+        return lambda: main._run_subprocess(args_list=[sys.executable, '-c', f'print("{text}")'])
+
+    # like single formula mode, the setup steps overlap, and validate runs alone
+    steps = [
+        main.Step(name='upgrade', func=echo('upgraded')),
+        main.Step(name='prefetch', func=echo('prefetched')),
+        main.Step(name='validate', func=lambda: validate(formula='foo'), requires=('upgrade', 'prefetch')),
+    ]
+    assert main.get_max_concurrency() == 2
+    assert all(main.run_steps(steps=steps, max_concurrency=main.get_max_concurrency()).values())
+
+    output = capsys.readouterr().out
+    assert '[upgrade] upgraded\n' in output
+    assert '[prefetch] prefetched\n' in output
+    assert '::group::validate (foo): ' in output
+    assert output.count('::group::') == 1
+    assert '\nWarning: something happened\n' in output
+
+
+@pytest.fixture(scope='function')
+def formula_files(monkeypatch):
+    formula_file = os.path.join(os.environ['GITHUB_WORKSPACE'], 'Formula', 'hello_world.rb')
+    monkeypatch.setattr(main, 'FORMULA_FILES', dict(hello_world=formula_file))
+    return formula_file
+
+
+@pytest.mark.parametrize('args_list, output, expected', [
+    (
+        ['brew', 'install'],
+        [
+            'src/main.c:12:5: error: use of undeclared identifier \'foo\'',
+            'src/main.c:12:5: error: use of undeclared identifier \'foo\'',
+            'src/util.c:3: warning: unused variable \'bar\'',
+            'make: *** [main.o] Error 1',
+        ],
+        [
+            ('error', 'src/main.c', '12', 'use of undeclared identifier \'foo\''),
+            ('warning', 'src/util.c', '3', 'unused variable \'bar\''),
+        ],
+    ),
+    (
+        ['brew', 'install'],
+        [
+            '/usr/bin/ld: main.o: in function `main\':',
+            '/usr/bin/ld: main.c:(.text+0x5): undefined reference to `foo\'',
+            'collect2: error: ld returned 1 exit status',
+            'Undefined symbols for architecture arm64:',
+        ],
+        [
+            ('error', None, None, 'undefined reference to `foo\''),
+            ('error', None, None, 'ld returned 1 exit status'),
+            ('error', None, None, 'Undefined symbols for architecture arm64:'),
+        ],
+    ),
+    (
+        ['brew', 'test'],
+        [
+            'Testing homebrew-release-action/homebrew-test/hello_world',
+            'An exception occurred within a child process:',
+            '  Minitest::Assertion: Expected path "dummy.txt" to exist.',
+            '/opt/homebrew/Library/Taps/homebrew-release-action/homebrew-test/Formula/h/hello_world.rb:31:in `block\'',
+            '/opt/homebrew/Library/Homebrew/test.rb:40:in `<main>\'',
+            'Error: hello_world: failed',
+        ],
+        [
+            (
+                'error',
+                os.path.join('Formula', 'hello_world.rb'),
+                '31',
+                'Minitest::Assertion: Expected path "dummy.txt" to exist.',
+            ),
+            ('error', None, None, 'hello_world: failed'),
+        ],
+    ),
+    (
+        ['brew', 'audit'],
+        [
+            'homebrew-release-action/homebrew-test/hello_world',
+            '  * line 5, col 3: Description should not end with a full stop',
+            '  * Stable: version 0.0.1 is redundant with version scanned from URL',
+            'Error: 2 problems in 1 formula detected.',
+        ],
+        [
+            ('error', os.path.join('Formula', 'hello_world.rb'), '5', 'Description should not end with a full stop'),
+            (
+                'error',
+                os.path.join('Formula', 'hello_world.rb'),
+                '1',
+                'Stable: version 0.0.1 is redundant with version scanned from URL',
+            ),
+            ('error', None, None, '2 problems in 1 formula detected.'),
+        ],
+    ),
+])
+def test_problem_matcher(formula_files, args_list, output, expected):
+    matcher = main._ProblemMatcher(args_list=args_list)
+    for line in output:
+        matcher.feed(f'{line}\n')
+    assert list(matcher.problems) == expected
+
+
+def test_problem_matcher_emit(capsys, monkeypatch):
+    monkeypatch.setattr(main, 'PROBLEM_MATCHER_MAX_ANNOTATIONS', 2)
+    matcher = main._ProblemMatcher(args_list=['brew', 'install'])
+    for i in range(3):
+        matcher.feed(f'src/main.c:{i + 1}:1: error: problem {i}\n')
+    matcher.feed('Warning: something\n')
+    matcher.emit()
+
+    assert capsys.readouterr().out == (
+        '::error file=src/main.c,line=1::problem 0\n'
+        '::error file=src/main.c,line=2::problem 1\n'
+        '::warning::something\n'
+        '1 more errors were not annotated\n'
+    )
+
+
+@pytest.mark.parametrize('enabled', [True, False])
+def test_run_subprocess_problem_matcher(capsys, monkeypatch, enabled):
+    monkeypatch.setenv('INPUT_PROBLEM_MATCHER', str(enabled).lower())
+    with main._output_prefix('[foo] '):
+        main._run_subprocess(
+            args_list=[sys.executable, '-c', 'import sys; print("a.c:1:2: error: oops"); sys.exit(1)'],
+        )
+
+    output = capsys.readouterr().out
+    assert '[foo] a.c:1:2: error: oops\n' in output
+    assert ('\n::error file=a.c,line=1::oops\n' in output) is enabled
+
+
+@pytest.mark.parametrize('exit_code, ignore_error, expected', [
+    (0, False, '::error file=a.c,line=1::oops\n'),
+    (1, False, '::error file=a.c,line=1::oops\n::warning::something\n'),
+    (1, True, ''),
+])
+def test_run_subprocess_problem_matcher_failed(capsys, exit_code, ignore_error, expected):
+    code = f'import sys; print("a.c:1:2: error: oops"); print("Warning: something"); sys.exit({exit_code})'
+    main._run_subprocess(args_list=[sys.executable, '-c', code], ignore_error=ignore_error)
+
+    output = capsys.readouterr().out
+    annotations = [line for line in output.splitlines() if line.startswith(('::error file', '::warning'))]
+    assert ''.join(f'{line}\n' for line in annotations) == expected
+
+
+def test_get_log_mode_invalid(monkeypatch):
+    monkeypatch.setenv('INPUT_LOG_MODE', 'quiet')
+    with pytest.raises(ValueError, match='Invalid log mode'):
+        main.get_log_mode()
+
+
+def test_validate_batch_duplicate(monkeypatch):
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'false')
+
+    with patch.object(main, 'process_input_formula', return_value='foo'):
+        with pytest.raises(ValueError, match="more than once"):
+            main.validate_batch(formula_files=['a/foo.rb', 'b/foo.rb'], max_workers=1)
+
+
+def test_validate_batch_contribute_to_homebrew_core(monkeypatch):
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'true')
+
+    with pytest.raises(SystemExit):
+        main.validate_batch(formula_files=['foo.rb'], max_workers=1)
+
+
+@pytest.fixture(scope='function')
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('INPUT_CACHE_DIR', str(tmp_path / 'cache'))
+    yield str(tmp_path / 'cache')
+
+
+def test_get_cache_dir(cache_dir):
+    assert main.get_cache_dir() == cache_dir
+    assert os.path.isdir(cache_dir)
+
+
+@pytest.fixture(scope='function')
+def brew_probe():
+    stdout = (
+        'version=Homebrew 4.0.0\n'
+        'repository=/opt/homebrew\n'
+        'prefix=/opt/homebrew\n'
+        'cache=/tmp/brew-cache\n'
+        'devcmdrun=true\n'
+    )
+    with patch('subprocess.run') as mock_run:
+        mock_run.return_value = subprocess.CompletedProcess(args=[], returncode=0, stdout=stdout.encode(), stderr=b'')
+        yield mock_run
+
+
+def test_get_brew_environment(brew_probe):
+    environment = main.get_brew_environment()
+    assert environment['version'] == 'Homebrew 4.0.0'
+    assert environment['repository'] == '/opt/homebrew'
+    assert environment['prefix'] == '/opt/homebrew'
+    assert environment['cache'] == '/tmp/brew-cache'
+    assert environment['developer'] is True
+
+    # memoized
+    assert main.get_brew_version() == 'Homebrew 4.0.0'
+    assert main.get_brew_repository() == '/opt/homebrew'
+    assert main.is_brew_installed()
+    assert brew_probe.call_count == 1
+
+    main.get_brew_environment(refresh=True)
+    assert brew_probe.call_count == 2
+
+    main.invalidate_brew_environment()
+    main.get_brew_environment()
+    assert brew_probe.call_count == 3
+
+
+def test_get_brew_environment_not_installed():
+    with patch('subprocess.run') as mock_run:
+        mock_run.return_value = subprocess.CompletedProcess(args=[], returncode=0, stdout=b'version=\n', stderr=b'')
+        assert main.get_brew_version() == ''
+        assert not main.is_brew_installed()
+
+
+@pytest.mark.parametrize('run_id, expected_calls', [
+    ('1', 1),
+    ('2', 2),
+])
+def test_get_brew_environment_cache(brew_probe, cache_dir, monkeypatch, run_id, expected_calls):
+    monkeypatch.setenv('INPUT_BREW_ENVIRONMENT_CACHE', 'true')
+    monkeypatch.setenv('GITHUB_RUN_ID', '1')
+    main.get_brew_environment()
+    assert os.path.isfile(os.path.join(cache_dir, 'brew-environment.json'))
+
+    # a later step of the same run reuses the stored environment
+    main._BREW_ENVIRONMENT = None
+    monkeypatch.setenv('GITHUB_RUN_ID', run_id)
+    assert main.get_brew_environment()['version'] == 'Homebrew 4.0.0'
+    assert brew_probe.call_count == expected_calls
+
+
+@patch('action.main.get_brew_repository_head')
+def test_brew_update_stamp(mock_head, cache_dir):
+    mock_head.return_value = 'abc'
+    assert not main.is_brew_update_fresh(max_age=60)
+
+    main.write_brew_update_stamp()
+    assert main.is_brew_update_fresh(max_age=60)
+
+    # the repository was updated by something else
+    mock_head.return_value = 'def'
+    assert not main.is_brew_update_fresh(max_age=60)
+
+    # the stamp is too old
+    mock_head.return_value = 'abc'
+    with patch('time.time', return_value=time.time() + 120):
+        assert not main.is_brew_update_fresh(max_age=60)
+
+
+@pytest.mark.parametrize('fresh, expected_status', [
+    (True, 'cached'),
+    (False, 'updated'),
+])
+@patch('action.main.write_brew_update_stamp')
+@patch('action.main.is_brew_update_fresh')
+@patch('action.main._run_subprocess')
+def test_brew_upgrade_update_cache(
+        mock_run,
+        mock_fresh,
+        mock_stamp,
+        github_output_file,
+        monkeypatch,
+        fresh,
+        expected_status,
+):
+    monkeypatch.setenv('INPUT_BREW_UPDATE_MAX_AGE', '600')
+    mock_run.return_value = True
+    mock_fresh.return_value = fresh
+
+    assert main.brew_upgrade()
+
+    update_call_made = any('update' in str(call) for call in mock_run.call_args_list)
+    assert update_call_made != fresh
+    assert mock_stamp.called != fresh
+
+    with open(github_output_file, 'r') as f:
+        assert f'brew_update<<EOF\n{expected_status}\nEOF\n' in f.read()
+
+
+@pytest.mark.parametrize('dependencies, outdated, expected_upgrade', [
+    (['openssl@3', 'foo/bar/baz', 'cmake'], ['cmake', 'git', 'baz'], ['cmake', 'baz']),
+    (['openssl@3'], ['git'], None),
+    ([], ['git'], None),
+    (None, ['git'], None),
+    (['openssl@3'], None, None),
+])
+@patch('action.main.get_outdated_formulae')
+@patch('action.main.get_formula_dependencies')
+@patch('action.main._run_subprocess')
+def test_brew_upgrade_scoped(
+        mock_run,
+        mock_dependencies,
+        mock_outdated,
+        github_output_file,
+        monkeypatch,
+        dependencies,
+        outdated,
+        expected_upgrade,
+):
+    monkeypatch.setenv('INPUT_UPGRADE_MODE', 'scoped')
+    mock_run.return_value = True
+    mock_dependencies.return_value = dependencies
+    mock_outdated.return_value = outdated
+
+    assert main.brew_upgrade(formulae=['hello_world'])
+    mock_dependencies.assert_called_once_with(formulae=['hello_world'])
+
+    upgrade_calls = [c.kwargs['args_list'] for c in mock_run.call_args_list if 'upgrade' in c.kwargs['args_list']]
+    if expected_upgrade is None:
+        assert not upgrade_calls
+    else:
+        assert upgrade_calls == [['brew', 'upgrade', '--formula'] + expected_upgrade]
+
+
+@patch('action.main._run_subprocess')
+def test_brew_upgrade_full(mock_run, github_output_file, monkeypatch):
+    monkeypatch.setenv('INPUT_UPGRADE_MODE', 'full')
+    mock_run.return_value = True
+
+    assert main.brew_upgrade(formulae=['hello_world'])
+    assert mock_run.call_args_list[-1].kwargs['args_list'] == ['brew', 'upgrade']
+
+
+@patch('action.main._run_subprocess')
+def test_brew_upgrade_invalid_mode(mock_run, github_output_file, monkeypatch):
+    monkeypatch.setenv('INPUT_UPGRADE_MODE', 'foo')
+    mock_run.return_value = True
+
+    with pytest.raises(ValueError, match="Unknown upgrade mode"):
+        main.brew_upgrade(formulae=['hello_world'])
+
+
+@patch('subprocess.run')
+def test_get_formula_dependencies(mock_run):
+    mock_run.return_value = subprocess.CompletedProcess(args=[], returncode=0, stdout=b'cmake\nfoo/bar/baz\n')
+    assert main.get_formula_dependencies(formulae=['hello_world']) == ['cmake', 'foo/bar/baz']
+    assert os.path.join(main.temp_repo, 'hello_world') in mock_run.call_args.kwargs['args']
+
+    mock_run.return_value = subprocess.CompletedProcess(args=[], returncode=1, stdout=b'', stderr=b'Error')
+    assert main.get_formula_dependencies(formulae=['hello_world']) is None
+
+
+@pytest.mark.parametrize('concurrent_audit', ['true', 'false'])
+@pytest.mark.parametrize('results, expected_failures', [
+    ((True, True, True), []),
+    ((False, True, True), ['audit']),
+    ((True, False, False), ['install', 'test']),
+    ((False, False, False), ['audit', 'install', 'test']),
+])
+def test_validate_formula(monkeypatch, concurrent_audit, results, expected_failures):
+    monkeypatch.setenv('INPUT_CONCURRENT_AUDIT', concurrent_audit)
+    calls = {}
+
+    def phase(name, result):
+        def run(formula):
+            calls[name] = (threading.current_thread(), getattr(main._OUTPUT_CONTEXT, 'prefix', ''))
+            return result
+        return run
+
+    with patch.multiple(
+            main,
+            audit_formula=phase('audit', results[0]),
+            install_formula=phase('install', results[1]),
+            test_formula=phase('test', results[2]),
+    ):
+        with main._output_prefix('[foo] '):
+            assert main.validate_formula('foo') == expected_failures
+
+    if concurrent_audit == 'true':
+        assert calls['audit'][0] != threading.current_thread()
+        assert calls['audit'][1] == '[foo] [audit] '
+        assert calls['install'][1] == '[foo] [install] '
+        assert calls['test'][1] == '[foo] [test] '
+    else:
+        assert all(thread == threading.current_thread() for thread, _ in calls.values())
+        assert all(prefix == '[foo] ' for _, prefix in calls.values())
+
+
+@pytest.fixture(scope='function')
+def result_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('INPUT_RESULT_CACHE_DIR', str(tmp_path / 'results'))
+    monkeypatch.setenv('INPUT_FORCE_VALIDATE', 'false')
+    main.CACHED_FORMULAE = set()
+
+    formula_file = tmp_path / 'foo.rb'
+    formula_file.write_text('class Foo < Formula\nend\n')
+
+    with patch.multiple(
+            main,
+            get_brew_version=lambda: 'Homebrew 4.0.0',
+            get_brew_repository=lambda: str(tmp_path / 'brew'),
+            get_brew_repository_head=lambda: 'abc',
+    ):
+        yield str(formula_file)
+
+    main.CACHED_FORMULAE = set()
+
+
+def test_get_result_cache_key(result_cache):
+    key = main.get_result_cache_key(result_cache)
+    assert key == main.get_result_cache_key(result_cache)
+
+    with patch.object(main, 'get_brew_version', return_value='Homebrew 4.0.1'):
+        assert main.get_result_cache_key(result_cache) != key
+
+    with open(result_cache, 'a') as f:
+        f.write('# changed\n')
+    assert main.get_result_cache_key(result_cache) != key
+
+
+def test_validate_formula_cached(github_output_file, result_cache, monkeypatch):
+    main.BUILDPATHS['foo'] = '/tmp/foo-build'
+    main.TESTPATHS['foo'] = '/tmp/foo-test'
+
+    with patch.object(main, 'validate_formula', return_value=[]) as mock_validate:
+        # first run validates and stores the result
+        assert main.validate_formula_cached(formula='foo', formula_file=result_cache) == []
+        assert mock_validate.call_count == 1
+        assert 'foo' not in main.CACHED_FORMULAE
+
+        # second run replays the result
+        assert main.validate_formula_cached(formula='foo', formula_file=result_cache) == []
+        assert mock_validate.call_count == 1
+        assert 'foo' in main.CACHED_FORMULAE
+
+        # forced revalidation
+        monkeypatch.setenv('INPUT_FORCE_VALIDATE', 'true')
+        assert main.validate_formula_cached(formula='foo', formula_file=result_cache) == []
+        assert mock_validate.call_count == 2
+
+    with open(github_output_file, 'r') as f:
+        output = f.read()
+    assert 'buildpath<<EOF\n/tmp/foo-build\nEOF\n' in output
+    assert 'testpath<<EOF\n/tmp/foo-test\nEOF\n' in output
+
+
+def test_validate_formula_cached_failure(result_cache):
+    with patch.object(main, 'validate_formula', return_value=['test']) as mock_validate:
+        assert main.validate_formula_cached(formula='foo', formula_file=result_cache) == ['test']
+        assert main.validate_formula_cached(formula='foo', formula_file=result_cache) == ['test']
+        assert mock_validate.call_count == 2
+
+
+def test_validate_formula_cached_disabled(result_cache, monkeypatch):
+    monkeypatch.delenv('INPUT_RESULT_CACHE_DIR')
+
+    with patch.object(main, 'validate_formula', return_value=[]) as mock_validate:
+        main.validate_formula_cached(formula='foo', formula_file=result_cache)
+        main.validate_formula_cached(formula='foo', formula_file=result_cache)
+        assert mock_validate.call_count == 2
+
+
+@pytest.fixture(scope='function')
+def checkpoint(tmp_path, monkeypatch):
+    formula_file = tmp_path / 'foo.rb'
+    formula_file.write_text('class Foo < Formula\nend\n')
+    buildpath = tmp_path / 'foo-build'
+    buildpath.mkdir()
+
+    monkeypatch.setattr(main, 'get_result_cache_key', lambda formula_file: 'key')
+    monkeypatch.setattr(main, 'is_formula_installed', lambda formula: True)
+    monkeypatch.setattr(main, 'BUILDPATHS', {})
+    monkeypatch.setattr(main, 'CHECKPOINT', None)
+    monkeypatch.setattr(main, 'HOMEBREW_BUILDPATH', '')
+
+    def make():
+        return main.Checkpoint(formula='foo', formula_file=str(formula_file), path=str(tmp_path / 'checkpoint.json'))
+
+    yield make, str(buildpath)
+
+
+def test_checkpoint(checkpoint, monkeypatch):
+    make, buildpath = checkpoint
+
+    first = make()
+    for phase in ('upgrade', 'debug', 'audit'):
+        first.complete(phase)
+    first.complete('install', buildpath=buildpath)
+
+    resumed = make()
+    assert resumed.resume() == ['upgrade', 'debug', 'audit', 'install']
+    assert resumed.completed['install'] == dict(buildpath=buildpath)
+    assert not resumed.is_done('test')
+
+    # the keg is gone, so the install and later phases run again
+    monkeypatch.setattr(main, 'is_formula_installed', lambda formula: False)
+    assert make().resume() == ['upgrade', 'debug', 'audit']
+
+    # Homebrew or the formula changed
+    monkeypatch.setattr(main, 'get_result_cache_key', lambda formula_file: 'other')
+    assert make().resume() == []
+
+    first.remove()
+    assert make().resume() == []
+
+
+def test_checkpoint_prefix(checkpoint):
+    make, buildpath = checkpoint
+
+    # phases after the first incomplete phase are not skipped
+    first = make()
+    first.complete('upgrade')
+    first.complete('audit')
+    assert make().resume() == ['upgrade']
+
+
+def test_validate_formula_resume(github_output_file, checkpoint, monkeypatch):
+    make, buildpath = checkpoint
+    first = make()
+    for phase in ('upgrade', 'debug', 'audit'):
+        first.complete(phase)
+    first.complete('install', buildpath=buildpath)
+
+    main.CHECKPOINT = make()
+    main.CHECKPOINT.resume()
+    calls = []
+
+    def phase(name, result):
+        def run(formula):
+            calls.append(name)
+            return result
+        return run
+
+    with patch.multiple(
+            main,
+            audit_formula=phase('audit', True),
+            install_formula=phase('install', True),
+            test_formula=phase('test', False),
+    ):
+        assert main.validate_formula('foo') == ['test']
+
+    assert calls == ['test']
+    assert main.HOMEBREW_BUILDPATH == buildpath
+    assert main.BUILDPATHS['foo'] == buildpath
+    assert not main.CHECKPOINT.is_done('test')
+
+    with open(github_output_file, 'r') as f:
+        assert f'buildpath<<EOF\n{buildpath}\nEOF\n' in f.read()
+
+
+def test_get_upstream_homebrew_core_url(tmp_path, monkeypatch):
+    monkeypatch.setenv('INPUT_UPSTREAM_HOMEBREW_CORE_REPO', 'Homebrew/homebrew-core')
+    assert main.get_upstream_homebrew_core_url() == 'https://github.com/Homebrew/homebrew-core'
+
+    monkeypatch.setenv('INPUT_UPSTREAM_HOMEBREW_CORE_REPO', 'https://example.com/homebrew-core.git')
+    assert main.get_upstream_homebrew_core_url() == 'https://example.com/homebrew-core.git'
+
+    monkeypatch.setenv('INPUT_UPSTREAM_HOMEBREW_CORE_REPO', str(tmp_path))
+    assert main.get_upstream_homebrew_core_url() == f'file://{tmp_path}'
+
+
+def _list_files(path):
+    return sorted(
+        os.path.relpath(os.path.join(root, f), path).replace(os.sep, '/')
+        for root, dirs, files in os.walk(path) if '.git' not in root.split(os.sep)
+        for f in files
+    )
+
+
+@pytest.mark.parametrize('sparse_paths, expected_files', [
+    (None, ['Formula/a/aaa.rb', 'Formula/h/hello_world.rb', 'Formula/z/zzz.rb', 'README.md']),
+    (['Formula/h/hello_world.rb'], ['Formula/h/hello_world.rb']),
+])
+def test_prepare_homebrew_core_fork_local(github_output_file, local_homebrew_core, sparse_paths, expected_files):
+    main.prepare_homebrew_core_fork(
+        branch_suffix='hello_world',
+        path=local_homebrew_core['fork'],
+        sparse_paths=sparse_paths,
+    )
+    assert not main.ERROR
+
+    branch = get_current_branch(cwd=local_homebrew_core['fork'])
+    assert branch == 'homebrew-release-action/hello_world'
+
+    assert _list_files(local_homebrew_core['fork']) == expected_files
+
+    with open(os.path.join(local_homebrew_core['fork'], 'Formula', 'h', 'hello_world.rb'), 'r') as f:
+        assert f.read() == '# Formula/h/hello_world.rb v2\n'
+
+    if sparse_paths:
+        # the blobs of the other updated formulae were never fetched
+        missing = subprocess.run(
+            ['git', 'rev-list', '--objects', '--missing=print', 'upstream/master'],
+            cwd=local_homebrew_core['fork'],
+            capture_output=True,
+        ).stdout.decode('utf-8').split()
+        assert len([obj for obj in missing if obj.startswith('?')]) == 2
+
+
+def test_update_homebrew_core_mirror(local_homebrew_core, tmp_path):
+    mirror = str(tmp_path / 'mirror' / 'homebrew-core.git')
+    url = main.get_upstream_homebrew_core_url()
+
+    head = main.update_homebrew_core_mirror(mirror=mirror, url=url)
+    assert head == _git_rev_parse_head(local_homebrew_core['upstream'])
+    assert os.path.isfile(f'{mirror}.lock')
+
+    # the mirror is current, so nothing is fetched
+    with patch('action.main._run_subprocess') as mock_run:
+        assert main.update_homebrew_core_mirror(mirror=mirror, url=url) == head
+    mock_run.assert_not_called()
+
+    # upstream moves on, and only the new commit is fetched
+    with open(os.path.join(local_homebrew_core['work'], 'README.md'), 'w') as f:
+        f.write('# homebrew-core v2\n')
+    subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-qam', 'readme'],
+                   cwd=local_homebrew_core['work'], check=True)
+    subprocess.run(['git', 'push', '-q', local_homebrew_core['upstream'], 'master'],
+                   cwd=local_homebrew_core['work'], check=True)
+
+    head = main.update_homebrew_core_mirror(mirror=mirror, url=url)
+    assert head == _git_rev_parse_head(local_homebrew_core['upstream'])
+
+
+def _git_rev_parse_head(path):
+    return subprocess.run(
+        ['git', 'rev-parse', 'refs/heads/master'],
+        cwd=path,
+        capture_output=True,
+    ).stdout.decode('utf-8').strip()
+
+
+@pytest.mark.parametrize('sparse_paths', [None, ['Formula/h/hello_world.rb']])
+def test_prepare_homebrew_core_fork_mirror(
+        github_output_file, local_homebrew_core, monkeypatch, tmp_path, sparse_paths):
+    mirror = str(tmp_path / 'homebrew-core.git')
+    monkeypatch.setenv('INPUT_HOMEBREW_CORE_MIRROR', mirror)
+
+    main.prepare_homebrew_core_fork(
+        branch_suffix='hello_world',
+        path=local_homebrew_core['fork'],
+        sparse_paths=sparse_paths,
+    )
+    assert not main.ERROR
+
+    with open(os.path.join(local_homebrew_core['fork'], '.git', 'objects', 'info', 'alternates'), 'r') as f:
+        assert f.read().splitlines() == [os.path.join(mirror, 'objects')]
+
+    # upstream was never added as a remote, the objects are borrowed from the mirror instead
+    remotes = subprocess.run(['git', 'remote'], cwd=local_homebrew_core['fork'], capture_output=True)
+    assert remotes.stdout.decode('utf-8').split() == ['origin']
+
+    with open(os.path.join(local_homebrew_core['fork'], 'Formula', 'h', 'hello_world.rb'), 'r') as f:
+        assert f.read() == '# Formula/h/hello_world.rb v2\n'
+
+    # a second run reuses the mirror without fetching or updating any refs
+    with patch('action.main._run_subprocess', return_value=True) as mock_run:
+        main.prepare_homebrew_core_fork(
+            branch_suffix='hello_world',
+            path=local_homebrew_core['fork'],
+            sparse_paths=sparse_paths,
+        )
+    commands = [call.kwargs['args_list'][:2] for call in mock_run.call_args_list]
+    assert ['git', 'fetch'] not in commands
+    assert ['git', 'update-ref'] not in commands
+
+    with open(os.path.join(local_homebrew_core['fork'], '.git', 'objects', 'info', 'alternates'), 'r') as f:
+        assert len(f.read().splitlines()) == 1
+
+
+def test_prepare_homebrew_core_fork_mirror_no_git_dir(local_homebrew_core, monkeypatch, tmp_path):
+    monkeypatch.setenv('INPUT_HOMEBREW_CORE_MIRROR', str(tmp_path / 'homebrew-core.git'))
+
+    with patch('action.main.update_homebrew_core_mirror', return_value='a' * 40), \
+            patch('action.main._capture_subprocess', return_value=None):
+        assert not main._borrow_homebrew_core_mirror(path=local_homebrew_core['fork'])
+    assert not main.ERROR
+
+
+def test_prepare_homebrew_core_fork_traced(github_output_file, local_homebrew_core, monkeypatch, tmp_path,
+                                           trace_events):
+    monkeypatch.setenv('INPUT_HOMEBREW_CORE_MIRROR', str(tmp_path / 'homebrew-core.git'))
+
+    main.prepare_homebrew_core_fork(branch_suffix='hello_world', path=local_homebrew_core['fork'])
+
+    # the git calls of the fork are nested in the span of the phase
+    phase = next(event for event in trace_events if event['name'] == 'prepare_homebrew_core_fork')
+    assert any(
+        event['cat'] == 'subprocess' and phase['ts'] <= event['ts'] <= phase['ts'] + phase['dur']
+        for event in trace_events
+    )
+    assert not any(event['name'] == '_file_lock' for event in trace_events)
+
+
+def test_prepare_homebrew_core_fork_mirror_failure(github_output_file, local_homebrew_core, monkeypatch, tmp_path):
+    monkeypatch.setenv('INPUT_HOMEBREW_CORE_MIRROR', str(tmp_path / 'homebrew-core.git'))
+
+    with patch('action.main.update_homebrew_core_mirror', return_value=None):
+        main.prepare_homebrew_core_fork(
+            branch_suffix='hello_world',
+            path=local_homebrew_core['fork'],
+        )
+    assert not main.ERROR
+
+    # fell back to fetching upstream
+    remotes = subprocess.run(['git', 'remote'], cwd=local_homebrew_core['fork'], capture_output=True)
+    assert sorted(remotes.stdout.decode('utf-8').split()) == ['origin', 'upstream']
+
+    with open(os.path.join(local_homebrew_core['fork'], 'Formula', 'h', 'hello_world.rb'), 'r') as f:
+        assert f.read() == '# Formula/h/hello_world.rb v2\n'
+
+
+def test_run_steps_sequential():
+    order = []
+    steps = [
+        main.Step(name='a', func=lambda: order.append('a') or 1),
+        main.Step(name='b', func=lambda: order.append('b') or 2, requires=('c',)),
+        main.Step(name='c', func=lambda: order.append('c') or 3, requires=('a',)),
+        main.Step(name='d', func=lambda: order.append('d') or 4),
+    ]
+    results = main.run_steps(steps=steps, max_concurrency=1)
+
+    assert results == {'a': 1, 'b': 2, 'c': 3, 'd': 4}
+    assert order == ['a', 'c', 'b', 'd']
+
+
+def test_run_steps_concurrent():
+    barrier = threading.Barrier(2, timeout=5)
+    prefixes = {}
+
+    def step(name):
+        def run():
+            prefixes[name] = getattr(main._OUTPUT_CONTEXT, 'prefix', '')
+            barrier.wait()  # only passes if both steps run at the same time
+            return name
+        return run
+
+    steps = [
+        main.Step(name='a', func=step('a')),
+        main.Step(name='b', func=step('b')),
+        main.Step(name='c', func=lambda: prefixes.setdefault('c', getattr(main._OUTPUT_CONTEXT, 'prefix', '')),
+                  requires=('a', 'b')),
+    ]
+    assert main.run_steps(steps=steps, max_concurrency=2) == {'a': 'a', 'b': 'b', 'c': ''}
+
+    # only the steps that overlap are prefixed, c runs alone
+    assert prefixes == {'a': '[a] ', 'b': '[b] ', 'c': ''}
+
+
+def test_run_subprocess_cwd_thread(tmp_path):
+    lines = []
+    with patch('os.chdir') as mock_chdir:
+        thread = threading.Thread(target=main._run_subprocess, kwargs=dict(
+            args_list=[sys.executable, '-c', 'import os; print(os.getcwd())'],
+            cwd=str(tmp_path),
+            line_callback=lines.append,
+        ))
+        thread.start()
+        thread.join()
+
+    # the cwd of the process is not changed from another thread
+    mock_chdir.assert_not_called()
+    assert lines == [f'{tmp_path}\n']
+
+
+def test_run_steps_failure():
+    ran = []
+
+    def fail():
+        ran.append('fail')
+        raise SystemExit(1)
+
+    def slow():
+        time.sleep(0.2)
+        ran.append('slow')
+
+    steps = [
+        main.Step(name='fail', func=fail),
+        main.Step(name='slow', func=slow),
+        main.Step(name='after', func=lambda: ran.append('after'), requires=('fail',)),
+    ]
+    with pytest.raises(SystemExit):
+        main.run_steps(steps=steps, max_concurrency=2)
+
+    # running steps are awaited, but no new steps are started
+    assert sorted(ran) == ['fail', 'slow']
+
+
+@pytest.mark.parametrize('steps, match', [
+    ([main.Step(name='a', func=lambda: None), main.Step(name='a', func=lambda: None)], 'Duplicate'),
+    ([main.Step(name='a', func=lambda: None, requires=('b',))], 'unknown'),
+    ([main.Step(name='a', func=lambda: None, requires=('b',)), main.Step(name='b', func=lambda: None, requires=('a',))],
+     'circular'),
+])
+def test_run_steps_invalid(steps, match):
+    with pytest.raises(ValueError, match=match):
+        main.run_steps(steps=steps, max_concurrency=2)
+
+
+@pytest.mark.parametrize('config, expected', [(True, True), (False, False)])
+def test_brew_debug_steps(config, expected):
+    with patch.multiple(main, brew_config=lambda: config, brew_doctor=lambda: False):
+        assert main.brew_debug() == expected
+
+
+def _write_download_formula(tmp_path, http_server, sha256=None):
+    directory, url = http_server
+    (directory / 'foo-1.0.tar.gz').write_bytes(os.urandom(3 * 1024))
+    (directory / 'bar-2.0.tar.gz').write_bytes(b'bar' * 1024)
+
+    sha256 = sha256 or {
+        name: hashlib.sha256((directory / name).read_bytes()).hexdigest()
+        for name in ('foo-1.0.tar.gz', 'bar-2.0.tar.gz')
+    }
+    formula_file = tmp_path / 'foo.rb'
+    formula_file.write_text(
+        'class Foo < Formula\n'
+        f'  url "{url}/foo-1.0.tar.gz"\n'
+        f'  sha256 "{sha256["foo-1.0.tar.gz"]}"\n'
+        '\n'
+        '  resource "bar" do\n'
+        f'    url "{url}/bar-2.0.tar.gz"\n'
+        f'    sha256 "{sha256["bar-2.0.tar.gz"]}"\n'
+        '  end\n'
+        '\n'
+        '  resource "baz" do\n'
+        '    url "https://example.com/baz.git", revision: "abc"\n'
+        '  end\n'
+        'end\n'
+    )
+    return str(formula_file), url
+
+
+@pytest.fixture(scope='function')
+def temp_directories(tmp_path, monkeypatch):
+    directories = {}
+    for name in ('buildpath', 'testpath'):
+        directory = tmp_path / name
+        (directory / 'build' / 'CMakeFiles').mkdir(parents=True)
+        (directory / 'build' / 'CMakeFiles' / 'CMakeError.log').write_text('error')
+        (directory / 'build' / 'CMakeCache.txt').write_text('cache')
+        (directory / 'build' / 'main.o').write_bytes(os.urandom(1024))
+        (directory / 'config.log').write_text('log')
+        directories[name] = str(directory)
+
+    monkeypatch.setattr(main, 'BUILDPATHS', dict(foo=directories['buildpath']))
+    monkeypatch.setattr(main, 'TESTPATHS', dict(foo=directories['testpath']))
+    return directories
+
+
+@pytest.mark.parametrize('include, exclude, expected', [
+    ([], [], [
+        'buildpath/build/CMakeCache.txt',
+        'buildpath/build/CMakeFiles/CMakeError.log',
+        'buildpath/build/main.o',
+        'buildpath/config.log',
+    ]),
+    (['*.log', 'CMake*'], [], [
+        'buildpath/build/CMakeCache.txt',
+        'buildpath/build/CMakeFiles/CMakeError.log',
+        'buildpath/config.log',
+    ]),
+    ([], ['*.o', 'build/CMakeFiles/*'], [
+        'buildpath/build/CMakeCache.txt',
+        'buildpath/config.log',
+    ]),
+])
+def test_create_archive(tmp_path, temp_directories, include, exclude, expected):
+    archive_file = str(tmp_path / 'out' / 'archive.tar.gz')
+    count = main.create_archive(
+        archive_file=archive_file,
+        directories=dict(buildpath=temp_directories['buildpath']),
+        include=include,
+        exclude=exclude,
+    )
+    assert count == len(expected)
+
+    with tarfile.open(archive_file, 'r:gz') as tar:
+        assert sorted(tar.getnames()) == expected
+        assert tar.extractfile('buildpath/build/CMakeCache.txt').read() == b'cache'
+
+
+def test_archive_temp_directories(github_output_file, tmp_path, temp_directories, monkeypatch):
+    assert main.archive_temp_directories(formulae=['foo']) is None
+
+    archive_file = str(tmp_path / 'archive.tar.gz')
+    monkeypatch.setenv('INPUT_ARCHIVE_FILE', archive_file)
+    monkeypatch.setenv('INPUT_ARCHIVE_INCLUDE', '*.log\n')
+    assert main.archive_temp_directories(formulae=['foo']) == archive_file
+
+    with tarfile.open(archive_file, 'r:gz') as tar:
+        assert sorted(tar.getnames()) == [
+            'buildpath/build/CMakeFiles/CMakeError.log',
+            'buildpath/config.log',
+            'testpath/build/CMakeFiles/CMakeError.log',
+            'testpath/config.log',
+        ]
+
+    with open(github_output_file, 'r') as f:
+        assert f'archive<<EOF\n{archive_file}\nEOF\n' in f.read()
+
+    # the directories of each formula are archived under the formula name
+    main.BUILDPATHS['bar'] = temp_directories['buildpath']
+    main.archive_temp_directories(formulae=['foo', 'bar'])
+    with tarfile.open(archive_file, 'r:gz') as tar:
+        assert {name.split('/')[0] for name in tar.getnames()} == {'foo', 'bar'}
+        assert 'bar/buildpath/config.log' in tar.getnames()
+
+
+def test_get_formula_downloads(tmp_path, http_server):
+    formula_file, url = _write_download_formula(tmp_path, http_server)
+    downloads = main.get_formula_downloads(formula_file)
+    assert [(download['name'], download['url']) for download in downloads] == [
+        ('source', f'{url}/foo-1.0.tar.gz'),
+        ('bar', f'{url}/bar-2.0.tar.gz'),
+    ]
+
+
+def test_get_formula_downloads_platform(tmp_path):
+    formula_file = tmp_path / 'foo.rb'
+    formula_file.write_text(
+        'class Foo < Formula\n'
+        '  on_linux do\n'
+        '    url "https://example.com/foo-linux.tar.gz"\n'
+        f'    sha256 "{FORMULA_SHA256}"\n'
+        '  end\n'
+        'end\n'
+    )
+
+    # the url may be for another platform, so it is left to brew
+    assert main.get_formula_downloads(str(formula_file)) == []
+
+
+def test_get_download_cache_path():
+    url = 'https://example.com/foo%20bar-1.0.tar.gz?raw=true'
+    path = main.get_download_cache_path(cache_dir='cache', url=url)
+    assert path == os.path.join('cache', 'downloads', f'{hashlib.sha256(url.encode()).hexdigest()}--foo bar-1.0.tar.gz')
+
+
+def test_prefetch_formula(tmp_path, http_server, monkeypatch):
+    monkeypatch.setattr(main, 'DOWNLOAD_CHUNK_SIZE', 1000)
+    formula_file, url = _write_download_formula(tmp_path, http_server)
+    cache_dir = str(tmp_path / 'cache')
+
+    assert main.prefetch_formula(formula_file=formula_file, cache_dir=cache_dir)
+    for name in ('foo-1.0.tar.gz', 'bar-2.0.tar.gz'):
+        path = main.get_download_cache_path(cache_dir=cache_dir, url=f'{url}/{name}')
+        assert open(path, 'rb').read() == (http_server[0] / name).read_bytes()
+
+    # cached files are verified, not downloaded again
+    with patch('urllib.request.urlopen') as mock_urlopen:
+        assert main.prefetch_formula(formula_file=formula_file, cache_dir=cache_dir)
+    mock_urlopen.assert_not_called()
+
+
+def test_prefetch_formula_mismatch(tmp_path, http_server):
+    formula_file, url = _write_download_formula(
+        tmp_path,
+        http_server,
+        sha256={'foo-1.0.tar.gz': '0' * 64, 'bar-2.0.tar.gz': '0' * 64},
+    )
+    cache_dir = str(tmp_path / 'cache')
+
+    assert not main.prefetch_formula(formula_file=formula_file, cache_dir=cache_dir)
+    assert not os.listdir(os.path.join(cache_dir, 'downloads'))  # no partial or unverified files are left behind
+
+
+def test_prefetch_formula_unreachable(tmp_path, http_server):
+    formula_file, url = _write_download_formula(tmp_path, http_server)
+    os.remove(http_server[0] / 'bar-2.0.tar.gz')
+
+    # the download is left to brew
+    assert main.prefetch_formula(formula_file=formula_file, cache_dir=str(tmp_path / 'cache'))
+
+
+@pytest.mark.parametrize('prefetch_result', [True, False])
+def test_main_prefetch(main_output_files, monkeypatch, prefetch_result):
+    monkeypatch.setenv('INPUT_VALIDATE', 'true')
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'false')
+    monkeypatch.setenv('INPUT_PREFETCH', 'true')
+    main.FAILURES = []
+    main.args = main._parse_args([])
+    order = []
+
+    def record(name, result=True):
+        def run(*args, **kwargs):
+            order.append(name)
+            return result
+        return run
+
+    with patch.multiple(
+            main,
+            is_brew_installed=record('is_brew_installed'),
+            process_input_formula=record('process_input_formula', 'hello_world'),
+            prefetch_formula=record('prefetch_formula', prefetch_result),
+            brew_upgrade=record('brew_upgrade'),
+            brew_debug=record('brew_debug'),
+            validate_formula_cached=record('validate_formula_cached', []),
+            set_github_action_output=record('set_github_action_output', None),
+    ):
+        if prefetch_result:
+            main._main()
+        else:
+            with pytest.raises(SystemExit):
+                main._main()
+
+    assert 'prefetch_formula' in order
+    assert ('validate_formula_cached' in order) is prefetch_result
+    if prefetch_result:
+        assert order.index('prefetch_formula') < order.index('validate_formula_cached')
+
+
+def test_main_contribute(main_output_files, monkeypatch):
+    monkeypatch.setenv('INPUT_VALIDATE', 'true')
+    monkeypatch.setenv('INPUT_CONTRIBUTE_TO_HOMEBREW_CORE', 'true')
+    monkeypatch.setenv('INPUT_MAX_CONCURRENCY', '4')
+    main.FAILURES = []
+    main.args = main._parse_args([])
+    order = []
+
+    def record(name, result=True):
+        def run(*args, **kwargs):
+            order.append(name)
+            return result
+        return run
+
+    with patch.multiple(
+            main,
+            is_brew_installed=record('is_brew_installed'),
+            process_input_formula=record('process_input_formula', 'hello_world'),
+            contribute_formula=record('contribute_formula', None),
+            brew_upgrade=record('brew_upgrade'),
+            brew_debug=record('brew_debug'),
+            validate_formula_cached=record('validate_formula_cached', []),
+            set_github_action_output=record('set_github_action_output', None),
+    ):
+        main._main()
+
+    assert order.index('process_input_formula') < order.index('contribute_formula')
+    assert order.index('contribute_formula') < order.index('validate_formula_cached')
+    assert order.index('brew_debug') < order.index('validate_formula_cached')
+    assert not main.FAILURES